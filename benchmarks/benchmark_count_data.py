@@ -0,0 +1,99 @@
+"""
+Times the range join, distance filter and NPMI steps of `count_data` on synthetic records, comparing the original
+pandas implementations with the numpy implementations and, when numba is installed, the compiled kernels.
+
+    python benchmarks/benchmark_count_data.py [records]
+"""
+
+# standard libraries
+import os
+import sys
+import time
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# local imports
+from osm_multiplex import count_data
+from osm_multiplex import kernels
+
+def synthetic_records(records, suffix, seed):
+    """Records spread over a day and a few square kilometers, tagged with a few thousand identifiers"""
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'element_id' + suffix: rng.randint(0, 5000, records).astype(str),
+                         'timestamp' + suffix: np.sort(rng.randint(0, 86400, records)),
+                         'lat' + suffix: 44.55 + rng.rand(records) * 0.03,
+                         'lon' + suffix: -123.28 + rng.rand(records) * 0.03})
+
+def pandas_haversine_dist_filter(dataframe, dist_max=100):
+    """The original column-by-column distance filter"""
+    radius = 6378137 # meters
+
+    dataframe = dataframe.copy()
+    dataframe['dlat'] = np.radians(dataframe['lat2']-dataframe['lat1'])
+    dataframe['dlon'] = np.radians(dataframe['lon2']-dataframe['lon1'])
+    dataframe['a'] = np.sin(dataframe['dlat']/2)**2 + np.cos(np.radians(dataframe['lat1'])) * np.cos(np.radians(dataframe['lat2'])) * np.sin(dataframe['dlon']/2)**2
+    dataframe['c'] = 2 * np.arcsin(np.sqrt(dataframe['a']))
+    dataframe['dist'] = radius * dataframe['c']
+
+    close_distance = dataframe['dist'] <= dist_max
+    return dataframe[close_distance].drop(columns=['dlat', 'dlon', 'a', 'c', 'dist']).reset_index(drop=True)
+
+def pandas_npmi(dataframe):
+    """The original groupby and join NPMI"""
+    id_only = dataframe[['element_id1', 'element_id2']]
+    ids_size = id_only.groupby(['element_id1', 'element_id2']).size().to_frame('ids_count')
+    id1_size = id_only.groupby(['element_id1']).size().to_frame('id1_count')
+    id2_size = id_only.groupby(['element_id2']).size().to_frame('id2_count')
+    total_id_count = id_only.shape[0]
+    id_distinct = id_only.drop_duplicates().reset_index(drop=True)
+
+    calculations = id_distinct.join(ids_size, on=['element_id1', 'element_id2']).join(id1_size, on=['element_id1']).join(id2_size, on=['element_id2'])
+    calculations['pmi'] = np.log((calculations['ids_count'] / total_id_count) / ((calculations['id1_count'] / total_id_count) * (calculations['id2_count'] / total_id_count)))
+    calculations['npmi'] = calculations['pmi'] / (-1 * np.log(calculations['ids_count'] / total_id_count))
+
+    return calculations[['element_id1', 'element_id2', 'npmi']]
+
+def best_time(function, *args, repeat=3):
+    """Fastest of `repeat` runs in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def compare(step, reference, implementation, *args):
+    """Prints the time of the reference and of `implementation` with the kernels off and on"""
+    reference_time = best_time(reference, *args)
+
+    kernels.ENABLED = False
+    numpy_time = best_time(implementation, *args)
+    row = '{:<16}{:>12.4f}{:>12.4f} ({:>5.1f}x)'.format(step, reference_time, numpy_time, reference_time / numpy_time)
+
+    if kernels.NUMBA_AVAILABLE:
+        kernels.ENABLED = True
+        implementation(*args) # compiles the kernel outside of the timing
+        numba_time = best_time(implementation, *args)
+        row += '{:>12.4f} ({:>5.1f}x)'.format(numba_time, reference_time / numba_time)
+
+    print(row)
+
+def main(records=20000):
+    data1 = synthetic_records(records, '1', 0)
+    data2 = synthetic_records(records, '2', 1)
+    joined = count_data.time_range_join_sorted(data1, data2, 60)
+
+    print(str(records) + ' records per dataset, ' + str(len(joined)) + ' pairs within 60 seconds')
+    print('{:<16}{:>12}{:>20}{:>20}'.format('step', 'pandas (s)', 'numpy (s)', 'numba (s)'))
+    compare('range join', count_data.time_range_join_np, count_data.time_range_join_sorted, data1, data2, 60)
+    compare('distance', pandas_haversine_dist_filter, count_data.haversine_dist_filter, joined, 100)
+    compare('npmi', pandas_npmi, count_data.npmi, joined)
+    compare('npmi sparse', pandas_npmi, count_data.npmi_sparse, joined)
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
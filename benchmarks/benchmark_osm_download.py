@@ -0,0 +1,87 @@
+"""
+Times merging the co-located nodes of a synthetic multi-layer graph with `osm_download.merge_multiplex_nodes`,
+comparing it with the original implementation that scans every node for each OSM id. The original is only timed
+on the smallest graph as it grows quadratically.
+
+    python benchmarks/benchmark_osm_download.py [nodes per layer] [layers]
+"""
+
+# standard libraries
+import copy
+import os
+import re
+import sys
+import time
+
+# third-party libraries
+import networkx as nx
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'osm_multiplex'))
+
+# local imports
+import osm_download
+
+MODES = ['walk', 'bike', 'drive', 'drive_service']
+
+def synthetic_multiplex(nodes, layers, seed=0):
+    """Layers sharing most of their OSM node ids, each a chain of its nodes with a few random street edges"""
+    rng = np.random.RandomState(seed)
+    osm_ids = rng.choice(10 * nodes, size=nodes + nodes // 4, replace=False)
+    separated = nx.MultiDiGraph()
+    for mode in MODES[:layers]:
+        layer_ids = rng.choice(osm_ids, size=nodes, replace=False)
+        layer_nodes = [mode + '-' + str(osm_id) for osm_id in layer_ids]
+        separated.add_nodes_from(layer_nodes)
+        separated.add_edges_from(zip(layer_nodes[:-1], layer_nodes[1:]))
+        ends = rng.randint(0, nodes, size=(nodes // 2, 2))
+        separated.add_edges_from((layer_nodes[start], layer_nodes[end]) for start, end in ends)
+
+    return separated
+
+def original_merge_multiplex_nodes(multiplex_separated):
+    """The original merge, matching OSM ids as substrings of every node"""
+    node_list = list(multiplex_separated.nodes)
+    node_list_all = copy.deepcopy(node_list)
+    node_num = []
+    for node in node_list:
+        node_num.append(re.sub('^.*?-', '', node))
+    node_set = set(node_num)
+
+    for node in node_set:
+        colocated_nodes = [mode_node for mode_node in node_list_all if node in mode_node]
+        for start_node in colocated_nodes:
+            for end_node in colocated_nodes:
+                multiplex_separated.add_edge(start_node, end_node)
+            multiplex_separated.remove_edge(start_node, start_node)
+
+    return multiplex_separated
+
+def merge_time(function, separated, repeat=3):
+    """Fastest of `repeat` merges of copies of `separated` in seconds, with the edges of the last merge"""
+    times = []
+    for _ in range(repeat):
+        graph = separated.copy()
+        start = time.perf_counter()
+        function(graph)
+        times.append(time.perf_counter() - start)
+
+    return min(times), graph.number_of_edges()
+
+def main(nodes=100000, layers=3):
+    print('{:>10}{:>10}{:>16}{:>16}{:>16}'.format('nodes', 'edges', 'transfers', 'original (s)', 'dict (s)'))
+    for layer_nodes in sorted({min(1000, nodes), min(10000, nodes), nodes}):
+        separated = synthetic_multiplex(layer_nodes, layers)
+        merged_time, merged_edges = merge_time(osm_download.merge_multiplex_nodes, separated)
+        transfers = merged_edges - separated.number_of_edges()
+
+        # the original grows quadratically, so it is only run on the smallest graph
+        if layer_nodes <= 1000:
+            original = '{:>16.4f}'.format(merge_time(original_merge_multiplex_nodes, separated, repeat=1)[0])
+        else:
+            original = '{:>16}'.format('-')
+        print('{:>10}{:>10}{:>16}'.format(separated.number_of_nodes(), separated.number_of_edges(), transfers)
+              + original + '{:>16.4f}'.format(merged_time))
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -1,13 +1,18 @@
+# standard libraries
+import os
+
 # third-party libraries
 from argparse import ArgumentParser
 from networkx import write_gpickle
-import pickle
 
 # local imports
-from osm_download import generate_multiplex
-from count_data import process_data
+from artifacts import ArtifactStore, DATA_DIR
+from osm_download import generate_multiplex, generate_tiled_multiplex, OsmLayerCache, LAYER_CACHE_TTL
+from multiplex_arrays import CsrMultiplex
+from count_data import process_data, JOIN_ENGINES
 from lstm_preprocessing import preprocess
-from lstm import anomaly_detect
+from lstm import anomaly_detect, save_reconstruction
+from pipeline import run_pipeline, STAGE_NAMES
 
 parser = ArgumentParser(description='Utility for multiplex graph generation '
                                     'and anomaly detection for collected counts.'
@@ -32,6 +37,45 @@ parser.add_argument('-gm', '--graph-modes',
                     help='Specify modes for multiplex graph generation'
                     )
 
+parser.add_argument('-gc', '--graph-csr',
+                    dest='graph_csr',
+                    action='store_true',
+                    required=False,
+                    help='Save the multiplex graph as memory-mappable CSR arrays rather than a gpickle'
+                    )
+
+parser.add_argument('-gt', '--graph-tile-size',
+                    dest='graph_tile_size',
+                    type=float,
+                    default=None,
+                    required=False,
+                    help='Build the multiplex graph in tiles of this many degrees, with the area given as '
+                         'north,south,east,west'
+                    )
+
+parser.add_argument('-oc', '--osm-cache',
+                    dest='osm_cache',
+                    type=str,
+                    default=None,
+                    required=False,
+                    help='Directory caching the downloaded OSM layers between runs'
+                    )
+
+parser.add_argument('-ot', '--osm-cache-ttl',
+                    dest='osm_cache_ttl',
+                    type=int,
+                    default=LAYER_CACHE_TTL,
+                    required=False,
+                    help='Seconds a cached OSM layer is used before it is downloaded again'
+                    )
+
+parser.add_argument('-of', '--offline',
+                    dest='offline',
+                    action='store_true',
+                    required=False,
+                    help='Build the multiplex graph only from the OSM layer cache'
+                    )
+
 parser.add_argument('-ad', '--anomaly-detect',
                     dest='anomaly_detect',
                     action='store_true',
@@ -45,6 +89,39 @@ parser.add_argument('-j', '--joined',
                     help='Use already joined datasets'
                     )
 
+parser.add_argument('-cp', '--checkpoint-dir',
+                    dest='checkpoint_dir',
+                    type=str,
+                    default=None,
+                    required=False,
+                    help='Run anomaly detection as a staged pipeline checkpointed in this directory, '
+                         'skipping stages whose inputs are unchanged'
+                    )
+
+parser.add_argument('-rf', '--rerun-from',
+                    dest='rerun_from',
+                    choices=STAGE_NAMES,
+                    default=None,
+                    required=False,
+                    help='Pipeline stage to run again along with those after it'
+                    )
+
+parser.add_argument('-dd', '--detection-distance',
+                    dest='detection_distance',
+                    type=float,
+                    default=50,
+                    required=False,
+                    help='Maximum distance in meters between paired records'
+                    )
+
+parser.add_argument('-dt', '--detection-time',
+                    dest='detection_time',
+                    type=int,
+                    default=60,
+                    required=False,
+                    help='Maximum time in seconds between paired records'
+                    )
+
 parser.add_argument('-t', '--testing',
                     action='store_true',
                     required=False,
@@ -212,6 +289,21 @@ parser.add_argument('-np', '--npmi',
                     help='Filter datasets using NMPI'
                     )
 
+parser.add_argument('-nc', '--npmi-counts',
+                    dest='npmi_counts',
+                    type=str,
+                    default=None,
+                    required=False,
+                    help='Parquet file of pair counts from earlier runs, updated with this run for the NPMI'
+                    )
+
+parser.add_argument('-an', '--approximate-npmi',
+                    dest='approximate_npmi',
+                    action='store_true',
+                    required=False,
+                    help='Estimate the NPMI of the most frequent pairs in fixed memory'
+                    )
+
 parser.add_argument('-r', '--rolling',
                     dest='rolling',
                     action='store_true',
@@ -219,15 +311,116 @@ parser.add_argument('-r', '--rolling',
                     help='Process using rolling detection'
                     )
 
+parser.add_argument('-cs', '--chunk-size',
+                    dest='chunk_size',
+                    type=int,
+                    default=None,
+                    required=False,
+                    help='Seconds of data joined per chunk when streaming the range join'
+                    )
+
+parser.add_argument('-mm', '--max-memory',
+                    dest='max_memory',
+                    type=int,
+                    default=None,
+                    required=False,
+                    help='Approximate maximum bytes per chunk when streaming the range join'
+                    )
+
+parser.add_argument('-je', '--join-engine',
+                    dest='join_engine',
+                    type=str,
+                    default='auto',
+                    choices=['auto'] + list(JOIN_ENGINES),
+                    required=False,
+                    help='Range join engine, chosen by estimated join size if auto'
+                    )
+
+parser.add_argument('-rc', '--read-chunksize',
+                    dest='chunksize',
+                    type=int,
+                    default=None,
+                    required=False,
+                    help='Records per csv chunk when streaming the datasets from disk'
+                    )
+
+parser.add_argument('-cd', '--cache-dir',
+                    dest='cache_dir',
+                    type=str,
+                    default=None,
+                    required=False,
+                    help='Directory caching the normalized datasets between runs'
+                    )
+
+parser.add_argument('-cz', '--cache-size',
+                    dest='cache_size',
+                    type=int,
+                    default=2 * 1024**3,
+                    required=False,
+                    help='Bytes the dataset cache is trimmed to'
+                    )
+
+parser.add_argument('-c', '--compact',
+                    dest='compact',
+                    action='store_true',
+                    required=False,
+                    help='Read only the needed csv columns into compact types'
+                    )
+
+parser.add_argument('-da', '--data-dir',
+                    dest='data_dir',
+                    type=str,
+                    default=DATA_DIR,
+                    required=False,
+                    help='Directory of the saved intermediate results'
+                    )
+
 args = parser.parse_args()
+store = ArtifactStore(args.data_dir)
 
 if args.graph == True:
-    multiplex = generate_multiplex(args.graph_area, [args.graph_modes])
-    write_gpickle(multiplex, './osm_multiplex/data/multiplex.gpickle')
+    if args.osm_cache is not None:
+        cache = OsmLayerCache(args.osm_cache, ttl=args.osm_cache_ttl, offline=args.offline)
+    elif args.offline == True:
+        raise Exception('Offline graph generation needs an OSM layer cache')
+    else:
+        cache = None
+    if args.graph_tile_size is not None:
+        area = [float(bound) for bound in args.graph_area.split(',')]
+        multiplex = generate_tiled_multiplex(area, [args.graph_modes], tile_size=args.graph_tile_size, cache=cache)
+    else:
+        multiplex = generate_multiplex(args.graph_area, [args.graph_modes], cache=cache)
+    if args.graph_csr == True:
+        CsrMultiplex.from_networkx(multiplex).save(os.path.join(args.data_dir, 'multiplex'))
+    else:
+        os.makedirs(args.data_dir, exist_ok=True)
+        write_gpickle(multiplex, os.path.join(args.data_dir, 'multiplex.gpickle'))
+elif args.anomaly_detect == True and args.checkpoint_dir is not None:
+    if args.chunksize is not None or args.cache_dir is not None or args.npmi_counts is not None:
+        raise Exception('Checkpointed runs cannot stream csv chunks, use the ingestion cache or keep npmi counts')
+    headers1 = {'element_id': args.element_id1, 'timestamp': args.timestamp1, 'session_start': args.session_start1,
+                'session_end': args.session_end1, 'boardings': args.boardings1, 'alightings': args.alightings1,
+                'occupancy': args.occupancy1, 'lat': args.latitude1, 'lon': args.longitude1}
+    headers2 = {'element_id': args.element_id2, 'timestamp': args.timestamp2, 'session_start': args.session_start2,
+                'session_end': args.session_end2, 'boardings': args.boardings2, 'alightings': args.alightings2,
+                'occupancy': args.occupancy2, 'lat': args.latitude2, 'lon': args.longitude2}
+    outputs = run_pipeline(args.dataset1, args.dataset2, checkpoint_dir=args.checkpoint_dir,
+                           stop_after='preprocess' if args.rolling == True else 'detect', rerun_from=args.rerun_from,
+                           headers1=headers1, headers2=headers2, compact=args.compact, engine=args.join_engine,
+                           chunk_size=args.chunk_size, max_memory=args.max_memory,
+                           detection_distance=args.detection_distance, detection_time=args.detection_time,
+                           run_npmi=args.npmi, approximate_npmi=args.approximate_npmi, locations=args.locations,
+                           testing=args.testing)
+    if args.rolling == True:
+        anomalies = anomaly_detect(outputs['preprocessed'], "rolling", locations=args.locations, store=store)
+    else:
+        anomalies = outputs['anomalies']
+        save_reconstruction(store, anomalies, outputs['collected_target'], outputs['predicted_target'])
+    store.put('anomaly_results', anomalies)
 elif args.anomaly_detect == True:
     if args.joined == True:
         print("Loading joined dataset")
-        likely_pairs = pickle.load(open('./osm_multiplex/data/likely_pairs.pickle', 'rb'))
+        likely_pairs = store.get('likely_pairs')
     else:
         print("Merging datasets")
         likely_pairs = process_data(args.dataset1, args.dataset2, run_npmi=args.npmi,
@@ -236,16 +429,20 @@ elif args.anomaly_detect == True:
         lat1=args.latitude1, lon1=args.longitude1,
         element_id2=args.element_id2, timestamp2=args.timestamp2, session_start2=args.session_start2, session_end2=args.session_end2,
         boardings2=args.boardings2, alightings2=args.alightings2, occupancy2=args.occupancy2,
-        lat2=args.latitude2, lon2=args.longitude2)
-        pickle.dump(likely_pairs, open('./osm_multiplex/data/likely_pairs.pickle', 'wb'))
+        lat2=args.latitude2, lon2=args.longitude2, chunk_size=args.chunk_size, max_memory=args.max_memory,
+        engine=args.join_engine, compact=args.compact, chunksize=args.chunksize,
+        cache_dir=args.cache_dir, cache_size=args.cache_size, npmi_counts=args.npmi_counts,
+        approximate_npmi=args.approximate_npmi, detection_distance=args.detection_distance,
+        detection_time=args.detection_time)
+        store.put('likely_pairs', likely_pairs)
     print("Preprocessing for LSTM")
     preprocessed = preprocess(likely_pairs)
-    pickle.dump(preprocessed, open('./osm_multiplex/data/lstm_preprocessed.pickle', 'wb'))
+    store.put('lstm_preprocessed', preprocessed)
     print("LSTM processing")
     if args.rolling == True:
-        anomalies = anomaly_detect(preprocessed, "rolling", locations=args.locations)
+        anomalies = anomaly_detect(preprocessed, "rolling", locations=args.locations, store=store)
     else:
-        anomalies = anomaly_detect(preprocessed, locations=args.locations, testing=args.testing)
-    pickle.dump(anomalies, open('./osm_multiplex/data/anomaly_results.pickle', 'wb'))
+        anomalies = anomaly_detect(preprocessed, locations=args.locations, testing=args.testing, store=store)
+    store.put('anomaly_results', anomalies)
 else:
     raise Exception('No action specified')
\ No newline at end of file
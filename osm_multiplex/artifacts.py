@@ -0,0 +1,233 @@
+"""
+.. moduleauthor:: Sylvan Hoover <hooversy@oregonstate.edu>
+
+Store for the intermediate results handed between the steps of the project. DataFrames are written as Parquet or
+Feather, numpy arrays as memory-mappable `.npy` files and other results as json, with the kind and location of
+every artifact kept in a manifest at the root of the store.
+"""
+
+# standard libraries
+import collections.abc
+import json
+import os
+import shutil
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+DATA_DIR = './osm_multiplex/data'
+
+MANIFEST = 'manifest.json'
+
+def _json_default(value):
+    """Converts the numpy scalars in results for json"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Cannot store ' + type(value).__name__ + ' as json')
+
+def _write_frame(dataframe, path, frame_format):
+    table = pa.Table.from_pandas(dataframe)
+    if frame_format == 'feather':
+        # uncompressed so it can be memory mapped when read
+        feather.write_feather(table, path, compression='uncompressed')
+    else:
+        pq.write_table(table, path)
+
+def _read_frame(path, frame_format, columns=None):
+    if frame_format == 'feather':
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pq.read_table(path, columns=columns, use_pandas_metadata=True)
+
+    return table.to_pandas()
+
+class LazyArtifacts(collections.abc.Mapping):
+    """Read-only mapping of a stored collection of DataFrames or arrays that reads each entry when it is first
+    accessed
+
+    Parameters
+    ----------
+    files : dict
+        Each key is the name of an entry with the value being its file path
+
+    reader : function
+        Reads an entry from its file path
+    """
+    def __init__(self, files, reader):
+        self.files = files
+        self.reader = reader
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = self.reader(self.files[name])
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+class ArtifactStore(object):
+    """Named artifacts under a root directory
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store, created when the first artifact is written
+    """
+    def __init__(self, root=DATA_DIR):
+        self.root = root
+        manifest_path = os.path.join(root, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        else:
+            self.manifest = {}
+
+    def __contains__(self, name):
+        return name in self.manifest
+
+    def names(self):
+        """Names of the stored artifacts"""
+        return list(self.manifest)
+
+    def metadata(self, name):
+        """Metadata stored with an artifact"""
+        return self.manifest[name]['metadata']
+
+    def _write_manifest(self):
+        # replaced in one step so readers never see a partial manifest
+        partial = os.path.join(self.root, MANIFEST + '.partial')
+        with open(partial, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1, default=_json_default)
+        os.replace(partial, os.path.join(self.root, MANIFEST))
+
+    def _remove_files(self, name):
+        path = os.path.join(self.root, self.manifest[name]['path'])
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def put(self, name, value, frame_format='parquet', metadata=None):
+        """Writes an artifact, replacing any artifact of the same name
+
+        Parameters
+        ----------
+        name : str
+            Name of the artifact
+
+        value : pandas DataFrame, numpy array, dict or json serializable
+            The artifact. A dict whose values are all DataFrames or all arrays is written as a collection with one
+            file per entry
+
+        frame_format : str
+            Format of DataFrames, either 'parquet' or 'feather'
+
+        metadata : dict
+            Json serializable information kept in the manifest with the artifact
+
+        Returns
+        -------
+        kind : str
+            Kind of artifact written, one of 'frame', 'array', 'frames', 'arrays' or 'json'
+        """
+        os.makedirs(self.root, exist_ok=True)
+        if name in self.manifest:
+            self._remove_files(name)
+        entry = {'metadata': metadata or {}}
+        frame_extension = '.feather' if frame_format == 'feather' else '.parquet'
+
+        if isinstance(value, pd.DataFrame):
+            entry.update(kind='frame', format=frame_format, path=name + frame_extension,
+                         columns=[str(column) for column in value.columns])
+            _write_frame(value, os.path.join(self.root, entry['path']), frame_format)
+        elif isinstance(value, np.ndarray):
+            entry.update(kind='array', path=name + '.npy', shape=list(value.shape), dtype=str(value.dtype))
+            np.save(os.path.join(self.root, entry['path']), value)
+        elif (isinstance(value, dict) and value and
+              (all(isinstance(item, pd.DataFrame) for item in value.values()) or
+               all(isinstance(item, np.ndarray) for item in value.values()))):
+            frames = isinstance(next(iter(value.values())), pd.DataFrame)
+            entry.update(kind='frames' if frames else 'arrays', format=frame_format, path=name, entries={})
+            os.makedirs(os.path.join(self.root, name), exist_ok=True)
+            # entries are numbered since their names may not be valid file names
+            for position, (entry_name, item) in enumerate(value.items()):
+                entry_path = os.path.join(name, 'part-%05d' % position + (frame_extension if frames else '.npy'))
+                entry['entries'][entry_name] = entry_path
+                if frames:
+                    _write_frame(item, os.path.join(self.root, entry_path), frame_format)
+                else:
+                    np.save(os.path.join(self.root, entry_path), item)
+        else:
+            entry.update(kind='json', path=name + '.json')
+            with open(os.path.join(self.root, entry['path']), 'w') as json_file:
+                json.dump(value, json_file, default=_json_default)
+
+        self.manifest[name] = entry
+        self._write_manifest()
+
+        return entry['kind']
+
+    def get(self, name, columns=None, lazy=False, mmap=True):
+        """Reads an artifact
+
+        Parameters
+        ----------
+        name : str
+            Name of the artifact
+
+        columns : list
+            For DataFrames, only these columns are read
+
+        lazy : bool
+            For collections, return a mapping that reads each entry when it is first accessed
+
+        mmap : bool
+            Whether arrays are memory mapped rather than read into memory
+
+        Returns
+        -------
+        value : pandas DataFrame, numpy array, dict or json value
+            The artifact
+        """
+        if name not in self.manifest:
+            raise KeyError('No artifact named ' + name + ' in ' + self.root)
+        entry = self.manifest[name]
+        kind = entry['kind']
+
+        if kind == 'frame':
+            return _read_frame(os.path.join(self.root, entry['path']), entry['format'], columns=columns)
+        if kind == 'array':
+            return np.load(os.path.join(self.root, entry['path']), mmap_mode='r' if mmap else None)
+        if kind == 'json':
+            with open(os.path.join(self.root, entry['path'])) as json_file:
+                return json.load(json_file)
+
+        if kind == 'frames':
+            reader = lambda path: _read_frame(path, entry['format'], columns=columns)
+        else:
+            reader = lambda path: np.load(path, mmap_mode='r' if mmap else None)
+        files = {entry_name: os.path.join(self.root, path) for entry_name, path in entry['entries'].items()}
+        if lazy:
+            return LazyArtifacts(files, reader)
+
+        return {entry_name: reader(path) for entry_name, path in files.items()}
+
+    def delete(self, name):
+        """Removes an artifact and its files
+
+        Parameters
+        ----------
+        name : str
+            Name of the artifact
+        """
+        self._remove_files(name)
+        del self.manifest[name]
+        self._write_manifest()
@@ -2,18 +2,42 @@
 .. moduleauthor:: Sylvan Hoover <hooversy@oregonstate.edu>
 """
 
+# standard libraries
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
 # third-party libraries
 
 import numpy as np
 import pandas as pd
-import pickle
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import scipy.sparse as sparse
 import sqlite3
 import pyspark
 import findspark
 # import dask.dataframe as dd
 
+# local imports
+try:
+    from . import artifacts
+    from . import kernels
+except ImportError:
+    import artifacts
+    import kernels
+
 def csv_to_df(data, element_id=None, timestamp=None, session_start=None, session_end=None,
-              boardings=None, alightings=None, occupancy=None, lat=None, lon=None):
+              boardings=None, alightings=None, occupancy=None, lat=None, lon=None, compact=False,
+              chunksize=None, session_limit=600):
     """Imports counter data as csv and creates pandas dataframe
 
     Parameters
@@ -44,6 +68,16 @@ def csv_to_df(data, element_id=None, timestamp=None, session_start=None, session
 
     lon : str
         Header of longitude column.
+
+    compact : bool
+        Whether to read only the needed columns into compact types with `csv_to_compact_df`
+
+    chunksize : int
+        If set, the csv is read this many records at a time with `csv_to_df_chunks` and an iterator of DataFrames
+        is returned instead
+
+    session_limit : int
+        For chunked reading, the maximum length of a session in seconds kept by `session_length_filter`
     
     Returns
     -------
@@ -51,6 +85,17 @@ def csv_to_df(data, element_id=None, timestamp=None, session_start=None, session
         DataFrame of counter data with headers set for further processing
     """
 
+    if chunksize is not None:
+        return csv_to_df_chunks(data, chunksize, element_id=element_id, timestamp=timestamp,
+                                session_start=session_start, session_end=session_end, boardings=boardings,
+                                alightings=alightings, occupancy=occupancy, lat=lat, lon=lon, compact=compact,
+                                session_limit=session_limit)
+
+    if compact == True:
+        return csv_to_compact_df(data, element_id=element_id, timestamp=timestamp, session_start=session_start,
+                                 session_end=session_end, boardings=boardings, alightings=alightings,
+                                 occupancy=occupancy, lat=lat, lon=lon)
+
     if timestamp == None:
         df_imported_headers = pd.read_csv(data, parse_dates=[session_start, session_end], infer_datetime_format=True)
         if boardings != None:
@@ -88,9 +133,352 @@ def csv_to_df(data, element_id=None, timestamp=None, session_start=None, session
     
     return df_fixed_headers
 
+def _csv_headers(element_id=None, timestamp=None, session_start=None, session_end=None,
+                 boardings=None, alightings=None, occupancy=None, lat=None, lon=None):
+    """Pairs of csv header and standard header of the columns used, in the column order of `csv_to_df`"""
+    headers = [(element_id, 'element_id')]
+    if timestamp == None:
+        headers += [(session_start, 'session_start'), (session_end, 'session_end')]
+    else:
+        headers += [(timestamp, 'timestamp')]
+    if boardings != None:
+        headers += [(boardings, 'boardings'), (alightings, 'alightings')]
+    elif occupancy != None:
+        headers += [(occupancy, 'occupancy')]
+    headers += [(lat, 'lat'), (lon, 'lon')]
+
+    return headers
+
+def csv_to_compact_df(data, element_id=None, timestamp=None, session_start=None, session_end=None,
+                      boardings=None, alightings=None, occupancy=None, lat=None, lon=None):
+    """Imports counter data as csv into a compact pandas dataframe. Only the columns named are parsed, ids are read
+    as categoricals, latitude and longitude as float32 and times straight to int64 unix time, which is what
+    `standardize_epoch` would otherwise convert them to. The multithreaded pyarrow csv reader is used when pandas
+    supports it
+
+    Parameters
+    ----------
+    data : str
+        File path of counter date
+
+    id : str
+        Header of id column
+
+    timestamp : str
+        Header of timestamp column. Optional if session times are used.
+
+    session_start : str
+        Header of session start time column. Optional if timestamp is used.
+
+    session_end : str
+        Header of session end time column. Optional if timestamp is used.
+
+    boardings : int
+        For grouped data, count of number boarding vehicle
+
+    alightings : int
+        For grouped data, count of number alighting vehicle
+
+    lat : str
+        Header of latitude column.
+
+    lon : str
+        Header of longitude column.
+
+    Returns
+    -------
+    df_fixed_headers : pandas DataFrame
+        DataFrame of counter data with headers set for further processing
+    """
+    headers = _csv_headers(element_id=element_id, timestamp=timestamp, session_start=session_start,
+                           session_end=session_end, boardings=boardings, alightings=alightings,
+                           occupancy=occupancy, lat=lat, lon=lon)
+    usecols = [header for header, _ in headers]
+    dtype = {element_id: 'category', lat: 'float32', lon: 'float32'}
+
+    try:
+        df_imported_headers = pd.read_csv(data, usecols=usecols, dtype=dtype, engine='pyarrow')
+    except (ImportError, ValueError, TypeError):
+        # pandas before 1.4 has no pyarrow reader
+        df_imported_headers = pd.read_csv(data, usecols=usecols, dtype=dtype)
+
+    df_fixed_headers = standardize_epoch(df_imported_headers[usecols].rename(columns=dict(headers)))
+
+    return df_fixed_headers
+
+def csv_to_df_chunks(data, chunksize, element_id=None, timestamp=None, session_start=None, session_end=None,
+                     boardings=None, alightings=None, occupancy=None, lat=None, lon=None, compact=False,
+                     session_limit=600):
+    """Imports counter data as csv `chunksize` records at a time. Each chunk has its headers set as in `csv_to_df`,
+    its times converted to unix time and its long sessions filtered, so a file larger than memory can be fed
+    through `pairwise_filter_stream`
+
+    Parameters
+    ----------
+    data : str
+        File path of counter date
+
+    chunksize : int
+        Number of csv records per chunk
+
+    id : str
+        Header of id column
+
+    timestamp : str
+        Header of timestamp column. Optional if session times are used.
+
+    session_start : str
+        Header of session start time column. Optional if timestamp is used.
+
+    session_end : str
+        Header of session end time column. Optional if timestamp is used.
+
+    boardings : int
+        For grouped data, count of number boarding vehicle
+
+    alightings : int
+        For grouped data, count of number alighting vehicle
+
+    lat : str
+        Header of latitude column.
+
+    lon : str
+        Header of longitude column.
+
+    compact : bool
+        Whether to read the chunks into the compact types of `csv_to_compact_df`
+
+    session_limit : int
+        The max length of a session in seconds to be kept by `session_length_filter`
+
+    Yields
+    ------
+    df_chunk : pandas DataFrame
+        DataFrame of a chunk of counter data with headers set, unix times and long sessions removed
+    """
+    headers = _csv_headers(element_id=element_id, timestamp=timestamp, session_start=session_start,
+                           session_end=session_end, boardings=boardings, alightings=alightings,
+                           occupancy=occupancy, lat=lat, lon=lon)
+    usecols = [header for header, _ in headers]
+    times = [header for header, column in headers if column in ['timestamp', 'session_start', 'session_end']]
+
+    if compact == True:
+        # the pyarrow reader has no chunked mode
+        reader = pd.read_csv(data, usecols=usecols, chunksize=chunksize,
+                             dtype={element_id: 'category', lat: 'float32', lon: 'float32'})
+    else:
+        reader = pd.read_csv(data, usecols=usecols, chunksize=chunksize, parse_dates=times,
+                             infer_datetime_format=True)
+
+    for df_imported_headers in reader:
+        # chunks carry on the index of the file, which the time conversion and filters expect to start at zero
+        df_chunk = df_imported_headers[usecols].rename(columns=dict(headers)).reset_index(drop=True)
+        df_chunk = standardize_epoch(df_chunk)
+
+        yield session_length_filter(df_chunk, session_max=session_limit)
+
+# size in bytes the ingestion cache is trimmed to after every write
+INGEST_CACHE_SIZE = 2 * 1024**3
+
+# seconds after which a partial entry of the ingestion cache is taken as left by an interrupted run
+INGEST_PARTIAL_AGE = 3600
+
+def _file_digest(path, block_size=2**20):
+    """SHA-256 of a file's content, read a block at a time"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def _ingest_cache_key(data, **arguments):
+    """Key of a normalized csv in the ingestion cache from the file's content, modification time and the arguments
+    it was read with"""
+    key = json.dumps({'digest': _file_digest(data), 'mtime': os.stat(data).st_mtime_ns, 'arguments': arguments},
+                     sort_keys=True)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def _evict_ingest_cache(cache_dir, cache_size):
+    """Removes the least recently used entries of the ingestion cache until it is no larger than `cache_size` bytes,
+    and the partial entries of interrupted runs"""
+    for partial in [os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir) if entry.endswith('.partial')]:
+        try:
+            if time.time() - os.stat(partial).st_mtime > INGEST_PARTIAL_AGE:
+                os.remove(partial)
+        except FileNotFoundError:
+            # renamed into place or removed by a concurrent run
+            continue
+    entries = [os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir) if entry.endswith('.feather')]
+    entries = sorted(entries, key=lambda entry: os.stat(entry).st_mtime_ns)
+    cache_total = sum(os.path.getsize(entry) for entry in entries)
+    for entry in entries:
+        if cache_total <= cache_size:
+            break
+        cache_total -= os.path.getsize(entry)
+        os.remove(entry)
+
+def cached_csv_to_df(data, cache_dir, element_id=None, timestamp=None, session_start=None, session_end=None,
+                     boardings=None, alightings=None, occupancy=None, lat=None, lon=None, compact=False,
+                     session_limit=600, cache_size=INGEST_CACHE_SIZE):
+    """Imports counter data as csv with `csv_to_df`, converts it to unix time and filters long sessions, keeping the
+    result in an on-disk cache. The cache holds uncompressed Feather files keyed by the csv's content hash, its
+    modification time and the header and filter arguments, so rerunning with the same inputs skips parsing the csv.
+    Entries are memory mapped when read back, and numeric columns without missing values are converted without a
+    copy, so they are read-only views of the mapped file. The least recently used entries are removed once the
+    cache exceeds `cache_size` bytes
+
+    Parameters
+    ----------
+    data : str
+        File path of counter date
+
+    cache_dir : str
+        Directory of the ingestion cache, created if it does not exist
+
+    id : str
+        Header of id column
+
+    timestamp : str
+        Header of timestamp column. Optional if session times are used.
+
+    session_start : str
+        Header of session start time column. Optional if timestamp is used.
+
+    session_end : str
+        Header of session end time column. Optional if timestamp is used.
+
+    boardings : int
+        For grouped data, count of number boarding vehicle
+
+    alightings : int
+        For grouped data, count of number alighting vehicle
+
+    lat : str
+        Header of latitude column.
+
+    lon : str
+        Header of longitude column.
+
+    compact : bool
+        Whether to read only the needed columns into compact types with `csv_to_compact_df`
+
+    session_limit : int
+        The max length of a session in seconds to be kept by `session_length_filter`
+
+    cache_size : int
+        Size in bytes the cache is trimmed to after a new entry is written
+
+    Returns
+    -------
+    df_normalized : pandas DataFrame
+        DataFrame of counter data with headers set, unix times and long sessions removed
+    """
+    headers = {'element_id': element_id, 'timestamp': timestamp, 'session_start': session_start,
+               'session_end': session_end, 'boardings': boardings, 'alightings': alightings,
+               'occupancy': occupancy, 'lat': lat, 'lon': lon}
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, _ingest_cache_key(data, compact=compact, session_limit=session_limit,
+                                                      **headers) + '.feather')
+
+    if os.path.exists(entry):
+        # marks the entry as recently used for eviction
+        os.utime(entry)
+        # a block per column lets the numeric columns point at the mapped file rather than be copied into a block
+        return feather.read_table(entry, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+
+    df_imported = csv_to_df(data, compact=compact, **headers)
+    df_normalized = session_length_filter(standardize_epoch(df_imported), session_max=session_limit)
+    df_normalized = df_normalized.reset_index(drop=True)
+
+    # written under a unique temporary name, so an interrupted or concurrent write never leaves a partial entry
+    descriptor, partial = tempfile.mkstemp(dir=cache_dir, suffix='.partial')
+    os.close(descriptor)
+    try:
+        feather.write_feather(df_normalized, partial, compression='uncompressed')
+        os.replace(partial, entry)
+    except BaseException:
+        os.remove(partial)
+        raise
+    _evict_ingest_cache(cache_dir, cache_size)
+
+    return df_normalized
+
+# columns holding times, with and without the suffixes of a joined dataset
+TIME_COLUMNS = ['timestamp', 'timestamp1', 'timestamp2', 'time',
+                'session_start', 'session_end', 'session_start1', 'session_end1', 'session_start2', 'session_end2']
+
+# nanoseconds per unit of epoch time
+EPOCH_UNITS = {'s': 10**9, 'ms': 10**6, 'us': 10**3, 'ns': 1}
+
+def _epoch_unit(values):
+    """Unit of a numeric array of epoch times, judged once from the magnitude of its largest time. Times in seconds
+    stay below 1e11 until the year 5138, so larger magnitudes mean finer units"""
+    largest = np.abs(values).max() if len(values) > 0 else 0
+    if largest >= 1e17:
+        return 'ns'
+    elif largest >= 1e14:
+        return 'us'
+    elif largest >= 1e11:
+        return 'ms'
+    else:
+        return 's'
+
+def _numeric_times(series):
+    """Numpy array of a time column's values if they are numbers or strings of numbers, otherwise None"""
+    if pd.api.types.is_bool_dtype(series):
+        return None
+    if pd.api.types.is_numeric_dtype(series):
+        return series.values
+    if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+        try:
+            return pd.to_numeric(series).values
+        except (ValueError, TypeError):
+            return None
+
+    return None
+
+def _epoch_nanoseconds(series):
+    """int64 nanoseconds since the epoch of a column of datetimes, epoch times or strings of either, or None if the
+    column is none of these"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # timezone aware columns give their UTC times here
+        return series.values.astype('datetime64[ns]').view('int64')
+
+    values = _numeric_times(series)
+    if values is None:
+        try:
+            datetimes = pd.to_datetime(series, utc=True)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        return datetimes.values.astype('datetime64[ns]').view('int64')
+
+    if values.dtype.kind == 'f' and not np.isfinite(values).all():
+        return None
+    nanoseconds = EPOCH_UNITS[_epoch_unit(values)]
+    if values.dtype.kind == 'f':
+        return (values * nanoseconds).astype(np.int64)
+
+    return values.astype(np.int64, copy=False) * nanoseconds
+
+def _report_unconverted(unconverted, time_format):
+    """Warns of the time columns that could not be converted"""
+    if unconverted:
+        warnings.warn('Could not convert ' + ', '.join(unconverted) + ' to ' + time_format)
+
+def _owned_frame(dataframe):
+    """The DataFrame itself, or a copy of it if it is a slice of another DataFrame, so time columns can be assigned
+    without a copy warning"""
+    if getattr(dataframe, '_is_copy', None) is not None:
+        return dataframe.copy()
+
+    return dataframe
+
 def standardize_datetime(dataframe):
     """Converts epoch times to datetime format. The import of the csv infers datetime format except in the
-    case of epoch times. If epoch times are present, this converts them to datetime.
+    case of epoch times. If epoch times are present, this converts them to datetime. The unit of epoch times
+    is detected once per column, and columns that cannot be converted are left as they are with a warning.
 
     Parameters
     ----------
@@ -102,19 +490,24 @@ def standardize_datetime(dataframe):
     dataframe : pandas DataFrame
         DataFrame with all times now datetime format
     """
-    time_list = ['timestamp', 'timestamp1', 'timestamp2', 'time', 
-                 'session_start', 'session_end', 'session_start1', 'session_end1', 'session_start2', 'session_end2']
-    for time in time_list:
-        try:
-            if dataframe.loc[:,(time)].dtype != 'datetime64[ns]':
-                dataframe.loc[:,(time)] = pd.to_datetime(dataframe.loc[:,(time)],unit='s')
-        except:
-            pass
+    unconverted = []
+    for time in [column for column in TIME_COLUMNS if column in dataframe.columns]:
+        if dataframe[time].dtype == 'datetime64[ns]':
+            continue
+        nanoseconds = _epoch_nanoseconds(dataframe[time])
+        if nanoseconds is None:
+            unconverted.append(time)
+        else:
+            dataframe = _owned_frame(dataframe)
+            dataframe[time] = nanoseconds.view('datetime64[ns]')
+    _report_unconverted(unconverted, 'datetimes')
 
     return dataframe
 
 def standardize_epoch(dataframe):
-    """Converts datetimes times to unix time format.
+    """Converts datetimes times to unix time format. Epoch times in milliseconds, microseconds or nanoseconds
+    are detected once per column and divided down to seconds, and columns that cannot be converted are left
+    as they are with a warning.
 
     Parameters
     ----------
@@ -126,16 +519,19 @@ def standardize_epoch(dataframe):
     dataframe : pandas DataFrame
         DataFrame with all times now unix time int64 format
     """
-    time_list = ['timestamp', 'timestamp1', 'timestamp2', 'time', 
-                 'session_start', 'session_end', 'session_start1', 'session_end1', 'session_start2', 'session_end2']
-    for time in time_list:
-        try:
-            if dataframe.loc[:,(time)].dtype != 'int64':
-                dataframe.loc[:,(time)] = dataframe.loc[:,(time)].astype(np.int64)
-                if dataframe.loc[:,(time)][0] > 10000000000:
-                    dataframe.loc[:,(time)] = dataframe.loc[:,(time)] // 10**9
-        except:
-            pass
+    unconverted = []
+    for time in [column for column in TIME_COLUMNS if column in dataframe.columns]:
+        values = dataframe[time].values
+        # already unix time, the common case on every call after the first
+        if values.dtype == np.int64 and _epoch_unit(values) == 's':
+            continue
+        nanoseconds = _epoch_nanoseconds(dataframe[time])
+        if nanoseconds is None:
+            unconverted.append(time)
+        else:
+            dataframe = _owned_frame(dataframe)
+            dataframe[time] = nanoseconds // EPOCH_UNITS['s']
+    _report_unconverted(unconverted, 'unix time')
 
     return dataframe
 
@@ -208,61 +604,79 @@ def time_range_join_np(data1, data2, time_range=60):
 
     return df_range_join
 
-def time_range_join_sqlite(data1, data2, time_range=60):
-    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses the SQL API, which is
-    much slower than the numpy based approach, but it more memory efficient so will work on larger datasets where the numpy 
-    approach may quickly exceed available memory and fail
+def _join_time(dataframe, suffix):
+    """Returns the numpy array of times used to range join a suffixed dataset, preferring the single
+    timestamp over the session start
 
     Parameters
     ----------
-    data1 : pandas DataFrame
-        DataFrame of the first dataset
+    dataframe : pandas DataFrame
+        DataFrame of a dataset with suffixed column names
 
-    data2 : pandas DataFrame
-        DataFrame of the second dataset
+    suffix : str
+        Suffix of the dataset, either '1' or '2'
 
-    time_range : int
-        Value for time buffer indicating range in join
-    
     Returns
     -------
-    df_range_join : pandas DataFrame
-        DataFrame with a range join of the two datasets based on time
+    time : numpy array
+        Times of the records in the dataset
     """
     try:
-        data1['time'] = data1['timestamp1']
-    except:
-        data1['time'] = data1['session_start1']
+        time = dataframe['timestamp' + suffix].values
+    except KeyError:
+        time = dataframe['session_start' + suffix].values
 
-    try:
-        data2['time'] = data2['timestamp2']
-    except:
-        data2['time'] = data2['session_start2']
+    return time
 
-    data2['time_high'] = data2['time'] + time_range
-    data2['time_low'] = data2['time'] - time_range
-    data2 = data2.drop(columns=['time'])
+def _sorted_join_pairs(d1_time, d2_time, time_range=60):
+    """Finds all index pairs (i, j) where `d1_time[i]` is within `time_range` of `d2_time[j]` by sorting the
+    second dataset and binary searching the window of every record of the first dataset
+
+    Parameters
+    ----------
+    d1_time : numpy array
+        Times of the first dataset
+
+    d2_time : numpy array
+        Times of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
 
-    conn = sqlite3.connect(':memory:')
+    Returns
+    -------
+    i : numpy array
+        Positional indices into the first dataset, ordered by `i` and then `j`
 
-    data1.to_sql('data1', conn, index=False)
-    data2.to_sql('data2', conn, index=False)
+    j : numpy array
+        Positional indices into the second dataset
+    """
+    d2_order = np.argsort(d2_time, kind='mergesort')
+    d2_sorted = d2_time[d2_order]
 
-    qry = '''
-        select
-            *
-        from
-            data1 join data2 on
-            time between time_low and time_high
-          '''
+    window_low = np.searchsorted(d2_sorted, d1_time - time_range, side='left')
+    window_high = np.searchsorted(d2_sorted, d1_time + time_range, side='right')
+    window_size = np.maximum(window_high - window_low, 0)
+    # counter logs are usually already in time order, in which case the pairs are too
+    unordered = bool(np.any(d2_order[1:] < d2_order[:-1]))
 
-    df_range_join = pd.read_sql_query(qry, conn).drop(columns=['time', 'time_high', 'time_low'])
+    if kernels.ENABLED:
+        return kernels.window_pairs(window_low, window_size, d2_order, unordered)
 
-    return df_range_join
+    i = np.repeat(np.arange(len(d1_time)), window_size)
+    # position of each pair within its window of the sorted second dataset
+    window_start = np.cumsum(window_size) - window_size
+    offset = np.arange(len(i)) - np.repeat(window_start, window_size)
+    j = d2_order[np.repeat(window_low, window_size) + offset]
 
-def time_range_join_spark_arrow(data1, data2, time_range=60):
-    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses Spark
-    and Arrow to use memory for all storage purposes.
+    if unordered:
+        pair_order = np.lexsort((j, i))
+        i, j = i[pair_order], j[pair_order]
+
+    return i, j
+
+def _pairs_to_frame(data1, data2, i, j):
+    """Builds the joined DataFrame from positional index pairs of the two datasets
 
     Parameters
     ----------
@@ -272,51 +686,57 @@ def time_range_join_spark_arrow(data1, data2, time_range=60):
     data2 : pandas DataFrame
         DataFrame of the second dataset
 
-    time_range : int
-        Value for time buffer indicating range in join
-    
+    i : numpy array
+        Positional indices into the first dataset
+
+    j : numpy array
+        Positional indices into the second dataset
+
     Returns
     -------
     df_range_join : pandas DataFrame
-        DataFrame with a range join of the two datasets based on time
+        DataFrame with the paired records of the two datasets side by side
     """
-    # spark configuration
-    #findspark.init('/Users/pntz/anaconda3/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
-    findspark.init('/root/miniconda/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
-    conf = pyspark.SparkConf()
-    conf.set("spark.sql.execution.arrow.enabled","true")
-    conf.set("spark.network.timeout", "1000000000")
-    conf.set("spark.driver.memory", "1g")
-    sc = pyspark.SparkContext(appName="rangeJoin", conf=conf)
-    sql = pyspark.SQLContext(sc)
+    df_range_join = pd.concat([data1.iloc[i].reset_index(drop=True),
+                               data2.iloc[j].reset_index(drop=True)], axis=1)
 
-    try:
-        data1['time'] = data1['timestamp1']
-    except:
-        data1['time'] = data1['session_start1']
+    return df_range_join
 
-    try:
-        data2['time'] = data2['timestamp2']
-    except:
-        data2['time'] = data2['session_start2']
+def time_range_join_sorted(data1, data2, time_range=60):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer. The second dataset is sorted by time
+    and the matching window of every record in the first dataset is found with a binary search, so only the matching
+    pairs are ever held in memory. This runs in O((N+M) log M + K) for K matching pairs when the second dataset is
+    already in time order and gives the same result as `time_range_join_np` without its N x M comparison matrix
 
-    data2['time_high'] = data2['time'] + time_range
-    data2['time_low'] = data2['time'] - time_range
-    data2 = data2.drop(columns=['time'])
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
 
-    sparkdf1 = sql.createDataFrame(data1).repartition(1000)
-    sparkdf2 = sql.createDataFrame(data2).repartition(1000)
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
 
-    sparkdf_range_join = sparkdf1.join(sparkdf2, sparkdf1.time.between(sparkdf2.time_low, sparkdf2.time_high)).drop('time', 'time_high', 'time_low')
-    df_range_join = sparkdf_range_join.toPandas()
+    time_range : int
+        Value for time buffer indicating range in join
+
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    d1_time = _join_time(data1, '1')
+    d2_time = _join_time(data2, '2')
 
-    pickle.dump(df_range_join, open('./osm_multiplex/data/range_joined.pickle', 'wb'))
+    i, j = _sorted_join_pairs(d1_time, d2_time, time_range)
+    df_range_join = _pairs_to_frame(data1, data2, i, j)
 
     return df_range_join
 
-def time_range_join_spark_disk(data1, data2, time_range=2):
-    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses Spark
-    and write to disk as an intermediary.
+def time_range_join_chunked(data1, data2, time_range=60, chunk_size=3600):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer, yielding the result in chunks.
+    Both datasets are walked in time order in blocks of `chunk_size` seconds of the first dataset, each joined against
+    the records of the second dataset within the block plus/minus `time_range`. Every pair is yielded exactly once
+    and only a single block of the join is held in memory at a time
 
     Parameters
     ----------
@@ -328,30 +748,528 @@ def time_range_join_spark_disk(data1, data2, time_range=2):
 
     time_range : int
         Value for time buffer indicating range in join
-    
-    Returns
-    -------
+
+    chunk_size : int
+        Length in seconds of the time block of the first dataset joined per chunk
+
+    Yields
+    ------
     df_range_join : pandas DataFrame
-        DataFrame with a range join of the two datasets based on time
+        DataFrame with a range join of one time block of the two datasets
     """
-    # spark configuration
-    findspark.init('/Users/pntz/anaconda3/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
-    # findspark.init('/root/miniconda/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
-    conf = pyspark.SparkConf()
-    conf.set("spark.sql.execution.arrow.enabled","true")
-    conf.set("spark.network.timeout", "1000000000")
-    conf.set("spark.driver.cores", "4")
-    conf.set("spark.driver.memory", "7g")
-    conf.set("spark.driver.maxResultSize", "0")
-    # conf.set("spark.executor.cores", "2")
-    # conf.set("spark.executor.memory", "4g")
-    sc = pyspark.SparkContext(appName="rangeJoin", conf=conf)
-    sql = pyspark.SQLContext(sc)
+    d1_time = _join_time(data1, '1')
+    d2_time = _join_time(data2, '2')
 
-    try:
-        data1['time'] = data1['timestamp1']
-    except:
-        data1['time'] = data1['session_start1']
+    d1_order = np.argsort(d1_time, kind='mergesort')
+    d2_order = np.argsort(d2_time, kind='mergesort')
+    d1_sorted = d1_time[d1_order]
+    d2_sorted = d2_time[d2_order]
+
+    d1_low = 0
+    while d1_low < len(d1_sorted):
+        block_start = d1_sorted[d1_low]
+        block_end = block_start + chunk_size
+        d1_high = np.searchsorted(d1_sorted, block_end, side='left')
+        # the second dataset block overlaps its neighbours by `time_range`
+        d2_low = np.searchsorted(d2_sorted, block_start - time_range, side='left')
+        d2_high = np.searchsorted(d2_sorted, block_end + time_range, side='right')
+
+        i_block, j_block = _sorted_join_pairs(d1_sorted[d1_low:d1_high], d2_sorted[d2_low:d2_high], time_range)
+        i = d1_order[d1_low + i_block]
+        j = d2_order[d2_low + j_block]
+        pair_order = np.lexsort((j, i))
+
+        yield _pairs_to_frame(data1, data2, i[pair_order], j[pair_order])
+
+        d1_low = d1_high
+
+def _grid_cells(lat, lon, time, lat_size, lon_size, time_size, origin):
+    """Integer space-time grid cell of each record
+
+    Parameters
+    ----------
+    lat, lon, time : numpy array
+        Latitudes, longitudes and times of the records
+
+    lat_size, lon_size, time_size : float
+        Size of a grid cell in degrees of latitude, degrees of longitude and seconds
+
+    origin : tuple
+        Minimum latitude, longitude and time of the grid
+
+    Returns
+    -------
+    cells : tuple
+        Latitude, longitude and time cell numbers, starting at 1 so every cell has a neighbour on each side
+    """
+    lat_cell = np.floor((lat - origin[0]) / lat_size).astype(np.int64) + 1
+    lon_cell = np.floor((lon - origin[1]) / lon_size).astype(np.int64) + 1
+    time_cell = np.floor((time - origin[2]) / time_size).astype(np.int64) + 1
+
+    return lat_cell, lon_cell, time_cell
+
+def _spatiotemporal_pairs(d1_time, lat1, lon1, d2_time, lat2, lon2, time_range=60, dist_max=100):
+    """Finds all index pairs (i, j) of records within `time_range` and `dist_max` of each other by bucketing both
+    datasets into a space-time grid and comparing only neighbouring cells
+
+    Parameters
+    ----------
+    d1_time, lat1, lon1 : numpy array
+        Times, latitudes and longitudes of the first dataset
+
+    d2_time, lat2, lon2 : numpy array
+        Times, latitudes and longitudes of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    dist_max : int
+        Maximum distance between records
+
+    Returns
+    -------
+    i : numpy array
+        Positional indices into the first dataset, ordered by `i` and then `j`
+
+    j : numpy array
+        Positional indices into the second dataset
+    """
+    radius = 6378137 # meters
+
+    if len(d1_time) == 0 or len(d2_time) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # a degree of latitude is the shortest a degree can be, and a degree of longitude shrinks with the cosine of
+    # the latitude, so neighbouring cells cover everything within `dist_max`. the 1% widening covers the small
+    # difference between the arc and the chord of the haversine
+    lat_size = 1.01 * max(dist_max, 1) / (radius * np.pi / 180)
+    max_cos = np.cos(np.radians(min(max(np.nanmax(np.abs(lat1)), np.nanmax(np.abs(lat2))), 89.0)))
+    lon_size = lat_size / max_cos
+    time_size = max(time_range, 1)
+
+    origin = (min(np.nanmin(lat1), np.nanmin(lat2)), min(np.nanmin(lon1), np.nanmin(lon2)),
+              min(d1_time.min(), d2_time.min()))
+    extent = (max(np.nanmax(lat1), np.nanmax(lat2)) - origin[0], max(np.nanmax(lon1), np.nanmax(lon2)) - origin[1],
+              max(d1_time.max(), d2_time.max()) - origin[2])
+
+    # coarser cells stay correct, so grow them until every cell number fits in a single int64 key
+    while True:
+        lat_count = int(extent[0] // lat_size) + 3
+        lon_count = int(extent[1] // lon_size) + 3
+        time_count = int(extent[2] // time_size) + 3
+        if float(lat_count) * lon_count * time_count < 2**62:
+            break
+        lat_size, lon_size, time_size = 2 * lat_size, 2 * lon_size, 2 * time_size
+
+    lat_cell1, lon_cell1, time_cell1 = _grid_cells(lat1, lon1, d1_time, lat_size, lon_size, time_size, origin)
+    lat_cell2, lon_cell2, time_cell2 = _grid_cells(lat2, lon2, d2_time, lat_size, lon_size, time_size, origin)
+
+    key2 = (time_cell2 * lat_count + lat_cell2) * lon_count + lon_cell2
+    d2_order = np.argsort(key2, kind='mergesort')
+    key2_sorted = key2[d2_order]
+
+    i_candidates = []
+    j_candidates = []
+    for time_offset in (-1, 0, 1):
+        for lat_offset in (-1, 0, 1):
+            # neighbouring longitude cells are adjacent keys, so one search covers all three
+            key1 = ((time_cell1 + time_offset) * lat_count + lat_cell1 + lat_offset) * lon_count + lon_cell1
+            window_low = np.searchsorted(key2_sorted, key1 - 1, side='left')
+            window_high = np.searchsorted(key2_sorted, key1 + 1, side='right')
+            window_size = window_high - window_low
+
+            i = np.repeat(np.arange(len(key1)), window_size)
+            window_start = np.cumsum(window_size) - window_size
+            offset = np.arange(len(i)) - np.repeat(window_start, window_size)
+            j = d2_order[np.repeat(window_low, window_size) + offset]
+
+            close_time = np.abs(d1_time[i] - d2_time[j]) <= time_range
+            i, j = i[close_time], j[close_time]
+            close_distance = haversine_dist_mask(lat1[i], lon1[i], lat2[j], lon2[j], dist_max=dist_max)
+            i_candidates.append(i[close_distance])
+            j_candidates.append(j[close_distance])
+
+    i = np.concatenate(i_candidates)
+    j = np.concatenate(j_candidates)
+    pair_order = np.lexsort((j, i))
+
+    return i[pair_order], j[pair_order]
+
+def spatiotemporal_join(data1, data2, time_range=60, dist_max=100):
+    """Performs a range join on both time plus/minus `time_range` and haversine distance within `dist_max`. Records are
+    bucketed into a grid of cells `dist_max` across and `time_range` long, and only records in neighbouring cells are
+    compared, so pairs too far apart in space are never materialized. This gives the same result as
+    `haversine_dist_filter` applied to `time_range_join_sorted`, which it falls back to if `dist_max` is None
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    dist_max : int
+        Maximum distance between records, or None to join on time alone
+
+    Returns
+    -------
+    df_dist : pandas DataFrame
+        DataFrame of the joined records within both the time range and the distance of each other
+    """
+    if dist_max is None:
+        return time_range_join_sorted(data1, data2, time_range=time_range)
+
+    i, j = _spatiotemporal_pairs(_join_time(data1, '1'), data1['lat1'].values.astype(np.float64),
+                                 data1['lon1'].values.astype(np.float64),
+                                 _join_time(data2, '2'), data2['lat2'].values.astype(np.float64),
+                                 data2['lon2'].values.astype(np.float64),
+                                 time_range=time_range, dist_max=dist_max)
+    df_dist = _pairs_to_frame(data1, data2, i, j)
+
+    return df_dist
+
+def _partition_pairs(d1_position, d1_time, lat1, lon1, d2_position, d2_time, lat2, lon2, time_range, dist_max):
+    """Joins one time partition in a worker process and maps the pairs back to positions in the full datasets"""
+    if dist_max is None:
+        i, j = _sorted_join_pairs(d1_time, d2_time, time_range)
+    else:
+        i, j = _spatiotemporal_pairs(d1_time, lat1, lon1, d2_time, lat2, lon2, time_range=time_range,
+                                     dist_max=dist_max)
+
+    return d1_position[i], d2_position[j]
+
+def time_range_join_parallel(data1, data2, time_range=60, dist_max=100, workers=None):
+    """Performs a range join on both time plus/minus `time_range` and haversine distance within `dist_max` across all
+    cores. The timeline is split into partitions holding an equal share of the first dataset, and each is joined in
+    a separate process against the records of the second dataset within the partition plus/minus `time_range`.
+    Every record of the first dataset belongs to exactly one partition, so pairs near a partition boundary are only
+    found once
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    dist_max : int
+        Maximum distance between records, or None to join on time alone
+
+    workers : int
+        Number of worker processes, defaulting to the number of cores
+
+    Returns
+    -------
+    df_dist : pandas DataFrame
+        DataFrame of the joined records within both the time range and the distance of each other
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    d1_time = _join_time(data1, '1')
+    d2_time = _join_time(data2, '2')
+    if dist_max is None:
+        # the coordinates are unused when joining on time alone
+        lat1 = lon1 = np.zeros(len(data1))
+        lat2 = lon2 = np.zeros(len(data2))
+    else:
+        lat1 = data1['lat1'].values.astype(np.float64)
+        lon1 = data1['lon1'].values.astype(np.float64)
+        lat2 = data2['lat2'].values.astype(np.float64)
+        lon2 = data2['lon2'].values.astype(np.float64)
+
+    d1_order = np.argsort(d1_time, kind='mergesort')
+    d2_order = np.argsort(d2_time, kind='mergesort')
+    d1_sorted = d1_time[d1_order]
+    d2_sorted = d2_time[d2_order]
+
+    # several partitions per worker evens out partitions that happen to be dense with pairs
+    partition_count = max(min(4 * workers, len(d1_sorted)), 1)
+    partition_edges = np.linspace(0, len(d1_sorted), partition_count + 1).astype(np.int64)
+
+    i_partitions = []
+    j_partitions = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for d1_low, d1_high in zip(partition_edges[:-1], partition_edges[1:]):
+            if d1_low == d1_high:
+                continue
+            d1_position = d1_order[d1_low:d1_high]
+            d2_low = np.searchsorted(d2_sorted, d1_sorted[d1_low] - time_range, side='left')
+            d2_high = np.searchsorted(d2_sorted, d1_sorted[d1_high - 1] + time_range, side='right')
+            d2_position = d2_order[d2_low:d2_high]
+            futures.append(executor.submit(_partition_pairs,
+                                           d1_position, d1_time[d1_position], lat1[d1_position], lon1[d1_position],
+                                           d2_position, d2_time[d2_position], lat2[d2_position], lon2[d2_position],
+                                           time_range, dist_max))
+        for future in futures:
+            i, j = future.result()
+            i_partitions.append(i)
+            j_partitions.append(j)
+
+    i = np.concatenate(i_partitions) if i_partitions else np.array([], dtype=np.int64)
+    j = np.concatenate(j_partitions) if j_partitions else np.array([], dtype=np.int64)
+    pair_order = np.lexsort((j, i))
+
+    df_dist = _pairs_to_frame(data1, data2, i[pair_order], j[pair_order])
+
+    return df_dist
+
+def _pair_bytes(data1, data2):
+    """Average size in bytes of a joined record of the two datasets"""
+    pair_bytes = (data1.memory_usage(deep=True).sum() / max(len(data1), 1) +
+                  data2.memory_usage(deep=True).sum() / max(len(data2), 1))
+
+    return pair_bytes
+
+def _chunk_size_for_memory(data1, data2, time_range, max_memory):
+    """Estimates the time block length for `time_range_join_chunked` so a single chunk of joined records stays
+    within `max_memory`, assuming the matching pairs are spread evenly over the timeline of the first dataset
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    max_memory : int
+        Target maximum size in bytes of a single chunk
+
+    Returns
+    -------
+    chunk_size : int
+        Length in seconds of the time block of the first dataset joined per chunk
+    """
+    d1_time = _join_time(data1, '1')
+    d2_sorted = np.sort(_join_time(data2, '2'))
+
+    window_low = np.searchsorted(d2_sorted, d1_time - time_range, side='left')
+    window_high = np.searchsorted(d2_sorted, d1_time + time_range, side='right')
+    pair_count = int(np.maximum(window_high - window_low, 0).sum())
+
+    timeline = int(d1_time.max() - d1_time.min()) + 1 if len(d1_time) > 0 else 1
+    if pair_count == 0:
+        return timeline
+
+    chunk_size = int(max_memory * timeline / (pair_count * _pair_bytes(data1, data2)))
+
+    return max(chunk_size, 1)
+
+def time_range_join_sqlite_chunked(data1, data2, time_range=60, database=':memory:', chunksize=100000):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer with SQLite, yielding the result
+    in chunks. The second dataset's times are indexed, so each record of the first dataset finds its matches with an
+    index range scan instead of a scan of the whole table, and the result is fetched `chunksize` records at a time.
+    With `database` set to a file path, the tables live on disk rather than in memory
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    database : str
+        SQLite database the datasets are loaded into, either ':memory:' or a file path. Tables named `data1` and
+        `data2` are replaced and dropped again afterwards
+
+    chunksize : int
+        Number of joined records fetched per chunk
+
+    Yields
+    ------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of a chunk of the two datasets
+    """
+    columns = list(data1.columns) + list(data2.columns)
+    select_columns = (['data1."' + column + '"' for column in data1.columns] +
+                      ['data2."' + column + '"' for column in data2.columns])
+
+    conn = sqlite3.connect(database)
+    try:
+        # the join times are added to copies so the caller's DataFrames are left as they are
+        data1.assign(_time1=_join_time(data1, '1')).to_sql('data1', conn, index=False, if_exists='replace',
+                                                           chunksize=chunksize)
+        data2.assign(_time2=_join_time(data2, '2')).to_sql('data2', conn, index=False, if_exists='replace',
+                                                           chunksize=chunksize)
+        conn.execute('create index data2_time on data2 (_time2)')
+
+        qry = '''
+            select
+                {columns}
+            from
+                data1 join data2 on
+                data2._time2 between data1._time1 - ? and data1._time1 + ?
+            order by
+                data1.rowid, data2.rowid
+              '''.format(columns=', '.join(select_columns))
+
+        cursor = conn.execute(qry, (time_range, time_range))
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+        conn.execute('drop table data1')
+        conn.execute('drop table data2')
+        conn.commit()
+    finally:
+        conn.close()
+
+def time_range_join_sqlite(data1, data2, time_range=60, database=':memory:', chunksize=100000):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses the SQL API, which is
+    slower than the numpy based approaches, but with `time_range_join_sqlite_chunked` indexing the times and fetching in
+    chunks it is more memory efficient, and with an on-disk `database` will work on larger datasets where the numpy
+    approach may quickly exceed available memory and fail
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    database : str
+        SQLite database the datasets are loaded into, either ':memory:' or a file path
+
+    chunksize : int
+        Number of joined records fetched per chunk
+    
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    chunks = list(time_range_join_sqlite_chunked(data1, data2, time_range=time_range, database=database,
+                                                 chunksize=chunksize))
+    if chunks:
+        df_range_join = pd.concat(chunks).reset_index(drop=True)
+    else:
+        df_range_join = _pairs_to_frame(data1, data2, np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+    return df_range_join
+
+def time_range_join_spark_arrow(data1, data2, time_range=60, store=None):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses Spark
+    and Arrow to use memory for all storage purposes.
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    store : ArtifactStore
+        Store the joined records are saved to as 'range_joined', defaults to the store in `artifacts.DATA_DIR`
+    
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    # spark configuration
+    #findspark.init('/Users/pntz/anaconda3/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
+    findspark.init('/root/miniconda/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
+    conf = pyspark.SparkConf()
+    conf.set("spark.sql.execution.arrow.enabled","true")
+    conf.set("spark.network.timeout", "1000000000")
+    conf.set("spark.driver.memory", "1g")
+    sc = pyspark.SparkContext(appName="rangeJoin", conf=conf)
+    sql = pyspark.SQLContext(sc)
+
+    try:
+        data1['time'] = data1['timestamp1']
+    except:
+        data1['time'] = data1['session_start1']
+
+    try:
+        data2['time'] = data2['timestamp2']
+    except:
+        data2['time'] = data2['session_start2']
+
+    data2['time_high'] = data2['time'] + time_range
+    data2['time_low'] = data2['time'] - time_range
+    data2 = data2.drop(columns=['time'])
+
+    sparkdf1 = sql.createDataFrame(data1).repartition(1000)
+    sparkdf2 = sql.createDataFrame(data2).repartition(1000)
+
+    sparkdf_range_join = sparkdf1.join(sparkdf2, sparkdf1.time.between(sparkdf2.time_low, sparkdf2.time_high)).drop('time', 'time_high', 'time_low')
+    df_range_join = sparkdf_range_join.toPandas()
+
+    if store is None:
+        store = artifacts.ArtifactStore()
+    store.put('range_joined', df_range_join)
+
+    return df_range_join
+
+def time_range_join_spark_disk(data1, data2, time_range=60, store=None):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer. This function uses Spark
+    and write to disk as an intermediary.
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    store : ArtifactStore
+        Store the joined records are saved to as 'range_joined', defaults to the store in `artifacts.DATA_DIR`
+    
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    # spark configuration
+    findspark.init('/Users/pntz/anaconda3/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
+    # findspark.init('/root/miniconda/pkgs/pyspark-2.4.3-py_0/site-packages/pyspark')
+    conf = pyspark.SparkConf()
+    conf.set("spark.sql.execution.arrow.enabled","true")
+    conf.set("spark.network.timeout", "1000000000")
+    conf.set("spark.driver.cores", "4")
+    conf.set("spark.driver.memory", "7g")
+    conf.set("spark.driver.maxResultSize", "0")
+    # conf.set("spark.executor.cores", "2")
+    # conf.set("spark.executor.memory", "4g")
+    sc = pyspark.SparkContext(appName="rangeJoin", conf=conf)
+    sql = pyspark.SQLContext(sc)
+
+    try:
+        data1['time'] = data1['timestamp1']
+    except:
+        data1['time'] = data1['session_start1']
 
     try:
         data2['time'] = data2['timestamp2']
@@ -376,7 +1294,9 @@ def time_range_join_spark_disk(data1, data2, time_range=2):
     df_range_join = df_range_join[df_range_join.timestamp1 > 0]
     df_range_join = df_range_join[df_range_join.timestamp2 > 0]
 
-    pickle.dump(df_range_join, open('./osm_multiplex/data/range_joined.pickle', 'wb'))
+    if store is None:
+        store = artifacts.ArtifactStore()
+    store.put('range_joined', df_range_join)
 
     return df_range_join
 
@@ -424,6 +1344,176 @@ def time_range_join_cartesian(data1, data2, time_range=60):
 
     return df_range_join
 
+def _write_time_sorted_parquet(dataframe, suffix, path, row_group_size):
+    """Writes a dataset sorted by time to Parquet, keeping each record's original position, and returns the name of
+    its time column"""
+    time_column = 'timestamp' + suffix if 'timestamp' + suffix in dataframe.columns else 'session_start' + suffix
+    time_sorted = dataframe.assign(**{'_position' + suffix: np.arange(len(dataframe))})
+    time_sorted = time_sorted.sort_values(time_column, kind='mergesort')
+    pq.write_table(pa.Table.from_pandas(time_sorted, preserve_index=False), path, row_group_size=row_group_size)
+
+    return time_column
+
+def _row_group_time_ranges(parquet_file, time_column):
+    """Minimum and maximum time of every non-empty row group of a Parquet file from its row group statistics"""
+    column_index = parquet_file.schema_arrow.get_field_index(time_column)
+    time_ranges = {}
+    for row_group in range(parquet_file.num_row_groups):
+        statistics = parquet_file.metadata.row_group(row_group).column(column_index).statistics
+        if statistics is not None and statistics.has_min_max:
+            time_ranges[row_group] = (statistics.min, statistics.max)
+
+    return time_ranges
+
+def write_time_range_join_parquet(data1, data2, output_dir, time_range=60, scratch_dir=None, row_group_size=100000,
+                                  keep_positions=False, dist_max=None):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer out of core, writing the result
+    as a Parquet dataset. Both datasets are written to scratch Parquet files sorted by time, and only row groups
+    whose time ranges overlap within `time_range` are read and joined, so at most one row group of the first dataset
+    and its overlapping row groups of the second dataset are in memory at a time. If `dist_max` is set, the pairs of
+    each row group are filtered on distance before they are written
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    output_dir : str
+        Directory the joined dataset is written to, as one Parquet file per row group of the first dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    scratch_dir : str
+        Directory for the time sorted copies of the datasets, which are deleted afterwards. Defaults to the system
+        temporary directory
+
+    row_group_size : int
+        Number of records per row group of the time sorted copies
+
+    keep_positions : bool
+        Whether to keep the `_position1` and `_position2` columns with each pair's original record positions
+
+    dist_max : int
+        Maximum distance between records, or None to join on time alone
+
+    Returns
+    -------
+    output_dir : str
+        Directory of the joined dataset
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='range_join_', dir=scratch_dir)
+
+    try:
+        time_column1 = _write_time_sorted_parquet(data1, '1', os.path.join(scratch, 'data1.parquet'), row_group_size)
+        time_column2 = _write_time_sorted_parquet(data2, '2', os.path.join(scratch, 'data2.parquet'), row_group_size)
+        parquet1 = pq.ParquetFile(os.path.join(scratch, 'data1.parquet'))
+        parquet2 = pq.ParquetFile(os.path.join(scratch, 'data2.parquet'))
+        time_ranges1 = _row_group_time_ranges(parquet1, time_column1)
+        time_ranges2 = _row_group_time_ranges(parquet2, time_column2)
+
+        schema = None
+        files_written = 0
+        row_groups2 = {}
+        for row_group1, (time_low1, time_high1) in time_ranges1.items():
+            overlapping = [row_group2 for row_group2, (time_low2, time_high2) in time_ranges2.items()
+                           if time_low2 <= time_high1 + time_range and time_high2 >= time_low1 - time_range]
+            if not overlapping:
+                continue
+
+            # both files are in time order, so row groups of the second dataset no longer overlapping are done with
+            row_groups2 = {row_group2: frame for row_group2, frame in row_groups2.items() if row_group2 in overlapping}
+            frame1 = parquet1.read_row_group(row_group1).to_pandas()
+            writer = None
+            for row_group2 in overlapping:
+                if row_group2 not in row_groups2:
+                    row_groups2[row_group2] = parquet2.read_row_group(row_group2).to_pandas()
+                frame2 = row_groups2[row_group2]
+
+                i, j = _sorted_join_pairs(frame1[time_column1].values, frame2[time_column2].values, time_range)
+                if dist_max is not None:
+                    close_distance = haversine_dist_mask(frame1['lat1'].values[i], frame1['lon1'].values[i],
+                                                         frame2['lat2'].values[j], frame2['lon2'].values[j],
+                                                         dist_max=dist_max)
+                    i, j = i[close_distance], j[close_distance]
+                if len(i) == 0:
+                    continue
+                df_range_join = _pairs_to_frame(frame1, frame2, i, j)
+                if not keep_positions:
+                    df_range_join = df_range_join.drop(columns=['_position1', '_position2'])
+                table = pa.Table.from_pandas(df_range_join, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(os.path.join(output_dir, 'part-%05d.parquet' % row_group1), schema)
+                writer.write_table(table.cast(schema))
+            if writer is not None:
+                writer.close()
+                files_written += 1
+
+        if files_written == 0:
+            # an empty file keeps the columns of the join readable
+            frame1 = data1.assign(_position1=np.arange(len(data1))).iloc[:0]
+            frame2 = data2.assign(_position2=np.arange(len(data2))).iloc[:0]
+            df_range_join = _pairs_to_frame(frame1, frame2, np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+            if not keep_positions:
+                df_range_join = df_range_join.drop(columns=['_position1', '_position2'])
+            pq.write_table(pa.Table.from_pandas(df_range_join, preserve_index=False),
+                           os.path.join(output_dir, 'part-00000.parquet'))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return output_dir
+
+def time_range_join_parquet(data1, data2, time_range=60, scratch_dir=None, row_group_size=100000, dist_max=None):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer out of core with
+    `write_time_range_join_parquet`, then reads the joined dataset back. If `dist_max` is set, each part is filtered
+    on distance as it is written, so only the pairs within it are read back. This needs no JVM, unlike the Spark
+    joins, and its scratch files are deleted afterwards
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    scratch_dir : str
+        Directory for the intermediate Parquet files. Defaults to the system temporary directory
+
+    row_group_size : int
+        Number of records per row group of the time sorted copies
+
+    dist_max : int
+        Maximum distance between records, or None to join on time alone
+
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    output_dir = tempfile.mkdtemp(prefix='range_joined_', dir=scratch_dir)
+
+    try:
+        write_time_range_join_parquet(data1, data2, output_dir, time_range=time_range, scratch_dir=scratch_dir,
+                                      row_group_size=row_group_size, keep_positions=True, dist_max=dist_max)
+        df_positions = pd.concat([pd.read_parquet(os.path.join(output_dir, part))
+                                  for part in sorted(os.listdir(output_dir))])
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    df_range_join = df_positions.sort_values(['_position1', '_position2'], kind='mergesort')
+    df_range_join = df_range_join.drop(columns=['_position1', '_position2']).reset_index(drop=True)
+
+    return df_range_join
+
 # def time_range_join_intervalindex(data1, data2, time_range=60):
 #     """Performs a range join based on indicated time plus/minus `time_range` buffer. This is an attempt to use interval
 #     indexing that exists in pandas, but for the moment can only serve as a merge and not a join so multiple records matches
@@ -510,6 +1600,284 @@ def time_range_join_cartesian(data1, data2, time_range=60):
 
 #     return df_range_join
 
+def _time_range_join_chunked_frame(data1, data2, time_range=60, dist_max=None, chunk_size=3600):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer by joining time blocks with
+    `time_range_join_chunked`, so the working memory of the join is bounded by a single block. If `dist_max` is set,
+    each block is filtered on distance before the next is joined
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    dist_max : int
+        Maximum distance between records, or None to join on time alone
+
+    chunk_size : int
+        Length in seconds of the time block of the first dataset joined per chunk
+
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    chunks = time_range_join_chunked(data1, data2, time_range=time_range, chunk_size=chunk_size)
+    if dist_max is not None:
+        chunks = (haversine_dist_filter(chunk, dist_max=dist_max) for chunk in chunks)
+    chunks = list(chunks)
+    if chunks:
+        df_range_join = pd.concat(chunks).reset_index(drop=True)
+    else:
+        df_range_join = _pairs_to_frame(data1, data2, np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+    return df_range_join
+
+# every engine takes (data1, data2, time_range) and returns the joined DataFrame. Engines marked as filtering on
+# distance also take `dist_max` and only return the pairs within it, while the others are followed by
+# `haversine_dist_filter` when a distance is given
+JOIN_ENGINES = {
+    'np': (time_range_join_np, False),
+    'sorted': (time_range_join_sorted, False),
+    'spatiotemporal': (spatiotemporal_join, True),
+    'parallel': (time_range_join_parallel, True),
+    'chunked': (_time_range_join_chunked_frame, True),
+    'parquet': (time_range_join_parquet, True),
+    'sqlite': (time_range_join_sqlite, False),
+    'spark_arrow': (time_range_join_spark_arrow, False),
+    'spark_disk': (time_range_join_spark_disk, False),
+    'cartesian': (time_range_join_cartesian, False),
+}
+
+def _available_memory():
+    """Memory in bytes currently available to the process, or None if the platform does not report it"""
+    try:
+        available_memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        available_memory = None
+
+    return available_memory
+
+def select_join_engine(data1, data2, time_range=60, max_memory=None, sample_size=1000, dist_max=None):
+    """Chooses the join engine for two datasets from an estimate of the size of the join. The number of matches of a
+    random sample of the first dataset is scaled up to the full dataset and compared with the memory budget
+        - 'sorted' : the whole join fits comfortably in memory, or 'spatiotemporal' if joining on distance too
+        - 'chunked' : the datasets fit in memory, but the join does not
+        - 'parquet' : the datasets themselves are too large to hold alongside the join
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    max_memory : int
+        Memory budget in bytes, defaulting to the memory currently available
+
+    sample_size : int
+        Number of records of the first dataset sampled to estimate the join size
+
+    dist_max : int
+        Maximum distance between records if the join is also filtered on distance
+
+    Returns
+    -------
+    engine : str
+        Key of the chosen engine in `JOIN_ENGINES`
+
+    reason : str
+        Description of the estimate the choice was based on
+    """
+    if max_memory is None:
+        max_memory = _available_memory()
+
+    d1_time = _join_time(data1, '1')
+    d2_sorted = np.sort(_join_time(data2, '2'))
+
+    if len(d1_time) > sample_size:
+        d1_sample = d1_time[np.random.RandomState(0).choice(len(d1_time), sample_size, replace=False)]
+    else:
+        d1_sample = d1_time
+    window_low = np.searchsorted(d2_sorted, d1_sample - time_range, side='left')
+    window_high = np.searchsorted(d2_sorted, d1_sample + time_range, side='right')
+    pair_estimate = int(np.maximum(window_high - window_low, 0).mean() * len(d1_time)) if len(d1_sample) > 0 else 0
+
+    join_bytes = pair_estimate * _pair_bytes(data1, data2)
+    input_bytes = data1.memory_usage(deep=True).sum() + data2.memory_usage(deep=True).sum()
+    estimate = ('an estimated ' + str(pair_estimate) + ' pairs taking ' + str(round(join_bytes / 2**20, 1)) + ' MiB')
+
+    # joining on time and distance together avoids building the pairs that are only close in time
+    in_memory = 'sorted' if dist_max is None else 'spatiotemporal'
+    if max_memory is None:
+        return in_memory, estimate + ' with no known memory limit'
+
+    budget = ' of the ' + str(round(max_memory / 2**20, 1)) + ' MiB memory budget'
+    # leaves room for the copies made while building and filtering the joined DataFrame
+    if join_bytes <= max_memory / 4:
+        engine, reason = in_memory, estimate + ' fit within a quarter' + budget
+    elif input_bytes * 2 <= max_memory:
+        engine, reason = 'chunked', estimate + ' exceed a quarter' + budget + ', but the datasets fit'
+    else:
+        engine, reason = 'parquet', ('the datasets taking ' + str(round(input_bytes / 2**20, 1)) + ' MiB exceed half' +
+                                     budget)
+
+    return engine, reason
+
+def time_range_join(data1, data2, time_range=60, engine='auto', max_memory=None, dist_max=None, **options):
+    """Performs a range join based on indicated time plus/minus `time_range` buffer with one of the `JOIN_ENGINES`,
+    and on distance within `dist_max` if it is set
+
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset
+
+    time_range : int
+        Value for time buffer indicating range in join
+
+    engine : str
+        Key of the engine in `JOIN_ENGINES`, or 'auto' to choose one with `select_join_engine`
+
+    max_memory : int
+        Memory budget in bytes used by 'auto', defaulting to the memory currently available
+
+    dist_max : int
+        If set, only the pairs of records within this distance of each other are kept
+
+    **options
+        Further keyword arguments of the engine, such as `chunk_size` of 'chunked' or `workers` of 'parallel'
+
+    Returns
+    -------
+    df_range_join : pandas DataFrame
+        DataFrame with a range join of the two datasets based on time
+    """
+    if engine == 'auto':
+        engine, reason = select_join_engine(data1, data2, time_range=time_range, max_memory=max_memory,
+                                            dist_max=dist_max)
+        print("Using " + engine + " join engine: " + reason)
+    elif engine not in JOIN_ENGINES:
+        raise Exception('Join engine not valid')
+
+    join, filters_distance = JOIN_ENGINES[engine]
+    if filters_distance:
+        df_range_join = join(data1, data2, time_range=time_range, dist_max=dist_max, **options)
+    else:
+        df_range_join = join(data1, data2, time_range=time_range, **options)
+        if dist_max is not None:
+            df_range_join = haversine_dist_filter(df_range_join, dist_max=dist_max)
+
+    return df_range_join
+
+def haversine_dist_mask(lat1, lon1, lat2, lon2, dist_max=100):
+    """Returns a boolean mask of the pairs of points within `dist_max` of each other using haversine distance. Pairs
+    are first rejected with a bounding box, as the difference in latitude alone, or in longitude at the highest
+    latitude present, can already put them too far apart. The haversine is then only evaluated on the remaining
+    pairs, computing in place in preallocated buffers
+
+    Parameters
+    ----------
+    lat1, lon1 : numpy array
+        Latitudes and longitudes in degrees of the first points
+
+    lat2, lon2 : numpy array
+        Latitudes and longitudes in degrees of the second points
+
+    dist_max : int
+        Maximum distance between points
+
+    Returns
+    -------
+    close_distance : numpy array
+        Boolean mask of the pairs within `dist_max` of each other
+    """
+    radius = 6378137 # meters
+
+    lat1 = np.asarray(lat1, dtype=np.float64)
+    lon1 = np.asarray(lon1, dtype=np.float64)
+    lat2 = np.asarray(lat2, dtype=np.float64)
+    lon2 = np.asarray(lon2, dtype=np.float64)
+    close_distance = np.zeros(len(lat1), dtype=bool)
+    if len(lat1) == 0:
+        return close_distance
+
+    # the haversine distance is at least the radius times the latitude difference, and at least the longitude
+    # difference scaled by the cosine of the highest latitude. the thresholds are widened slightly for rounding
+    angle_max = dist_max / radius
+    lat_max = np.degrees(angle_max) * (1 + 1e-9)
+    highest_cos = np.cos(np.radians(min(max(np.nanmax(np.abs(lat1)), np.nanmax(np.abs(lat2))), 90.0)))
+    if highest_cos > 0 and angle_max < np.pi and np.sin(angle_max / 2) < highest_cos:
+        lon_max = 2 * np.degrees(np.arcsin(np.sin(angle_max / 2) / highest_cos)) * (1 + 1e-9)
+    else:
+        lon_max = 180.0
+
+    if kernels.ENABLED:
+        return kernels.haversine_mask(lat1, lon1, lat2, lon2, float(dist_max), lat_max, lon_max)
+
+    buffer = np.empty(len(lat1))
+    np.subtract(lat2, lat1, out=buffer)
+    np.abs(buffer, out=buffer)
+    np.less_equal(buffer, lat_max, out=close_distance)
+
+    wrapped = np.empty(len(lat1))
+    np.subtract(lon2, lon1, out=buffer)
+    np.abs(buffer, out=buffer)
+    np.subtract(360.0, buffer, out=wrapped)
+    np.minimum(buffer, wrapped, out=buffer)
+    close_distance &= buffer <= lon_max
+
+    candidates = np.flatnonzero(close_distance)
+    if len(candidates) == 0:
+        return close_distance
+
+    # same operations in the same order as `haversine_dist_filter` always used, so results agree exactly
+    dlat = np.empty(len(candidates))
+    np.subtract(np.take(lat2, candidates), np.take(lat1, candidates), out=dlat)
+    np.radians(dlat, out=dlat)
+    dlat /= 2
+    np.sin(dlat, out=dlat)
+    np.square(dlat, out=dlat)
+
+    cos_lat = np.empty(len(candidates))
+    cos_lat2 = np.empty(len(candidates))
+    np.radians(np.take(lat1, candidates), out=cos_lat)
+    np.cos(cos_lat, out=cos_lat)
+    np.radians(np.take(lat2, candidates), out=cos_lat2)
+    np.cos(cos_lat2, out=cos_lat2)
+    cos_lat *= cos_lat2
+
+    dlon = cos_lat2
+    np.subtract(np.take(lon2, candidates), np.take(lon1, candidates), out=dlon)
+    np.radians(dlon, out=dlon)
+    dlon /= 2
+    np.sin(dlon, out=dlon)
+    np.square(dlon, out=dlon)
+    cos_lat *= dlon
+
+    a = dlat
+    a += cos_lat
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2
+    a *= radius
+
+    close_distance[candidates] = a <= dist_max
+
+    return close_distance
+
 def haversine_dist_filter(dataframe, dist_max=100):
     """Returns dataframe with filtered for distance between recorded points using haversine distance
 
@@ -526,20 +1894,81 @@ def haversine_dist_filter(dataframe, dist_max=100):
     df_dist : pandas DataFrame
         DataFrame filtered for only records within defined distance
     """
-    radius = 6378137 # meters
+    close_distance = haversine_dist_mask(dataframe['lat1'].values, dataframe['lon1'].values,
+                                         dataframe['lat2'].values, dataframe['lon2'].values, dist_max=dist_max)
+    df_dist = dataframe[close_distance].reset_index(drop=True)
 
-    dataframe['dlat'] = np.radians(dataframe['lat2']-dataframe['lat1'])
-    dataframe['dlon'] = np.radians(dataframe['lon2']-dataframe['lon1'])
-    dataframe['a'] = np.sin(dataframe['dlat']/2)**2 + np.cos(np.radians(dataframe['lat1'])) * np.cos(np.radians(dataframe['lat2'])) * np.sin(dataframe['dlon']/2)**2
-    dataframe['c'] = 2 * np.arcsin(np.sqrt(dataframe['a']))
-    dataframe['dist'] = radius * dataframe['c']
+    return df_dist
 
-    close_distance = dataframe['dist'] <= dist_max
-    df_dist = dataframe[close_distance].drop(columns=['dlat', 'dlon', 'a', 'c', 'dist']).reset_index(drop=True)
+def pairwise_join(data1, data2, detection_distance=50, detection_time=60, chunk_size=None, max_memory=None,
+                  engine='auto', workers=None):
+    """Range joins two datasets with suffixed columns on both time and distance with `time_range_join`, choosing
+    the engine and the size of its streamed blocks as `pairwise_filter` does
 
-    return df_dist
+    Parameters
+    ----------
+    data1 : pandas DataFrame
+        DataFrame of the first dataset, with unix times and '1' appended to its column names
+
+    data2 : pandas DataFrame
+        DataFrame of the second dataset, with unix times and '2' appended to its column names
+
+    detection_distance : int
+        The maximum distance in meters for two detections to have occurred
+
+    detection_time : int
+        The maximum time difference in the initial recording of a detection
+
+    chunk_size : int
+        If set, the range join is streamed in time blocks of this many seconds, with each block distance filtered
+        before the next is joined
+
+    max_memory : int
+        Memory budget in bytes for choosing the join engine. If set instead of `chunk_size` with the 'chunked' engine,
+        the approximate maximum size in bytes of a streamed block of the range join
+
+    engine : str
+        Key of the engine in `JOIN_ENGINES`, or 'auto' to choose one with `select_join_engine`. Set to 'chunked' if
+        `chunk_size` is set
 
-def pairwise_filter(data1, data2, session_limit=600, detection_distance=50, detection_time=2):
+    workers : int
+        Number of worker processes for the 'parallel' engine, defaulting to the number of cores
+
+    Returns
+    -------
+    candidate_pairs : pandas DataFrame
+        DataFrame of the joined records within both the time range and the distance of each other
+    """
+    if engine == 'auto' and chunk_size is None:
+        engine, reason = select_join_engine(data1, data2, time_range=detection_time, max_memory=max_memory,
+                                            dist_max=detection_distance)
+        print("Using " + engine + " join engine: " + reason)
+        if engine == 'chunked':
+            chunk_size = _chunk_size_for_memory(data1, data2, detection_time, (max_memory or _available_memory()) / 4)
+    elif engine == 'chunked' and chunk_size is None:
+        if max_memory is None:
+            raise Exception('Chunked join needs a chunk size or memory limit')
+        chunk_size = _chunk_size_for_memory(data1, data2, detection_time, max_memory)
+    elif engine not in JOIN_ENGINES and chunk_size is None:
+        raise Exception('Join engine not valid')
+
+    options = {}
+    if chunk_size is not None:
+        engine = 'chunked'
+        options['chunk_size'] = chunk_size
+        print("Time-based range joining and filtering on distance in " + str(chunk_size) + " second chunks")
+    elif engine == 'parallel':
+        options['workers'] = workers
+        print("Time and distance based range joining in parallel")
+    else:
+        print("Time and distance based range joining with the " + engine + " join engine")
+    candidate_pairs = time_range_join(data1, data2, time_range=detection_time, engine=engine,
+                                      dist_max=detection_distance, **options)
+
+    return candidate_pairs
+
+def pairwise_filter(data1, data2, session_limit=600, detection_distance=50, detection_time=60,
+                    chunk_size=None, max_memory=None, engine='auto', workers=None):
     """Takes two datasets with identifiers to range join and filter to produce a list of probable joint identifiers
 
     Parameters
@@ -559,6 +1988,21 @@ def pairwise_filter(data1, data2, session_limit=600, detection_distance=50, dete
 
     detection_time : int
         The maximum time difference in the initial recording of a detection
+
+    chunk_size : int
+        If set, the range join is streamed in time blocks of this many seconds, with each block distance filtered
+        before the next is joined
+
+    max_memory : int
+        Memory budget in bytes for choosing the join engine. If set instead of `chunk_size` with the 'chunked' engine,
+        the approximate maximum size in bytes of a streamed block of the range join
+
+    engine : str
+        Key of the engine in `JOIN_ENGINES` joining on time and distance through `time_range_join`, or 'auto' to
+        choose one with `select_join_engine`. Set to 'chunked' if `chunk_size` is set
+
+    workers : int
+        Number of worker processes for the 'parallel' engine, defaulting to the number of cores
     
     Returns
     -------
@@ -577,14 +2021,116 @@ def pairwise_filter(data1, data2, session_limit=600, detection_distance=50, dete
     data2_suffix = data2_session_filter.add_suffix('2')
 
     # range join includes filtering for time proximity of recorded event
-    print("Time-based range joining")
-    df_range_join = time_range_join_spark_disk(data1_suffix, data2_suffix, time_range=detection_time)
-
-    print("Filtering on distance")
-    candidate_pairs = haversine_dist_filter(df_range_join, dist_max=detection_distance)
+    candidate_pairs = pairwise_join(data1_suffix, data2_suffix, detection_distance=detection_distance,
+                                    detection_time=detection_time, chunk_size=chunk_size, max_memory=max_memory,
+                                    engine=engine, workers=workers)
 
     return candidate_pairs
 
+def pairwise_filter_stream(chunks1, chunks2, detection_distance=50, detection_time=60, scratch_dir=None,
+                           row_group_size=100000):
+    """Range joins and distance filters two streams of DataFrame chunks, such as from `csv_to_df_chunks`, holding
+    only a bounded number of records in memory. The chunks of the second dataset are spilled to time sorted Parquet
+    files, then each chunk of the first dataset is joined in time sorted blocks of `row_group_size` records against
+    only the row groups of the spilled files within `detection_time` of the block. A cursor into each spilled file
+    moves forward with the blocks, so each row group is read about once per chunk of the first dataset. The chunks
+    are expected to already have unix times and their long sessions filtered
+
+    Parameters
+    ----------
+    chunks1 : iterable of pandas DataFrame
+        Chunks of the first dataset
+
+    chunks2 : iterable of pandas DataFrame
+        Chunks of the second dataset
+
+    detection_distance : int
+        The maximum distance in meters for two detections to have occurred
+
+    detection_time : int
+        The maximum time difference in the initial recording of a detection
+
+    scratch_dir : str
+        Directory for the spilled chunks of the second dataset, which are deleted afterwards. Defaults to the system
+        temporary directory
+
+    row_group_size : int
+        Number of records per row group of the spilled chunks and per joined block of the first dataset
+
+    Yields
+    ------
+    candidate_pairs : pandas DataFrame
+        DataFrame of possible shared identifiers for a block of the first dataset. Pairs are in time order of the
+        first dataset within a chunk rather than in record order, and an empty DataFrame is yielded if there are none
+    """
+    scratch = tempfile.mkdtemp(prefix='pairwise_stream_', dir=scratch_dir)
+
+    try:
+        print("Spilling second dataset to disk")
+        runs2 = []
+        columns2 = None
+        for run, chunk2 in enumerate(chunks2):
+            chunk2 = chunk2.add_suffix('2')
+            columns2 = chunk2.columns
+            if len(chunk2) == 0:
+                continue
+            path = os.path.join(scratch, 'data2-%05d.parquet' % run)
+            time_column2 = _write_time_sorted_parquet(chunk2, '2', path, row_group_size)
+            parquet2 = pq.ParquetFile(path)
+            time_ranges2 = _row_group_time_ranges(parquet2, time_column2)
+            runs2.append((parquet2, np.array(list(time_ranges2), dtype=np.int64),
+                          np.array([time_low2 for time_low2, _ in time_ranges2.values()]),
+                          np.array([time_high2 for _, time_high2 in time_ranges2.values()])))
+
+        print("Time and distance based range joining in blocks of " + str(row_group_size) + " records")
+        columns1 = None
+        yielded = False
+        for chunk1 in chunks1:
+            chunk1 = chunk1.add_suffix('1')
+            columns1 = chunk1.columns
+            d1_time = _join_time(chunk1, '1')
+            d1_order = np.argsort(d1_time, kind='mergesort')
+            # row groups of each run read for the last block, which the next block in time order mostly overlaps
+            row_groups2 = [{} for _ in runs2]
+
+            for block_start in range(0, len(chunk1), row_group_size):
+                block_order = d1_order[block_start:block_start + row_group_size]
+                block1 = chunk1.iloc[block_order].reset_index(drop=True)
+                block_time = d1_time[block_order]
+                time_low, time_high = block_time[0] - detection_time, block_time[-1] + detection_time
+
+                # each run is in time order, so its row groups overlapping the block are a contiguous range found by
+                # binary search, and the range only moves forward as the blocks do
+                frames2 = []
+                for run, (parquet2, row_group_ids, time_lows2, time_highs2) in enumerate(runs2):
+                    first = np.searchsorted(time_highs2, time_low, side='left')
+                    last = np.searchsorted(time_lows2, time_high, side='right')
+                    loaded = row_groups2[run]
+                    row_groups2[run] = {row_group2: loaded[row_group2] if row_group2 in loaded
+                                        else parquet2.read_row_group(row_group2).to_pandas()
+                                        for row_group2 in row_group_ids[first:last]}
+                    frames2.extend(row_groups2[run].values())
+                if not frames2:
+                    continue
+
+                block2 = pd.concat(frames2, ignore_index=True)
+                block2 = block2.drop(columns=['_position2'])
+
+                i, j = _sorted_join_pairs(block_time, _join_time(block2, '2'), detection_time)
+                close_distance = haversine_dist_mask(block1['lat1'].values[i], block1['lon1'].values[i],
+                                                     block2['lat2'].values[j], block2['lon2'].values[j],
+                                                     dist_max=detection_distance)
+                if not close_distance.any():
+                    continue
+
+                yielded = True
+                yield _pairs_to_frame(block1, block2, i[close_distance], j[close_distance])
+
+        if not yielded and columns1 is not None and columns2 is not None:
+            yield pd.DataFrame(columns=columns1.append(columns2))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
 def npmi(dataframe):
     """Takes a dataset with identifiers and calculates the Normalize Pointwise Mutual Information value
     for every pair of identifiers
@@ -597,23 +2143,580 @@ def npmi(dataframe):
     Returns
     -------
     npmi : pandas DataFrame
-        DataFrame of NMPI values for all pairs
+        DataFrame of NMPI values for all pairs. Records missing either identifier are not counted
     """
-    id_only = dataframe[['element_id1', 'element_id2']]
-    ids_size = id_only.groupby(['element_id1', 'element_id2']).size().to_frame('ids_count')
-    id1_size = id_only.groupby(['element_id1']).size().to_frame('id1_count')
-    id2_size = id_only.groupby(['element_id2']).size().to_frame('id2_count')
-    total_id_count = id_only.shape[0]
-    id_distinct = id_only.drop_duplicates().reset_index(drop=True)
+    # missing identifiers would be coded as -1, so those records are left out of every count
+    dataframe = dataframe.dropna(subset=['element_id1', 'element_id2'])
+
+    # integer codes in order of first appearance keep the pairs in the order they were first seen
+    codes1, id1_distinct = pd.factorize(dataframe['element_id1'])
+    codes2, id2_distinct = pd.factorize(dataframe['element_id2'])
+    pair_codes, pair_keys = pd.factorize(codes1.astype(np.int64) * len(id2_distinct) + codes2)
+    total_id_count = len(pair_codes)
+
+    if kernels.ENABLED:
+        ids_count, id1_count, id2_count = kernels.npmi_counts(codes1, codes2, pair_codes, len(id1_distinct),
+                                                              len(id2_distinct), len(pair_keys))
+    else:
+        ids_count = np.bincount(pair_codes, minlength=len(pair_keys))
+        id1_count = np.bincount(codes1, minlength=len(id1_distinct))
+        id2_count = np.bincount(codes2, minlength=len(id2_distinct))
 
-    calculations = id_distinct.join(ids_size, on=['element_id1', 'element_id2']).join(id1_size, on=['element_id1']).join(id2_size, on=['element_id2'])
-    calculations['pmi'] = np.log((calculations['ids_count'] / total_id_count) / ((calculations['id1_count'] / total_id_count) * (calculations['id2_count'] / total_id_count)))
-    calculations['npmi'] = calculations['pmi'] / (-1 * np.log(calculations['ids_count'] / total_id_count))
+    pair_id1 = pair_keys // len(id2_distinct)
+    pair_id2 = pair_keys % len(id2_distinct)
+    pair_count = ids_count / total_id_count
+    pmi = np.log(pair_count / ((id1_count[pair_id1] / total_id_count) * (id2_count[pair_id2] / total_id_count)))
 
-    npmi = calculations[['element_id1', 'element_id2', 'npmi']]
+    npmi = pd.DataFrame({'element_id1': id1_distinct.take(pair_id1),
+                         'element_id2': id2_distinct.take(pair_id2),
+                         'npmi': pmi / (-1 * np.log(pair_count))})
 
     return npmi
 
+def npmi_sparse(dataframe, min_npmi=None):
+    """Takes a dataset with identifiers and calculates the Normalize Pointwise Mutual Information value for every
+    pair of identifiers from a sparse co-occurrence matrix of their integer codes. The marginal counts are the row
+    and column sums of the matrix and the NPMI is calculated on its stored values alone, so identifiers are only
+    mapped back for the pairs kept
+
+    Parameters
+    ----------
+    dataframe : pandas DataFrame
+        DataFrame of records with a pair of identifiers
+
+    min_npmi : float
+        If set, only the pairs with at least this npmi value are returned
+
+    Returns
+    -------
+    npmi : pandas DataFrame
+        DataFrame of identifier pairs and their npmi value, ordered by first appearance of the first identifier
+        and then of the second identifier. Records missing either identifier are not counted
+    """
+    # missing identifiers would be coded as -1, which the sparse matrix would read as the last row or column
+    dataframe = dataframe.dropna(subset=['element_id1', 'element_id2'])
+
+    codes1, id1_distinct = pd.factorize(dataframe['element_id1'])
+    codes2, id2_distinct = pd.factorize(dataframe['element_id2'])
+    total_id_count = len(dataframe)
+
+    # summing duplicate entries on conversion counts each pair
+    cooccurrence = sparse.coo_matrix((np.ones(total_id_count, dtype=np.int64), (codes1, codes2)),
+                                     shape=(len(id1_distinct), len(id2_distinct))).tocsr()
+    id1_count = np.asarray(cooccurrence.sum(axis=1)).ravel()
+    id2_count = np.asarray(cooccurrence.sum(axis=0)).ravel()
+
+    pair_id1 = np.repeat(np.arange(cooccurrence.shape[0]), np.diff(cooccurrence.indptr))
+    pair_id2 = cooccurrence.indices
+    pair_count = cooccurrence.data / total_id_count
+    pmi = np.log(pair_count / ((id1_count[pair_id1] / total_id_count) * (id2_count[pair_id2] / total_id_count)))
+    pair_npmi = pmi / (-1 * np.log(pair_count))
+
+    if min_npmi is not None:
+        selected_pairs = pair_npmi >= min_npmi
+        pair_id1, pair_id2, pair_npmi = pair_id1[selected_pairs], pair_id2[selected_pairs], pair_npmi[selected_pairs]
+
+    npmi = pd.DataFrame({'element_id1': id1_distinct.take(pair_id1),
+                         'element_id2': id2_distinct.take(pair_id2),
+                         'npmi': pair_npmi})
+
+    return npmi
+
+def _npmi_from_pair_counts(pair_counts, min_npmi=None):
+    """Calculates the npmi of every identifier pair from a Series of pair counts indexed by identifier pair, taking
+    the marginal counts from sums over the pair counts of each identifier"""
+    pair_index = pair_counts.index.remove_unused_levels()
+    codes1, codes2 = pair_index.codes
+    counts = pair_counts.values.astype(np.float64)
+    total_id_count = counts.sum()
+
+    id1_count = np.bincount(codes1, weights=counts, minlength=len(pair_index.levels[0]))
+    id2_count = np.bincount(codes2, weights=counts, minlength=len(pair_index.levels[1]))
+    pair_count = counts / total_id_count
+    pmi = np.log(pair_count / ((id1_count[codes1] / total_id_count) * (id2_count[codes2] / total_id_count)))
+    pair_npmi = pmi / (-1 * np.log(pair_count))
+
+    npmi = pd.DataFrame({'element_id1': pair_index.get_level_values(0),
+                         'element_id2': pair_index.get_level_values(1),
+                         'npmi': pair_npmi})
+    if min_npmi is not None:
+        npmi = npmi[npmi['npmi'] >= min_npmi].reset_index(drop=True)
+
+    return npmi
+
+class NpmiAccumulator(object):
+    """Running counts of identifier pairs for calculating the Normalize Pointwise Mutual Information without
+    holding every candidate pair at once. Chunks of candidate pairs are added with `update`, counts from other
+    workers or days are added with `merge`, and the counts can be saved to and loaded from Parquet so the npmi
+    can be updated with each day's pairs. Only the pair counts are kept, as the identifier counts and the total
+    are sums over them. `sources` names the inputs counted, such as digests of the files the pairs came from, so
+    inputs already counted can be skipped when updating saved counts
+    """
+    def __init__(self):
+        self.pair_counts = pd.Series([], dtype=np.int64,
+                                     index=pd.MultiIndex.from_arrays([[], []], names=['element_id1', 'element_id2']))
+        self.sources = set()
+
+    @property
+    def total(self):
+        """Number of candidate pairs counted"""
+        return int(self.pair_counts.sum())
+
+    def _add_counts(self, pair_counts):
+        if len(self.pair_counts) == 0:
+            self.pair_counts = pair_counts.astype(np.int64)
+        else:
+            self.pair_counts = self.pair_counts.add(pair_counts, fill_value=0).astype(np.int64)
+
+    def update(self, dataframe):
+        """Counts a chunk of candidate pairs
+
+        Parameters
+        ----------
+        dataframe : pandas DataFrame
+            DataFrame of records with a pair of identifiers
+
+        Returns
+        -------
+        self : NpmiAccumulator
+            The accumulator with the chunk counted
+        """
+        pair_counts = dataframe.groupby(['element_id1', 'element_id2'], sort=False, observed=True).size()
+        self._add_counts(pair_counts)
+
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator
+
+        Parameters
+        ----------
+        other : NpmiAccumulator
+            Accumulator of other candidate pairs, such as from another worker or day
+
+        Returns
+        -------
+        self : NpmiAccumulator
+            The accumulator with both sets of counts
+        """
+        self._add_counts(other.pair_counts)
+        self.sources |= other.sources
+
+        return self
+
+    def subtract(self, other):
+        """Removes the counts of another accumulator whose pairs were added before, dropping pairs no longer counted
+
+        Parameters
+        ----------
+        other : NpmiAccumulator
+            Accumulator of candidate pairs included in this one, such as a window leaving a sliding window
+
+        Returns
+        -------
+        self : NpmiAccumulator
+            The accumulator without the other's counts
+        """
+        pair_counts = self.pair_counts.sub(other.pair_counts, fill_value=0).astype(np.int64)
+        self.pair_counts = pair_counts[pair_counts > 0]
+        self.sources -= other.sources
+
+        return self
+
+    def finalize(self, min_npmi=None):
+        """Calculates the npmi of every identifier pair counted
+
+        Parameters
+        ----------
+        min_npmi : float
+            If set, only the pairs with at least this npmi value are returned
+
+        Returns
+        -------
+        npmi : pandas DataFrame
+            DataFrame of identifier pairs and their npmi value
+        """
+        return _npmi_from_pair_counts(self.pair_counts, min_npmi=min_npmi)
+
+    def save(self, path):
+        """Writes the pair counts to a Parquet file, with the sources counted in its metadata
+
+        Parameters
+        ----------
+        path : str
+            File path of the counts
+        """
+        counts = pa.Table.from_pandas(self.pair_counts.rename('count').reset_index(), preserve_index=False)
+        metadata = dict(counts.schema.metadata or {}, sources=json.dumps(sorted(self.sources)))
+        pq.write_table(counts.replace_schema_metadata(metadata), path)
+
+    def load(self, path):
+        """Replaces the counts with those saved to a Parquet file
+
+        Parameters
+        ----------
+        path : str
+            File path of the counts
+
+        Returns
+        -------
+        self : NpmiAccumulator
+            The accumulator with the saved counts
+        """
+        counts = pq.read_table(path)
+        self.pair_counts = counts.to_pandas().set_index(['element_id1', 'element_id2'])['count'].astype(np.int64)
+        self.sources = set(json.loads((counts.schema.metadata or {}).get(b'sources', b'[]')))
+
+        return self
+
+class SlidingNpmi(object):
+    """Normalize Pointwise Mutual Information over a sliding window of the most recent `window_count` time windows
+    of `window_size` seconds each, such as the last week of days. Counts are kept per window along with their
+    running sum, so sliding forward adds the newest window and subtracts the oldest rather than recounting the
+    whole span, and associations that stopped occurring age out of the scores
+
+    Parameters
+    ----------
+    window_size : int
+        Length in seconds of each window, by the time of the first dataset's record
+
+    window_count : int
+        Number of most recent windows scored together
+    """
+    def __init__(self, window_size=86400, window_count=7):
+        self.window_size = window_size
+        self.window_count = window_count
+        self.windows = collections.OrderedDict()
+        self.running = NpmiAccumulator()
+
+    def _slide_to(self, window):
+        """Opens windows up to `window` and drops those that no longer fit in the span"""
+        newest = next(reversed(self.windows)) if self.windows else window - 1
+        for opened in range(max(newest + 1, window - self.window_count + 1), window + 1):
+            self.windows[opened] = NpmiAccumulator()
+        while next(iter(self.windows)) <= window - self.window_count:
+            _, oldest = self.windows.popitem(last=False)
+            self.running.subtract(oldest)
+
+    def update(self, dataframe):
+        """Counts candidate pairs into their windows, sliding the span forward to the newest window seen. Pairs
+        older than the span are ignored
+
+        Parameters
+        ----------
+        dataframe : pandas DataFrame
+            DataFrame of candidate pairs with identifiers and the times of the first dataset
+
+        Returns
+        -------
+        self : SlidingNpmi
+            The sliding window with the pairs counted
+        """
+        pair_windows = _join_time(dataframe, '1') // self.window_size
+        for window in np.unique(pair_windows):
+            window = int(window)
+            if not self.windows or window > next(reversed(self.windows)):
+                self._slide_to(window)
+            if window not in self.windows:
+                continue
+            window_counts = NpmiAccumulator().update(dataframe[pair_windows == window])
+            self.windows[window].merge(window_counts)
+            self.running.merge(window_counts)
+
+        return self
+
+    def finalize(self, min_npmi=None):
+        """Calculates the npmi of every identifier pair in the current span of windows
+
+        Parameters
+        ----------
+        min_npmi : float
+            If set, only the pairs with at least this npmi value are returned
+
+        Returns
+        -------
+        npmi : pandas DataFrame
+            DataFrame of identifier pairs and their npmi value
+        """
+        return self.running.finalize(min_npmi=min_npmi)
+
+    def save(self, path):
+        """Writes the counts of every window in the span to a directory, one Parquet file per window
+
+        Parameters
+        ----------
+        path : str
+            Directory of the window counts, whose previous window files are replaced
+        """
+        os.makedirs(path, exist_ok=True)
+        for entry in os.listdir(path):
+            if entry.startswith('window-') and entry.endswith('.parquet'):
+                os.remove(os.path.join(path, entry))
+        for window, accumulator in self.windows.items():
+            accumulator.save(os.path.join(path, 'window-%d.parquet' % window))
+
+    def load(self, path):
+        """Replaces the windows with those saved to a directory, keeping only the most recent `window_count`
+
+        Parameters
+        ----------
+        path : str
+            Directory of the window counts
+
+        Returns
+        -------
+        self : SlidingNpmi
+            The sliding window with the saved counts
+        """
+        windows = sorted(int(entry[len('window-'):-len('.parquet')]) for entry in os.listdir(path)
+                         if entry.startswith('window-') and entry.endswith('.parquet'))
+        self.windows = collections.OrderedDict()
+        self.running = NpmiAccumulator()
+        for window in windows[-self.window_count:]:
+            self.windows[window] = NpmiAccumulator().load(os.path.join(path, 'window-%d.parquet' % window))
+            self.running.merge(self.windows[window])
+
+        return self
+
+def rolling_npmi(dataframe, window_size=86400, window_count=7, min_npmi=None):
+    """Scores the candidate pairs of each window with the npmi of the sliding span of windows ending with it
+
+    Parameters
+    ----------
+    dataframe : pandas DataFrame
+        DataFrame of candidate pairs with identifiers and the times of the first dataset
+
+    window_size : int
+        Length in seconds of each window
+
+    window_count : int
+        Number of most recent windows scored together
+
+    min_npmi : float
+        If set, only the pairs with at least this npmi value are returned
+
+    Yields
+    ------
+    window : int
+        Start of the window in unix time
+
+    npmi : pandas DataFrame
+        DataFrame of identifier pairs and their npmi value over the span ending with the window
+    """
+    sliding = SlidingNpmi(window_size=window_size, window_count=window_count)
+    pair_windows = _join_time(dataframe, '1') // window_size
+    for window in np.unique(pair_windows):
+        sliding.update(dataframe[pair_windows == window])
+        yield int(window) * window_size, sliding.finalize(min_npmi=min_npmi)
+
+class CountMinSketch(object):
+    """Count-Min sketch of 64 bit hashed keys. Counts are overestimated by at most `epsilon` times the total count
+    with probability at least 1 - `delta`, in a fixed `depth` by `width` table
+
+    Parameters
+    ----------
+    epsilon : float
+        Error bound on the estimated counts as a fraction of the total count
+
+    delta : float
+        Probability of an estimate exceeding the error bound
+
+    seed : int
+        Seed of the row hash functions, which must match for sketches to be merged
+    """
+    def __init__(self, epsilon=0.001, delta=0.01, seed=0):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.seed = seed
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        rng = np.random.RandomState(seed)
+        # odd multipliers of a multiply-shift hash for each row
+        self.multipliers = rng.randint(1, 2**62, self.depth, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+    def _columns(self, hashes, row):
+        return ((hashes * self.multipliers[row]) >> np.uint64(32)) % np.uint64(self.width)
+
+    def add(self, hashes):
+        """Counts each of an array of hashed keys once"""
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self._columns(hashes, row).astype(np.int64), minlength=self.width)
+
+    def estimate(self, hashes):
+        """Estimated count of each of an array of hashed keys"""
+        estimates = self.table[0][self._columns(hashes, 0).astype(np.int64)]
+        for row in range(1, self.depth):
+            estimates = np.minimum(estimates, self.table[row][self._columns(hashes, row).astype(np.int64)])
+
+        return estimates
+
+    def merge(self, other):
+        """Adds the counts of a sketch with the same dimensions and seed"""
+        if (self.width, self.depth, self.seed) != (other.width, other.depth, other.seed):
+            raise Exception('Count-Min sketches must share dimensions and seed to merge')
+        self.table += other.table
+
+def _id_hashes(ids):
+    """64 bit hashes of an array of identifiers"""
+    return pd.util.hash_pandas_object(pd.Series(ids), index=False).values
+
+def _pair_hashes(hashes1, hashes2):
+    """64 bit hashes of identifier pairs from the hashes of their identifiers"""
+    return hashes1 * np.uint64(0x9E3779B97F4A7C15) ^ (hashes2 + np.uint64(0x632BE59BD9B4E019))
+
+class ApproximateNpmi(object):
+    """Approximate Normalize Pointwise Mutual Information in fixed memory for identifier sets too large to count
+    exactly. Pair and identifier counts are estimated with Count-Min sketches, and only the `top_pairs` pairs with
+    the highest estimated counts are tracked and scored. Estimated counts are at most `epsilon` times the number of
+    candidate pairs too high with probability 1 - `delta`
+
+    Parameters
+    ----------
+    epsilon : float
+        Error bound on the estimated counts as a fraction of the number of candidate pairs
+
+    delta : float
+        Probability of an estimate exceeding the error bound
+
+    top_pairs : int
+        Number of most frequent identifier pairs tracked and scored
+
+    seed : int
+        Seed of the sketch hash functions, which must match for accumulators to be merged
+    """
+    def __init__(self, epsilon=0.001, delta=0.01, top_pairs=10000, seed=0):
+        self.top_pairs = top_pairs
+        self.total = 0
+        self.pair_sketch = CountMinSketch(epsilon=epsilon, delta=delta, seed=seed)
+        self.id1_sketch = CountMinSketch(epsilon=epsilon, delta=delta, seed=seed + 1)
+        self.id2_sketch = CountMinSketch(epsilon=epsilon, delta=delta, seed=seed + 2)
+        self.heavy_pairs = None
+
+    @property
+    def error(self):
+        """Largest overestimate of a count within the error bound"""
+        return math.e / self.pair_sketch.width * self.total
+
+    def _keep_heavy(self, candidates):
+        """Keeps the `top_pairs` candidate pairs with the highest estimated counts"""
+        if self.heavy_pairs is not None:
+            candidates = pd.concat([self.heavy_pairs, candidates], ignore_index=True)
+        candidates = candidates.drop_duplicates('pair_hash')
+        counts = self.pair_sketch.estimate(candidates['pair_hash'].values)
+        heaviest = np.argsort(-counts, kind='mergesort')[:self.top_pairs]
+        self.heavy_pairs = candidates.iloc[heaviest].reset_index(drop=True)
+
+    def update(self, dataframe):
+        """Counts a chunk of candidate pairs
+
+        Parameters
+        ----------
+        dataframe : pandas DataFrame
+            DataFrame of records with a pair of identifiers
+
+        Returns
+        -------
+        self : ApproximateNpmi
+            The accumulator with the chunk counted
+        """
+        hashes1 = _id_hashes(dataframe['element_id1'].values)
+        hashes2 = _id_hashes(dataframe['element_id2'].values)
+        pair_hashes = _pair_hashes(hashes1, hashes2)
+        self.total += len(dataframe)
+        self.pair_sketch.add(pair_hashes)
+        self.id1_sketch.add(hashes1)
+        self.id2_sketch.add(hashes2)
+
+        self._keep_heavy(pd.DataFrame({'element_id1': dataframe['element_id1'].values,
+                                       'element_id2': dataframe['element_id2'].values,
+                                       'hash1': hashes1, 'hash2': hashes2, 'pair_hash': pair_hashes}))
+
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator with the same error bounds and seed
+
+        Parameters
+        ----------
+        other : ApproximateNpmi
+            Accumulator of other candidate pairs, such as from another worker or day
+
+        Returns
+        -------
+        self : ApproximateNpmi
+            The accumulator with both sets of counts
+        """
+        self.total += other.total
+        self.pair_sketch.merge(other.pair_sketch)
+        self.id1_sketch.merge(other.id1_sketch)
+        self.id2_sketch.merge(other.id2_sketch)
+        if other.heavy_pairs is not None:
+            self._keep_heavy(other.heavy_pairs)
+
+        return self
+
+    def finalize(self, min_npmi=None):
+        """Estimates the npmi of the tracked identifier pairs
+
+        Parameters
+        ----------
+        min_npmi : float
+            If set, only the pairs with at least this estimated npmi value are returned
+
+        Returns
+        -------
+        npmi : pandas DataFrame
+            DataFrame of identifier pairs, their estimated count and npmi value, by descending count
+        """
+        if self.heavy_pairs is None:
+            return pd.DataFrame({'element_id1': [], 'element_id2': [], 'count': [], 'npmi': []})
+
+        pair_count = self.pair_sketch.estimate(self.heavy_pairs['pair_hash'].values).astype(np.float64)
+        id1_count = self.id1_sketch.estimate(self.heavy_pairs['hash1'].values)
+        id2_count = self.id2_sketch.estimate(self.heavy_pairs['hash2'].values)
+
+        # a pair can be counted no more often than either of its identifiers
+        pair_count = np.minimum(pair_count, np.minimum(id1_count, id2_count)) / self.total
+        pmi = np.log(pair_count / ((id1_count / self.total) * (id2_count / self.total)))
+
+        npmi = pd.DataFrame({'element_id1': self.heavy_pairs['element_id1'].values,
+                             'element_id2': self.heavy_pairs['element_id2'].values,
+                             'count': (pair_count * self.total).astype(np.int64),
+                             'npmi': pmi / (-1 * np.log(pair_count))})
+        if min_npmi is not None:
+            npmi = npmi[npmi['npmi'] >= min_npmi]
+
+        return npmi.sort_values('count', ascending=False, kind='mergesort').reset_index(drop=True)
+
+def npmi_approximate(dataframe, epsilon=0.001, delta=0.01, top_pairs=10000, min_npmi=None):
+    """Takes a dataset with identifiers and estimates the Normalize Pointwise Mutual Information value for its
+    most frequent pairs of identifiers in fixed memory with `ApproximateNpmi`
+
+    Parameters
+    ----------
+    dataframe : pandas DataFrame
+        DataFrame of records with a pair of identifiers
+
+    epsilon : float
+        Error bound on the estimated counts as a fraction of the number of records
+
+    delta : float
+        Probability of an estimate exceeding the error bound
+
+    top_pairs : int
+        Number of most frequent identifier pairs scored
+
+    min_npmi : float
+        If set, only the pairs with at least this estimated npmi value are returned
+
+    Returns
+    -------
+    npmi : pandas DataFrame
+        DataFrame of identifier pairs, their estimated count and npmi value, by descending count
+    """
+    approximate = ApproximateNpmi(epsilon=epsilon, delta=delta, top_pairs=top_pairs)
+
+    return approximate.update(dataframe).finalize(min_npmi=min_npmi)
+
 def npmi_data_filter(count_data, npmi_results, min_npmi=0.5):
     """Returns only data records where the npmi for the id pair exceeds a minimum threshold
 
@@ -635,26 +2738,101 @@ def npmi_data_filter(count_data, npmi_results, min_npmi=0.5):
         Only the records of identifier pairs that exceed the npmi threshold
     """
     selected_pairs = npmi_results['npmi'] >= min_npmi
-    pair_list = npmi_results[selected_pairs].drop(columns=['npmi']).reset_index(drop=True)
-    selected_data = pd.merge(count_data, pair_list, on=['element_id1', 'element_id2'])
+    pair_index = pd.MultiIndex.from_frame(npmi_results.loc[selected_pairs, ['element_id1', 'element_id2']])
+    # a hash lookup of each record's pair keeps the records in order without merging
+    selected_records = pd.MultiIndex.from_frame(count_data[['element_id1', 'element_id2']]).isin(pair_index)
+    selected_data = count_data[selected_records].reset_index(drop=True)
 
     return selected_data
 
+def _saved_npmi(accumulator, npmi_counts, source, min_npmi=None):
+    """Calculates the npmi of an accumulator's pairs. If `npmi_counts` is set, the counts saved there are added
+    first and the total saved back, unless they already include `source`, in which case the saved counts are used
+    as they are"""
+    if npmi_counts is None:
+        return accumulator.finalize(min_npmi=min_npmi)
+
+    saved = NpmiAccumulator().load(npmi_counts) if os.path.exists(npmi_counts) else NpmiAccumulator()
+    if source in saved.sources:
+        print("Inputs already counted in " + npmi_counts)
+        return saved.finalize(min_npmi=min_npmi)
+
+    accumulator.sources.add(source)
+    accumulator.merge(saved)
+    accumulator.save(npmi_counts)
+
+    return accumulator.finalize(min_npmi=min_npmi)
+
 def process_data(data1, data2, run_npmi=False, 
     element_id1=None, timestamp1=None, session_start1=None, session_end1=None, boardings1=None, alightings1=None, occupancy1=None, lat1=None, lon1=None,
-    element_id2=None, timestamp2=None, session_start2=None, session_end2=None, boardings2=None, alightings2=None, occupancy2=None, lat2=None, lon2=None):
-    
-    print("Converting to DataFrames")
-    df1 = csv_to_df(data1, element_id=element_id1, timestamp=timestamp1, session_start=session_start1, session_end=session_end1,
-                    boardings=boardings1, alightings=alightings1, occupancy=occupancy1, lat=lat1, lon=lon1)
-    df2 = csv_to_df(data2, element_id=element_id2, timestamp=timestamp2, session_start=session_start2, session_end=session_end2,
-                    boardings=boardings2, alightings=alightings2, occupancy=occupancy2, lat=lat2, lon=lon2)
-    
-    paired = pairwise_filter(df1, df2)
+    element_id2=None, timestamp2=None, session_start2=None, session_end2=None, boardings2=None, alightings2=None, occupancy2=None, lat2=None, lon2=None,
+    chunk_size=None, max_memory=None, engine='auto', compact=False, chunksize=None, cache_dir=None,
+    cache_size=INGEST_CACHE_SIZE, min_npmi=0.5, npmi_counts=None, approximate_npmi=False,
+    detection_distance=50, detection_time=60):
+
+    if run_npmi == True and approximate_npmi and npmi_counts is not None:
+        raise Exception('NPMI counts are only kept between runs for the exact NPMI')
+    # the digests of both inputs name the run in the saved counts, so rerunning the same inputs counts them once
+    npmi_source = _file_digest(data1) + '-' + _file_digest(data2) if npmi_counts is not None else None
+
+    if chunksize is not None:
+        print("Streaming csv chunks of " + str(chunksize) + " records")
+        chunks1 = csv_to_df(data1, element_id=element_id1, timestamp=timestamp1, session_start=session_start1,
+                            session_end=session_end1, boardings=boardings1, alightings=alightings1,
+                            occupancy=occupancy1, lat=lat1, lon=lon1, compact=compact, chunksize=chunksize)
+        chunks2 = csv_to_df(data2, element_id=element_id2, timestamp=timestamp2, session_start=session_start2,
+                            session_end=session_end2, boardings=boardings2, alightings=alightings2,
+                            occupancy=occupancy2, lat=lat2, lon=lon2, compact=compact, chunksize=chunksize)
+        paired_chunks = pairwise_filter_stream(chunks1, chunks2, detection_distance=detection_distance,
+                                               detection_time=detection_time, row_group_size=chunksize)
+        if run_npmi != True:
+            return pd.concat(paired_chunks, ignore_index=True)
+
+        # the chunks are counted as they stream and spilled to disk until the npmi is known, so only the likely
+        # pairs are held together. the kind of accumulator decides between the exact and approximate npmi
+        accumulator = ApproximateNpmi() if approximate_npmi else NpmiAccumulator()
+        scratch = tempfile.mkdtemp(prefix='paired_')
+        try:
+            parts = []
+            for paired_chunk in paired_chunks:
+                accumulator.update(paired_chunk)
+                parts.append(os.path.join(scratch, 'part-%05d.parquet' % len(parts)))
+                paired_chunk.to_parquet(parts[-1], index=False)
+            npmi_results = _saved_npmi(accumulator, npmi_counts, npmi_source, min_npmi=min_npmi)
+            likely_pairs = pd.concat([npmi_data_filter(pd.read_parquet(part), npmi_results, min_npmi=min_npmi)
+                                      for part in parts], ignore_index=True)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        return likely_pairs
+    elif cache_dir is not None:
+        print("Loading DataFrames through the ingestion cache")
+        df1 = cached_csv_to_df(data1, cache_dir, element_id=element_id1, timestamp=timestamp1, session_start=session_start1,
+                               session_end=session_end1, boardings=boardings1, alightings=alightings1, occupancy=occupancy1,
+                               lat=lat1, lon=lon1, compact=compact, cache_size=cache_size)
+        df2 = cached_csv_to_df(data2, cache_dir, element_id=element_id2, timestamp=timestamp2, session_start=session_start2,
+                               session_end=session_end2, boardings=boardings2, alightings=alightings2, occupancy=occupancy2,
+                               lat=lat2, lon=lon2, compact=compact, cache_size=cache_size)
+
+        paired = pairwise_filter(df1, df2, detection_distance=detection_distance, detection_time=detection_time,
+                                 chunk_size=chunk_size, max_memory=max_memory, engine=engine)
+    else:
+        print("Converting to DataFrames")
+        df1 = csv_to_df(data1, element_id=element_id1, timestamp=timestamp1, session_start=session_start1, session_end=session_end1,
+                        boardings=boardings1, alightings=alightings1, occupancy=occupancy1, lat=lat1, lon=lon1, compact=compact)
+        df2 = csv_to_df(data2, element_id=element_id2, timestamp=timestamp2, session_start=session_start2, session_end=session_end2,
+                        boardings=boardings2, alightings=alightings2, occupancy=occupancy2, lat=lat2, lon=lon2, compact=compact)
+
+        paired = pairwise_filter(df1, df2, detection_distance=detection_distance, detection_time=detection_time,
+                                 chunk_size=chunk_size, max_memory=max_memory, engine=engine)
     # if only individually identified data, then process for npmi tagging
     if run_npmi==True:
-        npmi_results = npmi(paired)
-        likely_pairs = npmi_data_filter(paired, npmi_results)
+        if approximate_npmi:
+            npmi_results = npmi_approximate(paired, min_npmi=min_npmi)
+        elif npmi_counts is not None:
+            npmi_results = _saved_npmi(NpmiAccumulator().update(paired), npmi_counts, npmi_source, min_npmi=min_npmi)
+        else:
+            npmi_results = npmi_sparse(paired, min_npmi=min_npmi)
+        likely_pairs = npmi_data_filter(paired, npmi_results, min_npmi=min_npmi)
         return likely_pairs
     # otherwise return all pairs that meet filter requirements without npmi assessment
     else:
@@ -0,0 +1,147 @@
+"""
+.. moduleauthor:: Sylvan Hoover <hooversy@oregonstate.edu>
+
+Compiled kernels for the hot loops of `count_data`. Numba is optional; without it `ENABLED` is False and
+`count_data` keeps to its numpy implementations.
+"""
+
+# standard libraries
+import math
+
+# third-party libraries
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# can be switched off to compare against or fall back to the numpy implementations
+ENABLED = NUMBA_AVAILABLE
+
+def _jit(function):
+    """Compiles a kernel with numba when it is installed, otherwise leaves it as plain python"""
+    if numba is None:
+        return function
+
+    return numba.njit(nogil=True)(function)
+
+@_jit
+def window_pairs(window_low, window_size, d2_order, sort_windows):
+    """Emits the index pairs of a sorted range join from the window of the sorted second dataset matching each
+    record of the first dataset
+
+    Parameters
+    ----------
+    window_low : numpy array
+        Start of each record's window in the sorted second dataset
+
+    window_size : numpy array
+        Number of matching records in each window
+
+    d2_order : numpy array
+        Positions of the sorted second dataset in the original second dataset
+
+    sort_windows : bool
+        Whether the positions within a window need sorting, when the second dataset was not already in time order
+
+    Returns
+    -------
+    i : numpy array
+        Positional indices into the first dataset, ordered by `i` and then `j`
+
+    j : numpy array
+        Positional indices into the second dataset
+    """
+    pair_count = 0
+    for record in range(len(window_size)):
+        pair_count += window_size[record]
+
+    i = np.empty(pair_count, dtype=np.int64)
+    j = np.empty(pair_count, dtype=np.int64)
+    position = 0
+    for record in range(len(window_size)):
+        size = window_size[record]
+        for offset in range(size):
+            i[position + offset] = record
+            j[position + offset] = d2_order[window_low[record] + offset]
+        if sort_windows and size > 1:
+            j[position:position + size] = np.sort(j[position:position + size])
+        position += size
+
+    return i, j
+
+@_jit
+def haversine_mask(lat1, lon1, lat2, lon2, dist_max, lat_max, lon_max):
+    """Marks the pairs of points within `dist_max` meters of each other, skipping the haversine for pairs outside
+    the `lat_max` and `lon_max` degree bounding box
+
+    Parameters
+    ----------
+    lat1, lon1 : numpy array
+        Latitudes and longitudes in degrees of the first points
+
+    lat2, lon2 : numpy array
+        Latitudes and longitudes in degrees of the second points
+
+    dist_max : float
+        Maximum distance between points
+
+    lat_max, lon_max : float
+        Largest latitude and longitude differences in degrees that can be within `dist_max`
+
+    Returns
+    -------
+    close_distance : numpy array
+        Boolean mask of the pairs within `dist_max` of each other
+    """
+    radius = 6378137.0 # meters
+
+    close_distance = np.zeros(len(lat1), dtype=np.bool_)
+    for pair in range(len(lat1)):
+        dlat_degrees = lat2[pair] - lat1[pair]
+        if not abs(dlat_degrees) <= lat_max:
+            continue
+        dlon_degrees = abs(lon2[pair] - lon1[pair])
+        if not min(dlon_degrees, 360.0 - dlon_degrees) <= lon_max:
+            continue
+
+        dlat = math.radians(lat2[pair] - lat1[pair])
+        dlon = math.radians(lon2[pair] - lon1[pair])
+        a = (math.sin(dlat / 2) ** 2 +
+             math.cos(math.radians(lat1[pair])) * math.cos(math.radians(lat2[pair])) * math.sin(dlon / 2) ** 2)
+        close_distance[pair] = radius * (2 * math.asin(math.sqrt(a))) <= dist_max
+
+    return close_distance
+
+@_jit
+def npmi_counts(codes1, codes2, pair_codes, id1_total, id2_total, pair_total):
+    """Counts the occurrences of every identifier and identifier pair in a single pass
+
+    Parameters
+    ----------
+    codes1, codes2 : numpy array
+        Integer code of the first and second identifier of each record
+
+    pair_codes : numpy array
+        Integer code of the identifier pair of each record
+
+    id1_total, id2_total, pair_total : int
+        Number of distinct first identifiers, second identifiers and pairs
+
+    Returns
+    -------
+    ids_count, id1_count, id2_count : numpy array
+        Number of records of each pair, first identifier and second identifier
+    """
+    ids_count = np.zeros(pair_total, dtype=np.int64)
+    id1_count = np.zeros(id1_total, dtype=np.int64)
+    id2_count = np.zeros(id2_total, dtype=np.int64)
+    for record in range(len(pair_codes)):
+        ids_count[pair_codes[record]] += 1
+        id1_count[codes1[record]] += 1
+        id2_count[codes2[record]] += 1
+
+    return ids_count, id1_count, id2_count
@@ -17,7 +17,12 @@ from sklearn.preprocessing import MinMaxScaler
 import pandas as pd
 import numpy as np
 import csv
-import pickle
+
+# local imports
+try:
+    from . import artifacts
+except ImportError:
+    import artifacts
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -32,6 +37,8 @@ class LstmAutoEncoder(object):
         self.config = None
         self.metric = None
         self.threshold = None
+        # the batch size `fit` defaults to, needed to rebuild a saved model in a new process
+        self.batch_size = 1
 
     @staticmethod
     def create_model(batch_size, time_window_size, metric):
@@ -123,9 +130,11 @@ class LstmAutoEncoder(object):
 
 class anomalydetect(object):
 
-    def __init__(self):
+    def __init__(self, store=None):
         self.ae = LstmAutoEncoder()
         self.model_dir_path = os.path.join(THIS_DIR, './models')
+        # results of `week_anomaly_detect` are saved here for the dashboard
+        self.store = store if store is not None else artifacts.ArtifactStore()
 
     def construct_npdata(self, dataframe, testing=False):
         np_data_o1 = dataframe[['occupancy1']].values
@@ -152,6 +161,100 @@ class anomalydetect(object):
 
         return anomaly_information, predicted_timeseries_dataset
 
+    def reconstruction_error(self, location, dataframe, anomaly_information):
+        """Collects the anomaly flag and reconstruction error of each week of a location, or None if the model's
+        threshold is zero"""
+        reconstruction_error = {}
+        if self.ae.threshold == 0.0:
+            return None
+        else:
+            reconstruction_error['threshold'] = self.ae.threshold
+        years = dataframe.index.get_level_values(0).tolist()
+        weeks = dataframe.index.get_level_values(1).tolist()
+        for idx, (is_anomaly, dist) in enumerate(anomaly_information):
+            reconstruction_error[str(years[idx]) + ', ' +str(weeks[idx])] = [is_anomaly, dist]
+            if is_anomaly == True:
+                print(location + ', year ' + str(years[idx]) + ', week ' + str(weeks[idx]) + ' is anomalous')
+
+        return reconstruction_error
+
+    def week_train(self, data, model_dir_path, testing=False):
+        """Fits a model to the weekly samples of each location, saving each in its own directory so detection
+        can be run separately with `week_detect`
+
+        Parameters
+        ----------
+        data : dict
+            Each key in the dictionary is a specific location with the value being a DataFrame of two time-series
+            representing collected data from each source
+
+        model_dir_path : str
+            Directory under which the model of each location is saved
+
+        Returns
+        -------
+        model_dirs : dict
+            Each key is the location with the value being the directory of its model
+        """
+        model_dirs = {}
+
+        for index, (location, dataframe) in enumerate(data.items()):
+            np_data = self.construct_npdata(dataframe.dropna(), testing)
+
+            print('For ' + str(location) + ', ' + str(np_data.shape[0]) + ' weeks training')
+
+            model_dir = os.path.join(model_dir_path, 'location-%05d' % index)
+            os.makedirs(model_dir, exist_ok=True)
+            self.ae.fit(np_data[:, :, :], model_dir_path=model_dir)
+            model_dirs[location] = model_dir
+
+        return model_dirs
+
+    def week_detect(self, data, model_dirs, testing=False):
+        """Assesses likely anomalous weekly samples of each location with the models saved by `week_train`
+
+        Parameters
+        ----------
+        data : dict
+            Each key in the dictionary is a specific location with the value being a DataFrame of two time-series
+            representing collected data from each source
+
+        model_dirs : dict
+            Each key is the location with the value being the directory of its model
+
+        Returns
+        -------
+        reconstruction_dict : dict
+            Each key is the location and error threshold with the value being a list of the reconstruction error 
+            for each sample in the location
+
+        collected_target : dict
+            Each key is the location with the value being the collected differences of each week
+
+        predicted_target : dict
+            Each key is the location with the value being the reconstructed differences of each week
+        """
+        reconstruction_dict = {}
+        collected_target = {}
+        predicted_target = {}
+
+        for location, dataframe in data.items():
+            np_data = self.construct_npdata(dataframe.dropna(), testing)
+
+            print('For ' + str(location) + ', ' + str(np_data.shape[0]) + ' weeks detecting')
+
+            self.ae.load_model(model_dirs[location])
+            anomaly_information, predicted_timeseries_dataset = self.ae.anomaly(np_data[:, :, :])
+
+            reconstruction_error = self.reconstruction_error(location, dataframe, anomaly_information)
+            if reconstruction_error is None:
+                continue
+            reconstruction_dict[location] = reconstruction_error
+            collected_target[location] = np_data[:,:,2]
+            predicted_target[location] = predicted_timeseries_dataset
+
+        return reconstruction_dict, collected_target, predicted_target
+
     def week_anomaly_detect(self, data, testing=False):
         """Takes a dictionary of location, data pairs containing a series of temporal sample and assesses likely
         anomalous samples. The resulting dictionary can be used to identify locations and time periods of likely
@@ -175,7 +278,7 @@ class anomalydetect(object):
         collected_target = {}
         predicted_target = {}
 
-        pickle.dump(data, open('./osm_multiplex/data/lstm_input_data.pickle', 'wb'))
+        self.store.put('lstm_input_data', data)
 
         for location, dataframe in data.items():
             # samples = len(dataframe.index.codes[0])
@@ -187,24 +290,14 @@ class anomalydetect(object):
 
             anomaly_information, predicted_timeseries_dataset = self.fit_detect(np_data)
 
-            reconstruction_error = {}
-            if self.ae.threshold == 0.0:
+            reconstruction_error = self.reconstruction_error(location, dataframe, anomaly_information)
+            if reconstruction_error is None:
                 continue
-            else:
-                reconstruction_error['threshold'] = self.ae.threshold
-            years = dataframe.index.get_level_values(0).tolist()
-            weeks = dataframe.index.get_level_values(1).tolist()
-            for idx, (is_anomaly, dist) in enumerate(anomaly_information):
-                reconstruction_error[str(years[idx]) + ', ' +str(weeks[idx])] = [is_anomaly, dist]
-                if is_anomaly == True:
-                    print(location + ', year ' + str(years[idx]) + ', week ' + str(weeks[idx]) + ' is anomalous')
             reconstruction_dict[location] = reconstruction_error
             collected_target[location] = np_data[:,:,2]
             predicted_target[location] = predicted_timeseries_dataset
 
-        pickle.dump(reconstruction_dict, open('./osm_multiplex/data/lstm_dist.pickle', 'wb'))
-        pickle.dump(collected_target, open('./osm_multiplex/data/lstm_collected_target.pickle', 'wb'))
-        pickle.dump(predicted_target, open('./osm_multiplex/data/lstm_predicted_target.pickle', 'wb'))
+        save_reconstruction(self.store, reconstruction_dict, collected_target, predicted_target)
         return reconstruction_dict
 
     # def rolling_anomaly_detect(self, data):
@@ -351,9 +444,50 @@ class datasamples(object):
     #     return pivoted_dataframes
 
 
-def anomaly_detect(preprocessed_dataframe, detection_type="weekly", locations=None, testing=False):
+def save_reconstruction(store, reconstruction_dict, collected_target, predicted_target):
+    """Saves the weekly results of each location for the dashboard, as memory-mapped arrays per location with a
+    small index of the locations, their thresholds and week labels so a single location or week can be read
+    without loading the rest
+
+    Parameters
+    ----------
+    store : ArtifactStore
+        Store the results are saved to
+
+    reconstruction_dict : dict
+        Each key is a location with the value being its threshold and the anomaly flag and reconstruction error
+        of each week, as returned by `anomalydetect.week_anomaly_detect`
+
+    collected_target : dict
+        Each key is a location with the value being the collected difference of each week
+
+    predicted_target : dict
+        Each key is a location with the value being the predicted difference of each week
+    """
+    index = {}
+    distance = {}
+    for location, results in reconstruction_dict.items():
+        weeks = [week for week in results if week != 'threshold']
+        index[location] = {'threshold': results['threshold'], 'weeks': weeks}
+        distance[location] = np.array([results[week][1] for week in weeks], dtype=np.float64)
+
+    if not distance:
+        # the empty index is written first, so the dashboard never lists locations whose arrays are gone
+        store.put('lstm_index', index)
+        for name in ['lstm_distance', 'lstm_collected_target', 'lstm_predicted_target']:
+            if name in store:
+                store.delete(name)
+        return
+
+    store.put('lstm_distance', distance)
+    store.put('lstm_collected_target', {location: np.asarray(collected_target[location]) for location in index})
+    store.put('lstm_predicted_target', {location: np.asarray(predicted_target[location]) for location in index})
+    # written last as the dashboard reads the arrays of the locations it lists
+    store.put('lstm_index', index)
+
+def anomaly_detect(preprocessed_dataframe, detection_type="weekly", locations=None, testing=False, store=None):
     sampler = datasamples()
-    ad = anomalydetect()
+    ad = anomalydetect(store=store)
 
     if detection_type == "weekly":
         sampled = sampler.weekly_sample(preprocessed_dataframe, locations=locations)
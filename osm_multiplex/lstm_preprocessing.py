@@ -8,10 +8,14 @@ import osmnx as ox
 import numpy as np
 
 # local imports
-import count_data
-import osm_download
-
-def spatial_grouping(dataframe, location_selection='1', mode='all'):
+try:
+    from . import count_data
+    from . import osm_download
+except ImportError:
+    import count_data
+    import osm_download
+
+def spatial_grouping(dataframe, location_selection='1', mode='all', cache=None):
     """Assigns a single location to the data records. The data records can choose the location of dataset 1,
     the location of dataset 2, or get a location assignment based on an osm-derived network.
 
@@ -29,6 +33,9 @@ def spatial_grouping(dataframe, location_selection='1', mode='all'):
     mode : str
         Mode choice of  {‘walk’, ‘bike’, ‘drive’, ‘drive_service’, ‘all’, ‘all_private’, ‘none’}
 
+    cache : OsmLayerCache
+        If set, the osm layer is read from and written to this cache
+
     Returns
     -------
     single_location : pandas DataFrame
@@ -39,11 +46,11 @@ def spatial_grouping(dataframe, location_selection='1', mode='all'):
     if location_selection == '2':
         single_location = dataframe.drop(columns=['lat1', 'lon1']).rename(index=str, columns={"lat2": "lat", "lon2": "lon"})
     if location_selection == 'osm':
-        single_location = assign_osm(dataframe, mode)
+        single_location = assign_osm(dataframe, mode, cache=cache)
 
     return single_location.reset_index(drop=True)
 
-def assign_osm(dataframe, mode='all'):
+def assign_osm(dataframe, mode='all', cache=None):
     """Assigns an OSM node by taking the average location of the two datasets and finding the nearest node present in the
     mode layer.
 
@@ -55,6 +62,9 @@ def assign_osm(dataframe, mode='all'):
     mode : str
         Mode choice of  {‘walk’, ‘bike’, ‘drive’, ‘drive_service’, ‘all’, ‘all_private’, ‘none’}
 
+    cache : OsmLayerCache
+        If set, the layer is read from this cache when present and written to it when downloaded
+
     Returns
     -------
     df_osm_location : pandas DataFrame
@@ -66,7 +76,7 @@ def assign_osm(dataframe, mode='all'):
     max_lon = dataframe[['lon1', 'lon2']].max().max()
     min_lon = dataframe[['lon1', 'lon2']].min().min()
 
-    osm_layer = osm_download.download_osm_layer([max_lat, min_lat, max_lon, min_lon], mode)
+    osm_layer = osm_download.download_osm_layer([max_lat, min_lat, max_lon, min_lon], mode, cache=cache)
     osm_nodes = pd.DataFrame([[node[0], node[1]['y'], node[1]['x']] for node in osm_layer.nodes(data=True)],
                              columns=['osm_id', 'lat', 'lon']).set_index('osm_id')
 
@@ -0,0 +1,174 @@
+"""
+.. moduleauthor:: Sylvan Hoover <hooversy@oregonstate.edu>
+
+Compact representation of the multiplex graph as integer-indexed arrays, with the outgoing edges of each node in
+compressed sparse row (CSR) order. Saved arrays are memory mapped when loaded, so a large multiplex can be opened
+without reading it into memory and converted back to NetworkX only when needed.
+"""
+
+# third-party libraries
+import networkx as nx
+import numpy as np
+
+# local imports
+try:
+    from . import artifacts
+except ImportError:
+    import artifacts
+
+# arrays of a `CsrMultiplex`, as saved by `CsrMultiplex.save`
+ARRAYS = ['osm_ids', 'node_modes', 'lat', 'lon', 'indptr', 'targets', 'weights', 'edge_modes', 'transfers']
+
+class CsrMultiplex(object):
+    """Multiplex graph as arrays. Node `i` is OSM node `osm_ids[i]` in the layer of mode `modes[node_modes[i]]`,
+    located at `lat[i]`, `lon[i]`. The outgoing edges of node `i` are the positions `indptr[i]` to
+    `indptr[i + 1]` of the edge arrays, with `targets` holding the node each edge leads to, `weights` its weight,
+    `edge_modes` the mode code of the layer it starts in and `transfers` whether it connects co-located nodes of
+    different layers
+
+    Parameters
+    ----------
+    modes : list
+        Names of the modes, indexed by the mode codes
+
+    **arrays
+        Each of `ARRAYS`
+    """
+    def __init__(self, modes, **arrays):
+        self.modes = list(modes)
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def node_count(self):
+        return len(self.osm_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    @classmethod
+    def from_networkx(cls, multiplex, weight='length'):
+        """Converts a multiplex graph whose nodes are named 'mode-number', as from `osm_download.generate_multiplex`
+
+        Parameters
+        ----------
+        multiplex : networkx multidigraph
+            Multiplex graph with the latitude and longitude of each node as the 'y' and 'x' attributes
+
+        weight : str
+            Edge attribute used as the edge weights. Transfer edges without it have a weight of zero and other
+            edges without it have a weight of nan
+
+        Returns
+        -------
+        csr_multiplex : CsrMultiplex
+            The multiplex graph as arrays
+        """
+        node_count = multiplex.number_of_nodes()
+        modes = []
+        mode_codes = {}
+        node_modes = np.empty(node_count, dtype=np.int16)
+        osm_ids = np.empty(node_count, dtype=np.int64)
+        lat = np.full(node_count, np.nan)
+        lon = np.full(node_count, np.nan)
+        positions = {}
+        for position, (node, attributes) in enumerate(multiplex.nodes(data=True)):
+            mode, separator, osm_id = str(node).partition('-')
+            if not separator:
+                raise Exception('Node ' + str(node) + ' is not named by mode and number')
+            if mode not in mode_codes:
+                mode_codes[mode] = len(modes)
+                modes.append(mode)
+            node_modes[position] = mode_codes[mode]
+            osm_ids[position] = int(osm_id)
+            lat[position] = attributes.get('y', np.nan)
+            lon[position] = attributes.get('x', np.nan)
+            positions[node] = position
+
+        sources = np.empty(multiplex.number_of_edges(), dtype=np.int64)
+        targets = np.empty(multiplex.number_of_edges(), dtype=np.int64)
+        weights = np.full(multiplex.number_of_edges(), np.nan)
+        for position, (start_node, end_node, value) in enumerate(multiplex.edges(data=weight)):
+            sources[position] = positions[start_node]
+            targets[position] = positions[end_node]
+            if value is not None:
+                weights[position] = value
+
+        transfers = node_modes[sources] != node_modes[targets]
+        weights[transfers & np.isnan(weights)] = 0
+
+        # edges ordered by the node they start from, keeping the order of parallel edges
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+
+        return cls(modes, osm_ids=osm_ids, node_modes=node_modes, lat=lat, lon=lon, indptr=indptr,
+                   targets=targets[order], weights=weights[order], edge_modes=node_modes[sources[order]],
+                   transfers=transfers[order])
+
+    def node_names(self):
+        """Name of each node as 'mode-number'"""
+        return [self.modes[mode] + '-' + str(osm_id) for mode, osm_id in zip(self.node_modes, self.osm_ids)]
+
+    def sources(self):
+        """Index of the node each edge starts from"""
+        return np.repeat(np.arange(self.node_count), np.diff(self.indptr))
+
+    def to_networkx(self, weight='length'):
+        """Converts back to a NetworkX multiplex graph. Only the coordinates of the nodes and the weights of the
+        edges are kept, with transfer edges having no attributes as from `osm_download.merge_multiplex_nodes`
+
+        Parameters
+        ----------
+        weight : str
+            Edge attribute the edge weights are set to
+
+        Returns
+        -------
+        multiplex : networkx multidigraph
+            The multiplex graph
+        """
+        names = self.node_names()
+        multiplex = nx.MultiDiGraph()
+        multiplex.add_nodes_from((name, {'y': float(lat), 'x': float(lon)})
+                                 for name, lat, lon in zip(names, self.lat, self.lon))
+
+        edge_attributes = ({} if transfer or np.isnan(value) else {weight: float(value)}
+                           for value, transfer in zip(self.weights, self.transfers))
+        multiplex.add_edges_from((names[start], names[end], attributes) for start, end, attributes
+                                 in zip(self.sources(), self.targets, edge_attributes))
+
+        return multiplex
+
+    def save(self, path):
+        """Writes the arrays to a directory as `.npy` files, replacing any saved there before
+
+        Parameters
+        ----------
+        path : str
+            Directory of the arrays
+        """
+        artifacts.ArtifactStore(path).put('multiplex', {name: np.asarray(getattr(self, name)) for name in ARRAYS},
+                                          metadata={'modes': self.modes})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Reads arrays written by `save`
+
+        Parameters
+        ----------
+        path : str
+            Directory of the arrays
+
+        mmap : bool
+            Whether the arrays are memory mapped rather than read into memory
+
+        Returns
+        -------
+        csr_multiplex : CsrMultiplex
+            The saved multiplex graph
+        """
+        store = artifacts.ArtifactStore(path)
+
+        return cls(store.metadata('multiplex')['modes'], **store.get('multiplex', mmap=mmap))
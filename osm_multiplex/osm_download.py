@@ -3,15 +3,190 @@
 """
 
 # standard libraries
-import copy
-import re
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
 
 # third-party libraries
 import osmnx as ox
 import networkx as nx
 
-def generate_multiplex(area, modes):
-    """Create multiplex transportation network graph from OSM
+LAYER_CACHE_DIR = './osm_multiplex/data/osm_layers'
+
+# seconds a cached layer is used before it is downloaded again
+LAYER_CACHE_TTL = 30 * 86400
+
+LAYER_CACHE_SIZE = 2 * 1024**3
+
+# concurrent OSM downloads, kept low as the Overpass API limits requests per client
+DOWNLOAD_WORKERS = 4
+
+# degrees of latitude and longitude on each side of a tile
+TILE_SIZE = 0.05
+
+class OsmLayerCache(object):
+    """On-disk cache of downloaded OSM layers, keyed by the area, with place names normalized and bounding boxes
+    rounded, the network type and whether the layer is simplified. Layers are pickled with the highest protocol so
+    every OSM attribute, including edge geometries, is kept, with the time each was written and its request in a
+    small json file beside it. Layers older than `ttl` seconds are downloaded again without being read, and the
+    least recently used layers are removed once the cache exceeds `cache_size` bytes
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache, created when the first layer is written
+
+    ttl : int
+        Seconds a cached layer is used before it expires
+
+    cache_size : int
+        Size in bytes the cache is trimmed to after a layer is written
+
+    offline : bool
+        Whether layers are only read from the cache, with expired layers still used and missing layers raising an
+        exception rather than being downloaded
+
+    precision : int
+        Decimal places bounding boxes are rounded to in the keys
+    """
+    def __init__(self, cache_dir=LAYER_CACHE_DIR, ttl=LAYER_CACHE_TTL, cache_size=LAYER_CACHE_SIZE, offline=False,
+                 precision=4):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.offline = offline
+        self.precision = precision
+
+    def key(self, area, mode, simplify=True, truncate_by_edge=False, retain_all=False):
+        """Key of a layer from its normalized area, network type, simplification, truncation and whether it keeps
+        every connected component"""
+        if isinstance(area, str):
+            normalized = ' '.join(area.lower().replace(',', ', ').split())
+        elif isinstance(area, list) and len(area) == 4:
+            normalized = [round(float(bound), self.precision) for bound in area]
+        else:
+            raise Exception('Graph area not geocoded place nor bounding box')
+        key = json.dumps({'area': normalized, 'network_type': mode, 'simplify': simplify,
+                          'truncate_by_edge': truncate_by_edge, 'retain_all': retain_all}, sort_keys=True)
+
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _entry(self, area, mode, simplify, truncate_by_edge, retain_all):
+        return os.path.join(self.cache_dir, self.key(area, mode, simplify, truncate_by_edge, retain_all) + '.pickle')
+
+    @staticmethod
+    def _written_path(entry):
+        return entry[:-len('.pickle')] + '.json'
+
+    def _replace(self, path, write):
+        """Writes a file under a unique temporary name and renames it into place, so an interrupted or concurrent
+        write never leaves a partial file"""
+        descriptor, partial = tempfile.mkstemp(dir=self.cache_dir, suffix='.partial')
+        try:
+            with os.fdopen(descriptor, 'wb') as partial_file:
+                write(partial_file)
+            os.replace(partial, path)
+        except BaseException:
+            os.remove(partial)
+            raise
+
+    def get(self, area, mode, simplify=True, truncate_by_edge=False, retain_all=False):
+        """Cached layer of a mode and area, or None if it is not cached or has expired
+
+        Parameters
+        ----------
+        area : str or list
+            String of geocoded place or list of [north, south, east, west]
+
+        mode : str
+            Network type of the layer
+
+        simplify : bool
+            Whether the layer is simplified
+
+        truncate_by_edge : bool
+            Whether the layer keeps the nodes outside the area of edges crossing into it
+
+        retain_all : bool
+            Whether the layer keeps the components not connected to its largest component
+
+        Returns
+        -------
+        layer : networkx multidigraph
+            The cached OSM map layer
+        """
+        entry = self._entry(area, mode, simplify, truncate_by_edge, retain_all)
+        if not (os.path.exists(entry) and os.path.exists(self._written_path(entry))):
+            if self.offline == True:
+                raise Exception('No cached ' + mode + ' layer of ' + str(area) + ' while offline')
+            return None
+
+        with open(self._written_path(entry)) as written_file:
+            written = json.load(written_file)['written']
+        if self.offline == False and time.time() - written > self.ttl:
+            return None
+        with open(entry, 'rb') as entry_file:
+            layer = pickle.load(entry_file)
+        # marks the entry as recently used for eviction
+        os.utime(entry)
+
+        return layer
+
+    def put(self, area, mode, layer, simplify=True, truncate_by_edge=False, retain_all=False):
+        """Writes a downloaded layer to the cache, then trims the cache to its size
+
+        Parameters
+        ----------
+        area : str or list
+            String of geocoded place or list of [north, south, east, west]
+
+        mode : str
+            Network type of the layer
+
+        layer : networkx multidigraph
+            The OSM map layer
+
+        simplify : bool
+            Whether the layer is simplified
+
+        truncate_by_edge : bool
+            Whether the layer keeps the nodes outside the area of edges crossing into it
+
+        retain_all : bool
+            Whether the layer keeps the components not connected to its largest component
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = self._entry(area, mode, simplify, truncate_by_edge, retain_all)
+        written = json.dumps({'written': time.time(), 'area': area, 'network_type': mode})
+        self._replace(entry, lambda entry_file: pickle.dump(layer, entry_file, protocol=pickle.HIGHEST_PROTOCOL))
+        # written after the layer, so a layer replaced mid-read is at worst taken as older than it is
+        self._replace(self._written_path(entry), lambda written_file: written_file.write(written.encode()))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used layers until the cache is no larger than `cache_size` bytes"""
+        entries = [os.path.join(self.cache_dir, entry) for entry in os.listdir(self.cache_dir)
+                   if entry.endswith('.pickle')]
+        entries = sorted(entries, key=lambda entry: os.stat(entry).st_mtime_ns)
+        cache_total = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries:
+            if cache_total <= self.cache_size:
+                break
+            cache_total -= os.path.getsize(entry)
+            os.remove(entry)
+            if os.path.exists(self._written_path(entry)):
+                os.remove(self._written_path(entry))
+
+def generate_multiplex(area, modes, workers=None, simplify=True, cache=None):
+    """Create multiplex transportation network graph from OSM. The layers of the modes are downloaded
+    concurrently, each being simplified in a separate process as soon as it is downloaded
 
     Parameters
     ----------
@@ -21,23 +196,261 @@ def generate_multiplex(area, modes):
     modes : list
         Modes included in multiplex graph
 
+    workers : int
+        Number of processes simplifying layers, defaulting to the number of processors
+
+    simplify : bool
+        Whether each layer's graph topology is simplified
+
+    cache : OsmLayerCache
+        If set, layers are read from this cache when present and written to it when downloaded
+
+    Returns
+    -------
+    multiplex : networkx multidigraph
+        Multiplex graph of merged OSM layers for all specified modes
+    """
+
+    layers = _fetch_layers({mode: (area, mode) for mode in modes}, simplify=simplify, workers=workers, cache=cache)
+
+    separated_multiplex = combine_layers({mode: layers[mode] for mode in modes})
+
+    multiplex = merge_multiplex_nodes(separated_multiplex)
+
+    return multiplex
+
+def bbox_tiles(area, tile_size=TILE_SIZE):
+    """Tiles of a fixed grid of `tile_size` degrees covering a bounding box. The grid is aligned to whole
+    multiples of `tile_size`, so overlapping areas share the same tiles
+
+    Parameters
+    ----------
+    area : list
+        Bounding box as [north, south, east, west]
+
+    tile_size : float
+        Degrees of latitude and longitude on each side of a tile
+
+    Returns
+    -------
+    tiles : list
+        Bounding box of each tile as [north, south, east, west]
+    """
+    if not (isinstance(area, list) and len(area) == 4):
+        raise Exception('Tiled graph area must be a bounding box')
+    north, south, east, west = area
+    # the small tolerance keeps bounds on a grid line from adding an empty row or column of tiles
+    rows = range(math.floor(south / tile_size + 1e-9), math.ceil(north / tile_size - 1e-9))
+    columns = range(math.floor(west / tile_size + 1e-9), math.ceil(east / tile_size - 1e-9))
+
+    return [[round((row + 1) * tile_size, 9), round(row * tile_size, 9),
+             round((column + 1) * tile_size, 9), round(column * tile_size, 9)] for row in rows for column in columns]
+
+def stitch_tiles(tile_layers):
+    """Joins the layers of a mode's tiles into one layer. Tiles are downloaded keeping the nodes just outside them
+    of edges crossing their boundary, so those edges and nodes appear in both neighbouring tiles under the same
+    OSM ids and are joined rather than duplicated
+
+    Parameters
+    ----------
+    tile_layers : list
+        Unsimplified OSM map layer of each tile
+
+    Returns
+    -------
+    layer : networkx multidigraph
+        OSM map layer of the tiles
+    """
+    layer = nx.MultiDiGraph()
+    for tile_layer in tile_layers:
+        layer.graph.update(tile_layer.graph)
+        layer.add_nodes_from(tile_layer.nodes(data=True))
+        layer.add_edges_from(tile_layer.edges(keys=True, data=True))
+
+    return layer
+
+def truncate_layer(layer, area):
+    """Keeps the nodes of a layer inside a bounding box and the edges between them, removing the nodes left without
+    edges, as osmnx does for a layer downloaded without `truncate_by_edge`
+
+    Parameters
+    ----------
+    layer : networkx multidigraph
+        OSM map layer
+
+    area : list
+        Bounding box as [north, south, east, west]
+
+    Returns
+    -------
+    layer : networkx multidigraph
+        OSM map layer within the bounding box
+    """
+    north, south, east, west = area
+    inside = [node for node, attributes in layer.nodes(data=True)
+              if south <= attributes['y'] <= north and west <= attributes['x'] <= east]
+    layer = layer.subgraph(inside).copy()
+    layer.remove_nodes_from(list(nx.isolates(layer)))
+
+    return layer
+
+def largest_component(layer):
+    """Keeps the largest weakly connected component of a layer, as osmnx does for a layer downloaded whole without
+    `retain_all`
+
+    Parameters
+    ----------
+    layer : networkx multidigraph
+        OSM map layer
+
+    Returns
+    -------
+    layer : networkx multidigraph
+        OSM map layer of its largest component
+    """
+    if layer.number_of_nodes() == 0:
+        return layer
+
+    return layer.subgraph(max(nx.weakly_connected_components(layer), key=len)).copy()
+
+def generate_tiled_multiplex(area, modes, tile_size=TILE_SIZE, workers=None, simplify=True, cache=None,
+                             refresh_area=None, retain_all=False):
+    """Create multiplex transportation network graph from OSM a tile at a time, for areas too large to request
+    at once. The unsimplified layer of each mode and tile is downloaded concurrently, or read from the cache, and
+    the tiles of each mode are stitched along their shared boundary nodes before the layer is simplified, so
+    simplification sees whole streets rather than pieces cut at tile edges. Tiles keep every connected component,
+    as a street leaving a tile and coming back into it is only connected through its neighbour, so only the
+    stitched layer is reduced to its largest component. The stitched layers are truncated to the bounding box, so
+    the multiplex has the nodes a single download of the area would
+
+    Parameters
+    ----------
+    area : list
+        Bounding box as [north, south, east, west]
+
+    modes : list
+        Modes included in multiplex graph
+
+    tile_size : float
+        Degrees of latitude and longitude on each side of a tile
+
+    workers : int
+        Number of processes simplifying layers, defaulting to the number of processors
+
+    simplify : bool
+        Whether each stitched layer's graph topology is simplified
+
+    cache : OsmLayerCache
+        If set, tiles are read from this cache when present and written to it when downloaded
+
+    refresh_area : list
+        If set, bounding box as [north, south, east, west] of an area whose tiles are downloaded again, even if
+        they are cached
+
+    retain_all : bool
+        Whether each stitched layer keeps the components not connected to its largest component
+
     Returns
     -------
     multiplex : networkx multidigraph
         Multiplex graph of merged OSM layers for all specified modes
     """
 
-    separated_multiplex = nx.MultiDiGraph()
+    tiles = bbox_tiles(area, tile_size)
+    requests = {(mode, position): (tile, mode) for mode in modes for position, tile in enumerate(tiles)}
+    refresh = set()
+    if refresh_area is not None:
+        refresh_tiles = bbox_tiles(refresh_area, tile_size)
+        refresh = {(mode, position) for (mode, position), (tile, _) in requests.items() if tile in refresh_tiles}
+
+    tile_layers = _fetch_layers(requests, simplify=False, cache=cache, truncate_by_edge=True, retain_all=True,
+                                refresh=refresh)
+    layers = {mode: truncate_layer(stitch_tiles([tile_layers[(mode, position)] for position in range(len(tiles))]),
+                                   area)
+              for mode in modes}
+    if retain_all == False:
+        layers = {mode: largest_component(layer) for mode, layer in layers.items()}
 
-    for mode in modes:
-        layer = download_osm_layer(area, mode)
-        separated_multiplex = nx.union(layer, separated_multiplex, rename=(mode, None))
+    if simplify == True:
+        with _simplify_pool(workers) as simplify_pool:
+            layers = dict(zip(modes, simplify_pool.map(simplify_layer, [layers[mode] for mode in modes])))
+
+    separated_multiplex = combine_layers(layers)
 
     multiplex = merge_multiplex_nodes(separated_multiplex)
 
     return multiplex
 
-def download_osm_layer(area, mode):
+def _simplify_pool(workers=None):
+    """Pool of processes simplifying layers. They are spawned rather than forked, as a fork while download threads
+    run, or after they ran, can copy locks they hold into the child"""
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def _fetch_layers(requests, simplify=True, workers=None, cache=None, truncate_by_edge=False, retain_all=False,
+                  refresh=()):
+    """Reads the requested layers from the cache or downloads them concurrently, simplifying each downloaded layer
+    in a separate process as soon as it arrives. The cache is only used from this thread
+
+    Parameters
+    ----------
+    requests : dict
+        Each key names a layer with the value being its area and mode
+
+    refresh : collection
+        Names of layers downloaded even if they are cached
+
+    Returns
+    -------
+    layers : dict
+        Each key names a layer with the value being the layer
+    """
+    layers = {}
+    if cache is not None:
+        for name, (area, mode) in requests.items():
+            if name in refresh:
+                continue
+            layer = cache.get(area, mode, simplify=simplify, truncate_by_edge=truncate_by_edge,
+                              retain_all=retain_all)
+            if layer is not None:
+                layers[name] = layer
+    missing = [name for name in requests if name not in layers]
+    if not missing:
+        return layers
+    if cache is not None and cache.offline == True:
+        raise Exception('Layers ' + ', '.join(str(name) for name in missing) + ' must be refreshed while offline')
+
+    if simplify == True:
+        simplify_pool = _simplify_pool(workers)
+    else:
+        simplify_pool = None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(missing), DOWNLOAD_WORKERS)) as download_pool:
+            downloads = {download_pool.submit(download_osm_layer, requests[name][0], requests[name][1],
+                                              simplify=False, truncate_by_edge=truncate_by_edge,
+                                              retain_all=retain_all): name
+                         for name in missing}
+            simplified = {}
+            for download in concurrent.futures.as_completed(downloads):
+                name = downloads[download]
+                if simplify_pool is not None:
+                    simplified[simplify_pool.submit(simplify_layer, download.result())] = name
+                else:
+                    layers[name] = download.result()
+        for simplification in concurrent.futures.as_completed(simplified):
+            layers[simplified[simplification]] = simplification.result()
+    finally:
+        if simplify_pool is not None:
+            simplify_pool.shutdown()
+
+    if cache is not None:
+        for name in missing:
+            area, mode = requests[name]
+            cache.put(area, mode, layers[name], simplify=simplify, truncate_by_edge=truncate_by_edge,
+                      retain_all=retain_all)
+
+    return layers
+
+def download_osm_layer(area, mode, simplify=True, cache=None, truncate_by_edge=False, retain_all=False):
     """Download a single-mode layer from OSM
 
     Parameters
@@ -48,24 +461,89 @@ def download_osm_layer(area, mode):
     mode : str
         Mode choice of  {‘walk’, ‘bike’, ‘drive’, ‘drive_service’, ‘all’, ‘all_private’, ‘none’}
 
+    simplify : bool
+        Whether the layer's graph topology is simplified
+
+    cache : OsmLayerCache
+        If set, the layer is read from this cache when present and written to it when downloaded
+
+    truncate_by_edge : bool
+        Whether to keep the nodes outside the area of edges crossing into it
+
+    retain_all : bool
+        Whether to keep the components not connected to the largest component
+
     Returns
     -------
     layer : networkx multidigraph
         OSM map layer of specific mode
     """
 
+    if cache is not None:
+        layer = cache.get(area, mode, simplify=simplify, truncate_by_edge=truncate_by_edge, retain_all=retain_all)
+        if layer is not None:
+            return layer
+
     if isinstance(area, str):
-        layer = ox.graph_from_place(area, network_type=mode)
+        layer = ox.graph_from_place(area, network_type=mode, simplify=simplify, truncate_by_edge=truncate_by_edge,
+                                    retain_all=retain_all)
     elif isinstance(area, list) and len(area) == 4:
-        layer = ox.graph_from_bbox(area[0], area[1], area[2], area[3], network_type=mode)
+        layer = ox.graph_from_bbox(area[0], area[1], area[2], area[3], network_type=mode, simplify=simplify,
+                                   truncate_by_edge=truncate_by_edge, retain_all=retain_all)
     else:
         raise Exception('Graph area not geocoded place nor bounding box')
 
+    if cache is not None:
+        cache.put(area, mode, layer, simplify=simplify, truncate_by_edge=truncate_by_edge, retain_all=retain_all)
+
     return layer
 
+def simplify_layer(layer):
+    """Simplifies the topology of a downloaded layer, keeping only the nodes at intersections and dead ends
+
+    Parameters
+    ----------
+    layer : networkx multidigraph
+        Unsimplified OSM map layer
+
+    Returns
+    -------
+    layer : networkx multidigraph
+        Simplified OSM map layer
+    """
+
+    return ox.simplify_graph(layer)
+
+def combine_layers(layers):
+    """Combines single-mode layers into one graph in a single pass, naming each node 'mode-number' by its layer's
+    mode and OSM node id
+
+    Parameters
+    ----------
+    layers : dict
+        Each key is a mode with the value being its OSM map layer
+
+    Returns
+    -------
+    multiplex_separated : networkx multidigraph
+        Multiplex network w/ each mode in an isolated layer
+    """
+
+    multiplex_separated = nx.MultiDiGraph()
+    for mode, layer in layers.items():
+        prefix = mode + '-'
+        multiplex_separated.graph.update(layer.graph)
+        multiplex_separated.add_nodes_from((prefix + str(node), attributes)
+                                           for node, attributes in layer.nodes(data=True))
+        multiplex_separated.add_edges_from((prefix + str(start_node), prefix + str(end_node), key, attributes)
+                                           for start_node, end_node, key, attributes
+                                           in layer.edges(keys=True, data=True))
+
+    return multiplex_separated
+
 def merge_multiplex_nodes(multiplex_separated):
     """In the multiplex graph, each mode has its own layer of nodes and edges. Nodes are
-    represented by a mode prefix and a node number. In order to allow inter-mode movement,
+    represented by a mode prefix and a node number, as 'mode-number'. In order to allow inter-mode movement,
     a zero-cost edge needs to be created between co-located nodes for different modes.
 
     Parameters
@@ -79,20 +557,17 @@ def merge_multiplex_nodes(multiplex_separated):
         Multiplex network with co-located nodes connected
     """
 
-    node_list = list(multiplex_separated.nodes)
-    node_list_all = copy.deepcopy(node_list)
-    node_num = []
-    for node in node_list:
-        node_num.append(re.sub('^.*?-', '', node))
-    node_set = set(node_num) # returns set of distinct OSM node id
+    # parse each node once, grouping the nodes of every mode by OSM node id
+    colocated = collections.defaultdict(list)
+    for node in multiplex_separated.nodes:
+        mode, separator, osm_id = str(node).partition('-')
+        if separator:
+            colocated[osm_id].append(node)
 
-    for node in node_set:
-        colocated_nodes = [mode_node for mode_node in node_list_all if node in mode_node]
-        for start_node in colocated_nodes:
-            for end_node in colocated_nodes:
-                multiplex_separated.add_edge(start_node, end_node)
-            multiplex_separated.remove_edge(start_node, start_node)
+    transfers = ((start_node, end_node) for nodes in colocated.values() if len(nodes) > 1
+                 for start_node in nodes for end_node in nodes if start_node != end_node)
+    multiplex_separated.add_edges_from(transfers)
 
-    multiplex_connected = multiplex_separated # only after above loop added the necessary edges
+    multiplex_connected = multiplex_separated # only after the transfer edges are added
 
-    return multiplex_connected
\ No newline at end of file
+    return multiplex_connected
@@ -0,0 +1,270 @@
+"""
+.. moduleauthor:: Sylvan Hoover <hooversy@oregonstate.edu>
+
+Staged pipeline from the counter csv files to anomaly detection. The output of every stage is checkpointed under
+a hash of the stage's parameters and the hash of the stage before it, so a rerun skips every stage whose inputs
+and parameters are unchanged and starts from the first one that changed.
+"""
+
+# standard libraries
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# local imports
+try:
+    from . import artifacts
+    from . import count_data
+    from . import lstm
+    from . import lstm_preprocessing
+except ImportError:
+    import artifacts
+    import count_data
+    import lstm
+    import lstm_preprocessing
+
+CHECKPOINT_DIR = './osm_multiplex/data/checkpoints'
+
+DEFAULT_PARAMETERS = {
+    'headers1': {},
+    'headers2': {},
+    'compact': False,
+    'session_limit': 600,
+    'detection_time': 60,
+    'detection_distance': 50,
+    'engine': 'auto',
+    'chunk_size': None,
+    'max_memory': None,
+    'run_npmi': False,
+    'min_npmi': 0.5,
+    'approximate_npmi': False,
+    'locations': None,
+    'testing': False,
+}
+
+# parameters naming input files, whose content is hashed into the checkpoint keys
+FILE_PARAMETERS = ['data1', 'data2', 'locations']
+
+def _ingest(inputs, input_dir, stage_dir, parameters):
+    """Reads both csv files with their headers set and times in unix time"""
+    outputs = {}
+    for suffix in ['1', '2']:
+        df_imported = count_data.csv_to_df(parameters['data' + suffix], compact=parameters['compact'],
+                                           **parameters['headers' + suffix])
+        outputs['data' + suffix] = count_data.standardize_epoch(df_imported).reset_index(drop=True)
+
+    return outputs
+
+def _session_filter(inputs, input_dir, stage_dir, parameters):
+    """Filters long sessions and appends the dataset suffixes to the column names"""
+    outputs = {}
+    for suffix in ['1', '2']:
+        filtered = count_data.session_length_filter(inputs['data' + suffix], session_max=parameters['session_limit'])
+        outputs['data' + suffix] = filtered.add_suffix(suffix)
+
+    return outputs
+
+def _join(inputs, input_dir, stage_dir, parameters):
+    """Range joins the datasets on time and distance together, so the pairs only close in time are never kept"""
+    paired = count_data.pairwise_join(inputs['data1'], inputs['data2'],
+                                      detection_distance=parameters['detection_distance'],
+                                      detection_time=parameters['detection_time'], chunk_size=parameters['chunk_size'],
+                                      max_memory=parameters['max_memory'], engine=parameters['engine'])
+
+    return {'paired': paired}
+
+def _npmi(inputs, input_dir, stage_dir, parameters):
+    """Keeps the pairs of identifiers with a high npmi, if npmi filtering is on"""
+    paired = inputs['paired']
+    if parameters['run_npmi'] == True:
+        if parameters['approximate_npmi'] == True:
+            npmi_results = count_data.npmi_approximate(paired, min_npmi=parameters['min_npmi'])
+        else:
+            npmi_results = count_data.npmi_sparse(paired, min_npmi=parameters['min_npmi'])
+        paired = count_data.npmi_data_filter(paired, npmi_results, min_npmi=parameters['min_npmi'])
+
+    return {'likely_pairs': paired}
+
+def _preprocess(inputs, input_dir, stage_dir, parameters):
+    """Groups the likely pairs by location and time for the LSTM"""
+    return {'preprocessed': lstm_preprocessing.preprocess(inputs['likely_pairs'])}
+
+def _sample(inputs, input_dir, stage_dir, parameters):
+    """Splits the grouped counts into weekly samples for each location"""
+    sampled = lstm.datasamples().weekly_sample(inputs['preprocessed'], locations=parameters['locations'])
+
+    return {'sampled': sampled}
+
+def _train(inputs, input_dir, stage_dir, parameters):
+    """Fits a model for each location, saved within the checkpoint"""
+    model_dirs = lstm.anomalydetect().week_train(inputs['sampled'], os.path.join(stage_dir, 'models'),
+                                                 testing=parameters['testing'])
+    models = {location: os.path.relpath(model_dir, stage_dir) for location, model_dir in model_dirs.items()}
+
+    return {'sampled': inputs['sampled'], 'models': models}
+
+def _detect(inputs, input_dir, stage_dir, parameters):
+    """Assesses the weekly samples of each location with its trained model"""
+    model_dirs = {location: os.path.join(input_dir, model_dir) for location, model_dir in inputs['models'].items()}
+    anomalies, collected_target, predicted_target = lstm.anomalydetect().week_detect(inputs['sampled'], model_dirs,
+                                                                                    testing=parameters['testing'])
+
+    return {'anomalies': anomalies, 'collected_target': collected_target, 'predicted_target': predicted_target}
+
+# stages in order, with the parameters each depends on beyond the stages before it. 'chunk_size' and 'max_memory'
+# only bound the memory of the join, whose pairs are the same either way, so they are left out of its key
+STAGES = [
+    ('ingest', _ingest, ['data1', 'data2', 'headers1', 'headers2', 'compact']),
+    ('session_filter', _session_filter, ['session_limit']),
+    ('join', _join, ['detection_time', 'detection_distance', 'engine']),
+    ('npmi', _npmi, ['run_npmi', 'min_npmi', 'approximate_npmi']),
+    ('preprocess', _preprocess, []),
+    ('sample', _sample, ['locations']),
+    ('train', _train, ['testing']),
+    ('detect', _detect, ['testing']),
+]
+
+STAGE_NAMES = [stage for stage, _, _ in STAGES]
+
+def _parameter_value(name, value):
+    """Value of a parameter in a checkpoint key, replacing input file paths with their content hash"""
+    if name in FILE_PARAMETERS and value is not None:
+        return {'path': os.path.basename(value), 'digest': count_data._file_digest(value)}
+
+    return value
+
+def stage_keys(parameters, stop_after='detect'):
+    """Checkpoint key of each stage up to `stop_after`, hashing the stage's parameters with the key of the stage
+    before it so a change to any earlier stage changes every key after it
+
+    Parameters
+    ----------
+    parameters : dict
+        Parameters of the pipeline, including the paths of the two datasets
+
+    stop_after : str
+        Last stage keyed
+
+    Returns
+    -------
+    keys : list
+        Key of each stage in order
+    """
+    keys = []
+    upstream = ''
+    for stage, _, names in STAGES[:STAGE_NAMES.index(stop_after) + 1]:
+        stage_parameters = {name: _parameter_value(name, parameters[name]) for name in names}
+        key_source = json.dumps({'stage': stage, 'parameters': stage_parameters, 'upstream': upstream},
+                                sort_keys=True, default=artifacts._json_default)
+        upstream = hashlib.sha256(key_source.encode()).hexdigest()
+        keys.append(upstream)
+
+    return keys
+
+def _checkpoint_path(checkpoint_dir, stage, key):
+    return os.path.join(checkpoint_dir, stage + '-' + key[:16])
+
+def read_checkpoint(path):
+    """Reads every output of a stage checkpoint
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint
+
+    Returns
+    -------
+    outputs : dict
+        Each key is the name of an output of the stage with the value being the output
+    """
+    store = artifacts.ArtifactStore(path)
+
+    return {name: store.get(name) for name in store.names()}
+
+def run_pipeline(data1, data2, checkpoint_dir=CHECKPOINT_DIR, stop_after='detect', rerun_from=None, **parameters):
+    """Runs the stages of the pipeline up to `stop_after`, starting after the last stage with a checkpoint matching
+    its parameters and those of every stage before it. Each stage run is checkpointed under `checkpoint_dir`
+
+    Parameters
+    ----------
+    data1 : str
+        File path of the first dataset
+
+    data2 : str
+        File path of the second dataset
+
+    checkpoint_dir : str
+        Directory of the stage checkpoints
+
+    stop_after : str
+        Last stage run, one of `STAGE_NAMES`
+
+    rerun_from : str
+        If set, this stage and those after it are run even if they have checkpoints
+
+    **parameters
+        Parameters of the stages overriding `DEFAULT_PARAMETERS`
+            - 'headers1', 'headers2' : header keyword arguments of `csv_to_df` for each dataset
+            - 'compact' : whether to read the csv files into compact types
+            - 'session_limit' : maximum session length in seconds
+            - 'detection_time' : maximum time difference in seconds of paired records
+            - 'detection_distance' : maximum distance in meters of paired records
+            - 'engine', 'chunk_size', 'max_memory' : range join engine and its memory bounds, as in `pairwise_join`
+            - 'run_npmi', 'min_npmi' : whether and at what threshold to filter pairs on npmi
+            - 'approximate_npmi' : whether to estimate the npmi with `npmi_approximate`
+            - 'locations' : csv file of location names
+            - 'testing' : whether to scale the second dataset for testing detection
+
+    Returns
+    -------
+    outputs : dict
+        Each key is the name of an output of the `stop_after` stage with the value being the output
+    """
+    unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise Exception('Unknown pipeline parameters: ' + ', '.join(sorted(unknown)))
+    parameters = dict(DEFAULT_PARAMETERS, data1=data1, data2=data2, **parameters)
+
+    keys = stage_keys(parameters, stop_after=stop_after)
+    paths = [_checkpoint_path(checkpoint_dir, stage, key) for stage, key in zip(STAGE_NAMES, keys)]
+    rerun = STAGE_NAMES.index(rerun_from) if rerun_from is not None else len(keys)
+
+    first_run = len(keys)
+    for position, path in enumerate(paths):
+        if position >= rerun or not os.path.exists(os.path.join(path, artifacts.MANIFEST)):
+            first_run = position
+            break
+
+    if first_run == len(keys):
+        print("Loading " + stop_after + " checkpoint")
+        return read_checkpoint(paths[-1])
+
+    if first_run > 0:
+        print("Resuming after " + STAGE_NAMES[first_run - 1] + " checkpoint")
+        outputs = read_checkpoint(paths[first_run - 1])
+    else:
+        outputs = None
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    for position in range(first_run, len(keys)):
+        stage, function, names = STAGES[position]
+        print("Running " + stage + " stage")
+        # written beside the checkpoint and renamed into place, so an interrupted stage leaves no checkpoint
+        stage_dir = tempfile.mkdtemp(prefix='.' + stage + '-', dir=checkpoint_dir)
+        try:
+            input_dir = paths[position - 1] if position > 0 else None
+            outputs = function(outputs, input_dir, stage_dir, parameters)
+            store = artifacts.ArtifactStore(stage_dir)
+            metadata = {'stage': stage, 'key': keys[position],
+                        'parameters': {name: _parameter_value(name, parameters[name]) for name in names}}
+            for name, value in outputs.items():
+                store.put(name, value, metadata=metadata)
+            shutil.rmtree(paths[position], ignore_errors=True)
+            os.rename(stage_dir, paths[position])
+        except BaseException:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            raise
+
+    return outputs
@@ -3,18 +3,21 @@ import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 
-import pickle
+import os
 import pandas as pd
 import plotly.graph_objs as go
 
-dist = pickle.load(open('./osm_multiplex/data/lstm_dist.pickle', 'rb'))
-collected = pickle.load(open('./osm_multiplex/data/lstm_collected_target.pickle', 'rb'))
-predicted = pickle.load(open('./osm_multiplex/data/lstm_predicted_target.pickle', 'rb'))
+from artifacts import ArtifactStore, DATA_DIR
 
-thresholds = {}
-for location, results in dist.items():
-    thresholds[location] = results['threshold']
-    del results['threshold']
+# results saved by `lstm.save_reconstruction`; only the index is read at startup, with the arrays of each location
+# memory mapped when it is first shown
+store = ArtifactStore(os.environ.get('OSM_MULTIPLEX_DATA_DIR', DATA_DIR))
+index = store.get('lstm_index')
+if not index:
+    raise Exception('No locations in the results saved in ' + store.root + ', so there is nothing to show')
+distance = store.get('lstm_distance', lazy=True)
+collected = store.get('lstm_collected_target', lazy=True)
+predicted = store.get('lstm_predicted_target', lazy=True)
 
 app = dash.Dash(__name__)
 
@@ -24,9 +27,9 @@ app.layout = html.Div([
         dcc.Dropdown(
             id="location_dropdown",
             options=[
-                {'label': location, 'value': location} for location, _ in dist.items()
+                {'label': location, 'value': location} for location in index
             ],
-            value=list(dist.keys())[0]
+            value=next(iter(index))
         )
     ]),
 
@@ -47,18 +50,18 @@ app.layout = html.Div([
     [Input('location_dropdown', 'value')]
 )
 def update_location(location):
-    x_week=[week for week in dist[location].keys()]
+    x_week = index[location]['weeks']
     dist_graph = {
         'data':[
         go.Scatter(
             x=x_week,
-            y=[result[1] for result in dist[location].values()],
+            y=distance[location].tolist(),
             mode='lines',
             name='Predicted Distance'
         ),
         go.Scatter(
             x=x_week,
-            y=[thresholds[location]] * len(x_week),
+            y=[index[location]['threshold']] * len(x_week),
             name='Threshold'
         )
         ],
@@ -78,19 +81,22 @@ def update_week(click, location):
         week = 0
     else:
         week = click['points'][0]['pointIndex']
-    x_week = list(range(len(collected[location][week])))
+    # reads only the clicked week from the memory-mapped arrays
+    collected_week = collected[location][week].tolist()
+    predicted_week = predicted[location][week].tolist()
+    x_week = list(range(len(collected_week)))
 
     week_graph = {
         'data':[
             go.Scatter(
                 x=x_week,
-                y=collected[location][week],
+                y=collected_week,
                 mode='lines',
                 name='Collected Difference'
             ),
             go.Scatter(
                 x=x_week,
-                y=predicted[location][week],
+                y=predicted_week,
                 mode='lines',
                 name='Predicted Difference'
             )
@@ -0,0 +1,62 @@
+# third-party libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+# local imports
+from .. import artifacts
+
+@pytest.fixture
+def store(tmpdir):
+    return artifacts.ArtifactStore(str(tmpdir.join('data')))
+
+class TestArtifactStore:
+    """
+    Tests writing and reading each kind of artifact
+    """
+    def test_frame_projection(self, store):
+        frame = pd.DataFrame({'element_id1': ['a', 'b'], 'timestamp1': [1, 2], 'lat1': [44.5, 44.6]},
+                             index=pd.Index([3, 7], name='record'))
+        for frame_format in ['parquet', 'feather']:
+            assert store.put('pairs', frame, frame_format=frame_format) == 'frame'
+            assert store.get('pairs').equals(frame)
+            projected = store.get('pairs', columns=['timestamp1'])
+            assert list(projected.columns) == ['timestamp1']
+            assert projected['timestamp1'].tolist() == [1, 2]
+
+    def test_multiindex_frames(self, store):
+        columns = pd.MultiIndex.from_product([['occupancy1', 'occupancy2'], [1, 2]])
+        index = pd.MultiIndex.from_tuples([(2019, 1), (2019, 2)], names=['year', 'week'])
+        samples = {'Stop A': pd.DataFrame(np.arange(8.0).reshape(2, 4), index=index, columns=columns),
+                   'Stop B/C': pd.DataFrame(np.ones((2, 4)), index=index, columns=columns)}
+
+        assert store.put('samples', samples) == 'frames'
+        loaded = store.get('samples')
+        assert list(loaded) == ['Stop A', 'Stop B/C']
+        assert all(loaded[location].equals(samples[location]) for location in samples)
+
+    def test_lazy_arrays(self, store):
+        targets = {'Stop A': np.arange(12.0).reshape(3, 4), 'Stop B': np.zeros((2, 4))}
+        assert store.put('targets', targets) == 'arrays'
+
+        lazy = artifacts.ArtifactStore(store.root).get('targets', lazy=True)
+        assert len(lazy) == 2 and lazy.loaded == {}
+        assert isinstance(lazy['Stop A'], np.memmap)
+        assert np.array_equal(lazy['Stop A'][1], targets['Stop A'][1])
+        assert list(lazy.loaded) == ['Stop A']
+
+    def test_json_and_manifest(self, store):
+        results = {'Stop A': {'threshold': np.float32(0.5), '2019, 1': [np.bool_(True), np.float32(0.75)]}}
+        assert store.put('lstm_dist', results, metadata={'source': 'test'}) == 'json'
+        store.put('array', np.arange(5))
+
+        reopened = artifacts.ArtifactStore(store.root)
+        assert sorted(reopened.names()) == ['array', 'lstm_dist']
+        assert reopened.get('lstm_dist') == {'Stop A': {'threshold': 0.5, '2019, 1': [True, 0.75]}}
+        assert reopened.metadata('lstm_dist') == {'source': 'test'}
+        assert reopened.get('array', mmap=False).tolist() == [0, 1, 2, 3, 4]
+
+        reopened.delete('array')
+        assert 'array' not in artifacts.ArtifactStore(store.root)
+        with pytest.raises(KeyError):
+            reopened.get('array')
@@ -1,8 +1,11 @@
 # standard libraries
 import os
+import warnings
 
 # third-party libraries
+import numpy as np
 import pandas as pd
+import pytest
 
 # local imports
 from .. import count_data
@@ -77,6 +80,125 @@ class TestCsvToDf:
 
         assert pd.util.hash_pandas_object(test_df).sum() == 2589903708124850504
 
+class TestCsvToCompactDf:
+    """
+    Tests reading only the needed csv columns straight into compact types
+    """
+    def test_timestamp_compact(self):
+        """
+        Check if a csv w/ a timestamp reads to the same values as `csv_to_df` and `standardize_epoch`
+        """
+        data = os.path.join(THIS_DIR, 'test_timestamp.csv')
+
+        legacy_df = count_data.standardize_epoch(count_data.csv_to_df(data, element_id='tagID', timestamp='timestamp', lat='lat', lon='lon'))
+        compact_df = count_data.csv_to_df(data, element_id='tagID', timestamp='timestamp', lat='lat', lon='lon', compact=True)
+
+        assert list(compact_df.columns) == list(legacy_df.columns)
+        assert compact_df['element_id'].dtype.name == 'category'
+        assert compact_df['lat'].dtype == np.float32
+        assert compact_df['timestamp'].tolist() == legacy_df['timestamp'].tolist()
+        assert compact_df['element_id'].astype(str).tolist() == legacy_df['element_id'].astype(str).tolist()
+        assert np.allclose(compact_df['lon'], legacy_df['lon'])
+
+    def test_session_ba_compact(self):
+        """
+        Check if a csv w/ session times and grouped counts reads to the same values as `csv_to_df`
+        """
+        data = os.path.join(THIS_DIR, 'test_session_ba.csv')
+        headers = {'element_id': 'MacPIN', 'session_start': 'SessionStart_Epoch', 'session_end': 'SessionEnd_Epoch',
+                   'boardings': 'boardings', 'alightings': 'alightings', 'lat': 'GPS_LAT', 'lon': 'GPS_LONG'}
+
+        legacy_df = count_data.standardize_epoch(count_data.csv_to_df(data, **headers))
+        compact_df = count_data.csv_to_compact_df(data, **headers)
+
+        assert list(compact_df.columns) == list(legacy_df.columns)
+        for column in ['session_start', 'session_end', 'boardings', 'alightings']:
+            assert compact_df[column].tolist() == legacy_df[column].tolist()
+        assert np.allclose(compact_df['lat'], legacy_df['lat'])
+
+class TestCsvToDfChunks:
+    """
+    Tests reading a csv as a stream of normalized chunks
+    """
+    def test_chunks_match_whole(self):
+        """
+        Check if the chunks of a csv together match the whole csv after the epoch conversion and session filter
+        """
+        data = os.path.join(THIS_DIR, 'test_session_ba.csv')
+        headers = {'element_id': 'MacPIN', 'session_start': 'SessionStart_Epoch', 'session_end': 'SessionEnd_Epoch',
+                   'boardings': 'boardings', 'alightings': 'alightings', 'lat': 'GPS_LAT', 'lon': 'GPS_LONG'}
+
+        whole_df = count_data.session_length_filter(count_data.standardize_epoch(count_data.csv_to_df(data, **headers)),
+                                                    session_max=1000)
+        chunks = list(count_data.csv_to_df(data, chunksize=2, session_limit=1000, **headers))
+
+        assert len(chunks) == 2
+        assert all(chunk.index[0] == 0 for chunk in chunks if len(chunk) > 0)
+        chunked_df = pd.concat(chunks, ignore_index=True)
+        assert chunked_df[['session_start', 'session_end']].values.tolist() == whole_df[['session_start', 'session_end']].values.tolist()
+
+class TestCachedCsvToDf:
+    """
+    Tests the on-disk cache of normalized csv imports
+    """
+    headers = {'element_id': 'MacPIN', 'session_start': 'SessionStart_Epoch', 'session_end': 'SessionEnd_Epoch',
+               'boardings': 'boardings', 'alightings': 'alightings', 'lat': 'GPS_LAT', 'lon': 'GPS_LONG'}
+
+    def test_reload(self, tmpdir):
+        """
+        Check if a second import is read from the cache and matches the first
+        """
+        data = os.path.join(THIS_DIR, 'test_session_ba.csv')
+
+        first_df = count_data.cached_csv_to_df(data, str(tmpdir), session_limit=1000, **self.headers)
+        entries = tmpdir.listdir()
+        second_df = count_data.cached_csv_to_df(data, str(tmpdir), session_limit=1000, **self.headers)
+
+        assert len(entries) == 1
+        assert tmpdir.listdir() == entries
+        assert second_df.equals(first_df)
+        assert second_df['session_start'].dtype == np.int64
+        # read without a copy, straight from the mapped file
+        assert not second_df['session_start'].values.flags.writeable
+
+    def test_keyed_and_evicted(self, tmpdir):
+        """
+        Check if changed arguments make a new entry and the oldest entries are evicted past the size budget
+        """
+        data = str(tmpdir.join('counts.csv'))
+        with open(os.path.join(THIS_DIR, 'test_session_ba.csv')) as source:
+            tmpdir.join('counts.csv').write(source.read())
+        cache_dir = tmpdir.join('cache')
+
+        count_data.cached_csv_to_df(data, str(cache_dir), session_limit=1000, **self.headers)
+        count_data.cached_csv_to_df(data, str(cache_dir), session_limit=5000, **self.headers)
+        assert len(cache_dir.listdir()) == 2
+
+        # the source changing on disk invalidates its entries, and the budget leaves room for only the newest
+        os.utime(data, ns=(0, 0))
+        entry_size = max(entry.size() for entry in cache_dir.listdir())
+        reloaded_df = count_data.cached_csv_to_df(data, str(cache_dir), session_limit=5000, cache_size=entry_size,
+                                                  **self.headers)
+
+        assert len(cache_dir.listdir()) == 1
+        assert len(reloaded_df) == 3
+
+    def test_partial_entries(self, tmpdir):
+        """
+        Check if the partial entries of interrupted runs are removed while those being written are kept
+        """
+        data = os.path.join(THIS_DIR, 'test_session_ba.csv')
+        stale = tmpdir.join('stale.partial')
+        stale.write('interrupted')
+        os.utime(str(stale), (0, 0))
+        writing = tmpdir.join('writing.partial')
+        writing.write('in progress')
+
+        count_data.cached_csv_to_df(data, str(tmpdir), session_limit=1000, **self.headers)
+
+        assert sorted(os.path.splitext(entry.basename)[1] for entry in tmpdir.listdir()) == ['.feather', '.partial']
+        assert writing.exists()
+
 class TestStandardizeDatetime:
     """
     Tests ensuring all times are datetime format
@@ -116,6 +238,21 @@ class TestStandardizeDatetime:
         assert processed_df['session_start'].dtype == 'datetime64[ns]'
         assert processed_df['session_end'].dtype == 'datetime64[ns]'
 
+    def test_column_selection(self):
+        """
+        Tests if the columns selected from another DataFrame are converted without a copy warning
+        """
+        test_df = pd.DataFrame({'time': [1519330080, 1518199500], 'lat': [44.5, 44.6], 'lon': [-123.2, -123.3],
+                                'occupancy1': [1, 2], 'occupancy2': [3, 4]})
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            processed_df = count_data.standardize_datetime(test_df[['time', 'lat', 'lon', 'occupancy1',
+                                                                    'occupancy2']])
+
+        assert processed_df['time'].dtype == 'datetime64[ns]'
+        assert test_df['time'].dtype == 'int64'
+
 class TestStandardizeEpoch:
     """
     Tests ensuring all times are unix epoch
@@ -158,6 +295,51 @@ class TestStandardizeEpoch:
         assert processed_df['session_start'].dtype == 'int64'
         assert processed_df['session_end'].dtype == 'int64'
 
+    def test_milliseconds_offset_index(self):
+        """
+        Tests if epoch times in milliseconds are detected on a DataFrame whose index does not start at zero
+        """
+        test_times = [1519330080000, 1518199500000, 1518200760000]
+        test_df = pd.DataFrame(test_times, columns=['timestamp'], index=[5, 6, 7])
+
+        processed_df = count_data.standardize_epoch(test_df)
+
+        assert processed_df['timestamp'].tolist() == [1519330080, 1518199500, 1518200760]
+
+    def test_timezone_datetime(self):
+        """
+        Tests if timezone aware datetimes are converted from UTC
+        """
+        test_df = pd.DataFrame({'timestamp': pd.to_datetime(['2018-02-22T20:08:00.000Z', '2018-02-09T18:05:00.000Z'])})
+
+        processed_df = count_data.standardize_epoch(test_df)
+
+        assert processed_df['timestamp'].tolist() == [1519330080, 1518199500]
+
+    def test_report_unconverted(self):
+        """
+        Tests if a column that is not a time is reported and left unchanged
+        """
+        test_df = pd.DataFrame({'timestamp': [1519330080, 1518199500], 'session_start': ['soon', 'later']})
+
+        with pytest.warns(UserWarning, match='session_start'):
+            processed_df = count_data.standardize_epoch(test_df)
+
+        assert processed_df['session_start'].tolist() == ['soon', 'later']
+
+    def test_column_selection(self):
+        """
+        Tests if the columns selected from another DataFrame are converted without a copy warning
+        """
+        test_df = pd.DataFrame({'timestamp': pd.to_datetime(['2018-02-22 20:08:00', '2018-02-09 18:05:00']),
+                                'lat': [44.5, 44.6]})
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            processed_df = count_data.standardize_epoch(test_df[['timestamp']])
+
+        assert processed_df['timestamp'].tolist() == [1519330080, 1518199500]
+
 class TestSessionLengthFilter:
     """
     Tests limiting the length of sessions to be included in candidate sessions
@@ -231,6 +413,67 @@ class TestTimeRangeJoinNp:
 
         assert df_range_join.equals(target)
 
+class TestTimeRangeJoinSorted:
+    """
+    Tests range joining two dataframes based on time using the sorted binary search join
+    """
+    def test_d1timestamp_d2session_sorted(self):
+        """
+        Tests with data1 having a timestamp and data2 having session times
+        """
+        time_range = 100
+        data1_list = [[1519330080, 'bob1'], [1519330030, 'bob1'], [1518200760, 'sue1']]
+        data2_list = [[1519330050, 1519330150, 'bob2'], [1518200780, 1518200980, 'sue2'], [1529200760, 1529200790, 'earl2']]
+        target_list = [[1519330080, 'bob1', 1519330050, 1519330150, 'bob2'],
+                       [1519330030, 'bob1', 1519330050, 1519330150, 'bob2'],
+                       [1518200760, 'sue1', 1518200780, 1518200980, 'sue2']]
+
+        data1 = pd.DataFrame(data1_list, columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame(data2_list, columns=['session_start2', 'session_end2', 'name2'])
+        target = pd.DataFrame(target_list, columns=['timestamp1', 'name1', 'session_start2', 'session_end2', 'name2'])
+
+        df_range_join = count_data.time_range_join_sorted(data1, data2, time_range)
+
+        assert df_range_join.equals(target)
+
+    def test_matches_np(self):
+        """
+        Tests that unsorted data with several matches per record joins identically to the numpy join
+        """
+        time_range = 30
+        data1_list = [[100, 'a1'], [40, 'b1'], [70, 'c1'], [500, 'd1'], [70, 'e1']]
+        data2_list = [[90, 'a2'], [60, 'b2'], [95, 'c2'], [10, 'd2'], [65, 'e2'], [1000, 'f2']]
+
+        data1 = pd.DataFrame(data1_list, columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame(data2_list, columns=['timestamp2', 'name2'])
+
+        df_sorted = count_data.time_range_join_sorted(data1, data2, time_range)
+        df_np = count_data.time_range_join_np(data1, data2, time_range)
+
+        assert df_sorted.equals(df_np)
+
+class TestTimeRangeJoinChunked:
+    """
+    Tests range joining two dataframes based on time in streamed time blocks
+    """
+    def test_chunks_match_sorted(self):
+        """
+        Tests that the chunks together hold every pair of the full join exactly once
+        """
+        time_range = 30
+        data1_list = [[100, 'a1'], [40, 'b1'], [70, 'c1'], [500, 'd1'], [70, 'e1'], [130, 'f1']]
+        data2_list = [[90, 'a2'], [60, 'b2'], [95, 'c2'], [10, 'd2'], [65, 'e2'], [1000, 'f2'], [160, 'g2']]
+
+        data1 = pd.DataFrame(data1_list, columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame(data2_list, columns=['timestamp2', 'name2'])
+
+        chunks = list(count_data.time_range_join_chunked(data1, data2, time_range, chunk_size=25))
+        df_chunked = pd.concat(chunks).sort_values(['name1', 'name2']).reset_index(drop=True)
+        df_sorted = count_data.time_range_join_sorted(data1, data2, time_range).sort_values(['name1', 'name2']).reset_index(drop=True)
+
+        assert len(chunks) > 1
+        assert df_chunked.equals(df_sorted)
+
 class TestTimeRangeJoinSql:
     """
     Tests range joining two dataframes based on time
@@ -250,7 +493,7 @@ class TestTimeRangeJoinSql:
         data2 = pd.DataFrame(data2_list, columns=['session_start2', 'session_end2', 'name2'])
         target = pd.DataFrame(target_list, columns=['timestamp1', 'name1', 'session_start2', 'session_end2', 'name2'])
 
-        df_range_join = count_data.time_range_join_sql(data1, data2, time_range)
+        df_range_join = count_data.time_range_join_sqlite(data1, data2, time_range)
 
         assert df_range_join.equals(target)
 
@@ -269,10 +512,193 @@ class TestTimeRangeJoinSql:
         data2 = pd.DataFrame(data2_list, columns=['timestamp2', 'name2'])
         target = pd.DataFrame(target_list, columns=['session_start1', 'session_end1', 'name1', 'timestamp2', 'name2'])
 
-        df_range_join = count_data.time_range_join_sql(data1, data2, time_range)
+        df_range_join = count_data.time_range_join_sqlite(data1, data2, time_range)
 
         assert df_range_join.equals(target)
 
+    def test_on_disk_chunked_sql(self, tmpdir):
+        """
+        Tests joining through an on-disk database in chunks leaves the input DataFrames unchanged
+        """
+        time_range = 30
+        data1 = pd.DataFrame([[100, 'a1'], [40, 'b1'], [70, 'c1'], [500, 'd1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2'], [60, 'b2'], [95, 'c2'], [10, 'd2']], columns=['timestamp2', 'name2'])
+        database = str(tmpdir.join('range_join.db'))
+
+        chunks = list(count_data.time_range_join_sqlite_chunked(data1, data2, time_range, database=database, chunksize=2))
+        df_range_join = pd.concat(chunks).reset_index(drop=True)
+
+        assert len(chunks) == 4
+        assert df_range_join.equals(count_data.time_range_join_np(data1, data2, time_range))
+        assert list(data1.columns) == ['timestamp1', 'name1']
+        assert list(data2.columns) == ['timestamp2', 'name2']
+
+class TestSpatiotemporalJoin:
+    """
+    Tests range joining two dataframes based on both time and distance
+    """
+    def test_matches_two_stage(self):
+        """
+        Tests that the grid join gives the same records as a time join followed by the distance filter
+        """
+        time_range = 60
+        dist_max = 500
+        rng = np.random.RandomState(0)
+        data1 = pd.DataFrame({'timestamp1': rng.randint(0, 3600, 300),
+                              'lat1': 44.5 + rng.rand(300) * 0.05, 'lon1': -123.3 + rng.rand(300) * 0.05})
+        data2 = pd.DataFrame({'session_start2': rng.randint(0, 3600, 200),
+                              'lat2': 44.5 + rng.rand(200) * 0.05, 'lon2': -123.3 + rng.rand(200) * 0.05})
+
+        two_stage = count_data.haversine_dist_filter(count_data.time_range_join_sorted(data1, data2, time_range), dist_max)
+        df_dist = count_data.spatiotemporal_join(data1, data2, time_range, dist_max)
+
+        assert len(df_dist) > 0
+        assert df_dist.equals(two_stage)
+
+class TestTimeRangeJoinParallel:
+    """
+    Tests range joining two dataframes based on both time and distance across worker processes
+    """
+    def test_matches_spatiotemporal(self):
+        """
+        Tests that joining time partitions in parallel gives the same records as a single grid join
+        """
+        time_range = 60
+        dist_max = 500
+        rng = np.random.RandomState(1)
+        data1 = pd.DataFrame({'timestamp1': rng.randint(0, 3600, 300),
+                              'lat1': 44.5 + rng.rand(300) * 0.05, 'lon1': -123.3 + rng.rand(300) * 0.05})
+        data2 = pd.DataFrame({'timestamp2': rng.randint(0, 3600, 200),
+                              'lat2': 44.5 + rng.rand(200) * 0.05, 'lon2': -123.3 + rng.rand(200) * 0.05})
+
+        df_single = count_data.spatiotemporal_join(data1, data2, time_range, dist_max)
+        df_parallel = count_data.time_range_join_parallel(data1, data2, time_range, dist_max, workers=2)
+
+        assert len(df_parallel) > 0
+        assert df_parallel.equals(df_single)
+
+class TestTimeRangeJoinParquet:
+    """
+    Tests range joining two dataframes based on time out of core with Parquet row groups
+    """
+    def test_matches_sorted(self, tmpdir):
+        """
+        Tests that joining small row groups gives the same records as the in-memory join and cleans up its scratch files
+        """
+        time_range = 30
+        data1_list = [[100, 'a1'], [40, 'b1'], [70, 'c1'], [500, 'd1'], [70, 'e1'], [130, 'f1']]
+        data2_list = [[90, 'a2'], [60, 'b2'], [95, 'c2'], [10, 'd2'], [65, 'e2'], [1000, 'f2'], [160, 'g2']]
+
+        data1 = pd.DataFrame(data1_list, columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame(data2_list, columns=['timestamp2', 'name2'])
+
+        df_parquet = count_data.time_range_join_parquet(data1, data2, time_range, scratch_dir=str(tmpdir), row_group_size=2)
+        df_sorted = count_data.time_range_join_sorted(data1, data2, time_range)
+
+        assert df_parquet.equals(df_sorted)
+        assert tmpdir.listdir() == []
+
+    def test_distance_filtered_parts(self, tmpdir):
+        """
+        Tests that each part is filtered on distance as it is written
+        """
+        data1 = pd.DataFrame([[100, 44.5, -123.5], [40, 44.5, -123.5], [500, 44.5, -123.5]],
+                             columns=['timestamp1', 'lat1', 'lon1'])
+        data2 = pd.DataFrame([[90, 44.5001, -123.5], [60, 45.5, -123.5], [510, 44.0, -123.0]],
+                             columns=['timestamp2', 'lat2', 'lon2'])
+        output_dir = str(tmpdir.join('joined'))
+
+        count_data.write_time_range_join_parquet(data1, data2, output_dir, 30, row_group_size=1, dist_max=50)
+        df_range_join = pd.read_parquet(output_dir)
+
+        assert len(os.listdir(output_dir)) == 1
+        assert df_range_join[['timestamp1', 'timestamp2']].values.tolist() == [[100, 90]]
+
+    def test_dataset_output(self, tmpdir):
+        """
+        Tests that the joined dataset is written as Parquet files, one per row group with matches
+        """
+        data1 = pd.DataFrame([[100, 'a1'], [40, 'b1'], [500, 'c1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2'], [60, 'b2']], columns=['timestamp2', 'name2'])
+        output_dir = str(tmpdir.join('joined'))
+
+        count_data.write_time_range_join_parquet(data1, data2, output_dir, 30, row_group_size=1)
+        df_range_join = pd.read_parquet(output_dir)
+
+        assert len(os.listdir(output_dir)) == 2
+        assert list(df_range_join.columns) == ['timestamp1', 'name1', 'timestamp2', 'name2']
+        assert len(df_range_join) == 2
+
+class TestTimeRangeJoin:
+    """
+    Tests choosing and dispatching to a range join engine
+    """
+    def test_select_in_memory(self):
+        """
+        Tests that a small join with plenty of memory is done in memory
+        """
+        data1 = pd.DataFrame([[100, 'a1'], [40, 'b1'], [70, 'c1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2'], [60, 'b2']], columns=['timestamp2', 'name2'])
+
+        engine, reason = count_data.select_join_engine(data1, data2, 30, max_memory=2**30)
+
+        assert engine == 'sorted'
+        assert 'pairs' in reason
+
+        engine, _ = count_data.select_join_engine(data1, data2, 30, max_memory=2**30, dist_max=50)
+
+        assert engine == 'spatiotemporal'
+
+    def test_select_low_memory(self):
+        """
+        Tests that joins too large for the memory budget are chunked or done out of core
+        """
+        data1 = pd.DataFrame([[100, 'a1'], [40, 'b1'], [70, 'c1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2'], [60, 'b2']], columns=['timestamp2', 'name2'])
+        input_bytes = data1.memory_usage(deep=True).sum() + data2.memory_usage(deep=True).sum()
+
+        chunked, _ = count_data.select_join_engine(data1, data2, 30, max_memory=2 * input_bytes)
+        out_of_core, _ = count_data.select_join_engine(data1, data2, 30, max_memory=input_bytes)
+
+        assert chunked == 'chunked'
+        assert out_of_core == 'parquet'
+
+    def test_engines_agree(self):
+        """
+        Tests that the in-memory engines give the same join through the dispatcher
+        """
+        data1 = pd.DataFrame([[100, 'a1'], [40, 'b1'], [70, 'c1'], [500, 'd1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2'], [60, 'b2'], [95, 'c2'], [10, 'd2']], columns=['timestamp2', 'name2'])
+
+        df_np = count_data.time_range_join(data1, data2, 30, engine='np')
+        for engine in ['auto', 'sorted', 'chunked', 'spatiotemporal', 'parallel']:
+            assert count_data.time_range_join(data1, data2, 30, engine=engine).equals(df_np)
+
+    def test_engines_agree_on_distance(self):
+        """
+        Tests that every in-memory engine gives the same join on time and distance, whether it filters on distance
+        itself or is followed by the distance filter
+        """
+        rng = np.random.RandomState(5)
+        data1 = pd.DataFrame({'timestamp1': rng.randint(0, 600, 60), 'lat1': 44.5 + rng.rand(60) * 0.01,
+                              'lon1': -123.3 + rng.rand(60) * 0.01})
+        data2 = pd.DataFrame({'timestamp2': rng.randint(0, 600, 50), 'lat2': 44.5 + rng.rand(50) * 0.01,
+                              'lon2': -123.3 + rng.rand(50) * 0.01})
+
+        expected = count_data.haversine_dist_filter(count_data.time_range_join(data1, data2, 30, engine='sorted'),
+                                                    dist_max=400)
+        assert 0 < len(expected)
+        for engine in ['auto', 'spatiotemporal', 'parallel', 'chunked', 'parquet']:
+            df_dist = count_data.time_range_join(data1, data2, 30, engine=engine, dist_max=400)
+            assert df_dist.equals(expected)
+
+    def test_invalid_engine(self):
+        data1 = pd.DataFrame([[100, 'a1']], columns=['timestamp1', 'name1'])
+        data2 = pd.DataFrame([[90, 'a2']], columns=['timestamp2', 'name2'])
+
+        with pytest.raises(Exception):
+            count_data.time_range_join(data1, data2, 30, engine='bogus')
+
 class TestHaversineDistFilter:
     """
     Tests filtering using haversine distance
@@ -288,6 +714,31 @@ class TestHaversineDistFilter:
 
         assert filtered_df.equals(target)
 
+class TestHaversineDistMask:
+    """
+    Tests the boolean mask of points within a haversine distance
+    """
+    def test_distance_mask(self):
+        dist_max = 3000
+        lat1 = np.array([44.49, 44.0, 44.5, 10.0, 44.5])
+        lon1 = np.array([-123.51, -123.0, 179.99, -123.0, -123.5])
+        lat2 = np.array([44.51, 43.0, 44.5, 10.0, 44.5])
+        lon2 = np.array([-123.49, -124.0, -179.99, -120.0, -123.5 + 3000 / 79500])
+
+        close_distance = count_data.haversine_dist_mask(lat1, lon1, lat2, lon2, dist_max)
+
+        assert close_distance.tolist() == [True, False, True, False, True]
+
+    def test_filter_leaves_input(self):
+        """
+        Tests that filtering adds no columns to the DataFrame passed in
+        """
+        dataframe = pd.DataFrame([[44.49, -123.51, 44.51, -123.49]], columns=['lat1', 'lon1', 'lat2', 'lon2'])
+
+        count_data.haversine_dist_filter(dataframe, 3000)
+
+        assert list(dataframe.columns) == ['lat1', 'lon1', 'lat2', 'lon2']
+
 class TestPairwiseFilter:
     """
     Tests the creation of candidate pairs of identifiers based on spatiotemporal filters
@@ -307,6 +758,92 @@ class TestPairwiseFilter:
 
         assert paired_records.equals(target)
 
+    def test_pairwise_filter_chunked(self):
+        data1_list = [['bob1', 1519330050, 44.4999, -123.5001], ['bob1', 1519330080, 44.5001, -123.4999], ['sue1', 1519330150, 43.0, -124.0]]
+        data2_list = [['bob2', 1519330040, 1519330070, 44.50, -123.50], ['jake2', 1519333150, 1519333320, 44.0, -123.0]]
+        target_list = [['bob1', 1519330050, 44.4999, -123.5001, 'bob2', 1519330040, 1519330070, 44.50, -123.50],
+                       ['bob1', 1519330080, 44.5001, -123.4999, 'bob2', 1519330040, 1519330070, 44.50, -123.50]]
+
+        data1 = pd.DataFrame(data1_list, columns=['element_id', 'timestamp', 'lat', 'lon'])
+        data2 = pd.DataFrame(data2_list, columns=['element_id', 'session_start', 'session_end', 'lat', 'lon'])
+        target = pd.DataFrame(target_list, columns=['element_id1', 'timestamp1', 'lat1', 'lon1',
+                                                    'element_id2', 'session_start2', 'session_end2', 'lat2', 'lon2'])
+
+        paired_records = count_data.pairwise_filter(data1, data2, chunk_size=20)
+
+        assert paired_records.equals(target)
+
+    def test_pairwise_filter_engines(self):
+        data1_list = [['bob1', 1519330050, 44.4999, -123.5001], ['bob1', 1519330080, 44.5001, -123.4999], ['sue1', 1519330150, 43.0, -124.0]]
+        data2_list = [['bob2', 1519330040, 1519330070, 44.50, -123.50], ['jake2', 1519333150, 1519333320, 44.0, -123.0]]
+        target_list = [['bob1', 1519330050, 44.4999, -123.5001, 'bob2', 1519330040, 1519330070, 44.50, -123.50],
+                       ['bob1', 1519330080, 44.5001, -123.4999, 'bob2', 1519330040, 1519330070, 44.50, -123.50]]
+        target = pd.DataFrame(target_list, columns=['element_id1', 'timestamp1', 'lat1', 'lon1',
+                                                    'element_id2', 'session_start2', 'session_end2', 'lat2', 'lon2'])
+
+        for engine in ['auto', 'np', 'sorted', 'spatiotemporal', 'parallel']:
+            data1 = pd.DataFrame(data1_list, columns=['element_id', 'timestamp', 'lat', 'lon'])
+            data2 = pd.DataFrame(data2_list, columns=['element_id', 'session_start', 'session_end', 'lat', 'lon'])
+
+            paired_records = count_data.pairwise_filter(data1, data2, engine=engine, workers=2)
+
+            assert paired_records.equals(target)
+
+class TestPairwiseFilterStream:
+    """
+    Tests the range join and distance filter of chunked datasets through spilled Parquet files
+    """
+    def test_matches_pairwise_filter(self, tmpdir):
+        rng = np.random.RandomState(3)
+        data1 = pd.DataFrame({'element_id': rng.randint(0, 20, 500).astype(str), 'timestamp': rng.randint(0, 7200, 500),
+                              'lat': 44.5 + rng.rand(500) * 0.005, 'lon': -123.3 + rng.rand(500) * 0.005})
+        data2 = pd.DataFrame({'element_id': rng.randint(0, 20, 400).astype(str), 'timestamp': rng.randint(0, 7200, 400),
+                              'lat': 44.5 + rng.rand(400) * 0.005, 'lon': -123.3 + rng.rand(400) * 0.005})
+        chunks1 = (data1.iloc[start:start + 150].reset_index(drop=True) for start in range(0, 500, 150))
+        chunks2 = (data2.iloc[start:start + 100].reset_index(drop=True) for start in range(0, 400, 100))
+
+        expected = count_data.pairwise_filter(data1.copy(), data2.copy(), engine='sorted')
+        streamed = pd.concat(count_data.pairwise_filter_stream(chunks1, chunks2, scratch_dir=str(tmpdir), row_group_size=40),
+                             ignore_index=True)
+
+        columns = ['element_id1', 'timestamp1', 'element_id2', 'timestamp2']
+        assert len(expected) > 0
+        assert len(tmpdir.listdir()) == 0
+        assert (streamed[columns].sort_values(columns).reset_index(drop=True)
+                .equals(expected[columns].sort_values(columns).reset_index(drop=True)))
+
+    def test_row_groups_read_once(self, monkeypatch):
+        rng = np.random.RandomState(6)
+        data1 = pd.DataFrame({'element_id': rng.randint(0, 20, 300).astype(str), 'timestamp': rng.randint(0, 7200, 300),
+                              'lat': 44.5 + rng.rand(300) * 0.005, 'lon': -123.3 + rng.rand(300) * 0.005})
+        data2 = pd.DataFrame({'element_id': rng.randint(0, 20, 300).astype(str), 'timestamp': rng.randint(0, 7200, 300),
+                              'lat': 44.5 + rng.rand(300) * 0.005, 'lon': -123.3 + rng.rand(300) * 0.005})
+        chunks2 = [data2.iloc[start:start + 100].reset_index(drop=True) for start in range(0, 300, 100)]
+
+        reads = []
+        read_row_group = count_data.pq.ParquetFile.read_row_group
+        def counted_read(parquet_file, row_group, *args, **kwargs):
+            reads.append((id(parquet_file), row_group))
+            return read_row_group(parquet_file, row_group, *args, **kwargs)
+        monkeypatch.setattr(count_data.pq.ParquetFile, 'read_row_group', counted_read)
+
+        streamed = list(count_data.pairwise_filter_stream([data1], chunks2, row_group_size=20))
+
+        # 3 runs of 5 row groups, each read once for the single chunk of the first dataset
+        assert sum(len(pairs) for pairs in streamed) > 0
+        assert len(reads) == len(set(reads)) == 15
+
+    def test_no_pairs(self):
+        data1 = pd.DataFrame([['bob1', 1519330050, 44.4999, -123.5001]], columns=['element_id', 'timestamp', 'lat', 'lon'])
+        data2 = pd.DataFrame([['jake2', 1519333150, 1519333320, 44.0, -123.0]],
+                             columns=['element_id', 'session_start', 'session_end', 'lat', 'lon'])
+
+        streamed = list(count_data.pairwise_filter_stream([data1], [data2]))
+
+        assert len(streamed) == 1
+        assert list(streamed[0].columns) == ['element_id1', 'timestamp1', 'lat1', 'lon1',
+                                             'element_id2', 'session_start2', 'session_end2', 'lat2', 'lon2']
+
 class TestNpmi:
     """
     Tests the calculation of the normalized pointwise mutual information value for two identifiers in a dataset
@@ -319,6 +856,160 @@ class TestNpmi:
 
         assert pd.util.hash_pandas_object(npmi).sum() == -7751402083798698346
 
+    def test_missing_ids(self):
+        data_list = [['bob', 'sue'], ['bob', 'sue'], ['bob', 'sandy'], ['bill', 'sandy'], ['biff', 'sandy'], ['jeff', 'mike']]
+        data = pd.DataFrame(data_list, columns=['element_id1', 'element_id2'])
+        missing = pd.concat([data, pd.DataFrame([[None, 'sue'], ['bob', np.nan]], columns=['element_id1', 'element_id2'])],
+                            ignore_index=True)
+
+        npmi = count_data.npmi(missing)
+
+        assert npmi.equals(count_data.npmi(data))
+
+class TestNpmiSparse:
+    """
+    Tests the normalized pointwise mutual information from a sparse co-occurrence matrix
+    """
+    def test_matches_npmi(self):
+        data_list = [['bob', 'sue'], ['bob', 'sue'], ['bob', 'sandy'], ['bill', 'sandy'], ['biff', 'sandy'], ['jeff', 'mike']]
+        data = pd.DataFrame(data_list, columns=['element_id1', 'element_id2'])
+
+        npmi = count_data.npmi(data).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+        npmi_sparse = count_data.npmi_sparse(data).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+
+        assert npmi_sparse[['element_id1', 'element_id2']].equals(npmi[['element_id1', 'element_id2']])
+        assert np.allclose(npmi_sparse['npmi'], npmi['npmi'], equal_nan=True)
+
+    def test_missing_ids(self):
+        data_list = [['bob', 'sue'], ['bob', 'sue'], ['bob', 'sandy'], ['bill', 'sandy'], ['biff', 'sandy'], ['jeff', 'mike']]
+        data = pd.DataFrame(data_list, columns=['element_id1', 'element_id2'])
+        missing = pd.concat([data, pd.DataFrame([[None, 'sue'], ['bob', np.nan]], columns=['element_id1', 'element_id2'])],
+                            ignore_index=True)
+
+        npmi_sparse = count_data.npmi_sparse(missing)
+
+        assert npmi_sparse.equals(count_data.npmi_sparse(data))
+
+    def test_min_npmi(self):
+        rng = np.random.RandomState(4)
+        data = pd.DataFrame({'element_id1': rng.randint(0, 30, 2000).astype(str),
+                             'element_id2': rng.randint(0, 40, 2000).astype(str)})
+
+        npmi = count_data.npmi(data)
+        npmi_sparse = count_data.npmi_sparse(data, min_npmi=0.1)
+
+        expected = npmi[npmi['npmi'] >= 0.1].sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+        assert len(expected) > 0
+        assert (npmi_sparse.sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+                [['element_id1', 'element_id2']].equals(expected[['element_id1', 'element_id2']]))
+
+class TestNpmiAccumulator:
+    """
+    Tests calculating the normalized pointwise mutual information from counts accumulated over chunks
+    """
+    def test_chunks_match_npmi(self, tmpdir):
+        rng = np.random.RandomState(5)
+        data = pd.DataFrame({'element_id1': rng.randint(0, 30, 2000).astype(str),
+                             'element_id2': rng.randint(0, 40, 2000).astype(str)})
+
+        accumulator = count_data.NpmiAccumulator()
+        for start in range(0, 1000, 250):
+            accumulator.update(data.iloc[start:start + 250])
+        other_worker = count_data.NpmiAccumulator().update(data.iloc[1000:])
+        accumulator.merge(other_worker)
+        accumulator.save(str(tmpdir.join('counts.parquet')))
+        loaded = count_data.NpmiAccumulator().load(str(tmpdir.join('counts.parquet')))
+
+        expected = count_data.npmi(data).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+        for npmi in [accumulator.finalize(), loaded.finalize()]:
+            npmi = npmi.sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+            assert npmi[['element_id1', 'element_id2']].equals(expected[['element_id1', 'element_id2']])
+            assert np.allclose(npmi['npmi'], expected['npmi'])
+        assert loaded.total == 2000
+
+    def test_sources(self, tmpdir):
+        data = pd.DataFrame({'element_id1': ['a', 'a', 'b'], 'element_id2': ['x', 'y', 'x']})
+        accumulator = count_data.NpmiAccumulator().update(data)
+        accumulator.sources.add('day 1')
+        day2 = count_data.NpmiAccumulator().update(data)
+        day2.sources.add('day 2')
+
+        accumulator.merge(day2).save(str(tmpdir.join('counts.parquet')))
+        loaded = count_data.NpmiAccumulator().load(str(tmpdir.join('counts.parquet')))
+
+        assert loaded.sources == {'day 1', 'day 2'}
+        assert loaded.subtract(day2).sources == {'day 1'}
+        assert loaded.total == 3
+
+class TestSlidingNpmi:
+    """
+    Tests the normalized pointwise mutual information over a sliding window of days
+    """
+    def test_matches_recent_days(self, tmpdir):
+        rng = np.random.RandomState(6)
+        data = pd.DataFrame({'element_id1': rng.randint(0, 20, 3000).astype(str),
+                             'element_id2': rng.randint(0, 25, 3000).astype(str),
+                             'timestamp1': np.sort(rng.randint(0, 10 * 86400, 3000))})
+
+        sliding = count_data.SlidingNpmi(window_size=86400, window_count=3)
+        for day in range(10):
+            sliding.update(data[data['timestamp1'] // 86400 == day])
+        sliding.save(str(tmpdir))
+        loaded = count_data.SlidingNpmi(window_size=86400, window_count=3).load(str(tmpdir))
+
+        recent = data[data['timestamp1'] >= 7 * 86400]
+        expected = count_data.npmi(recent).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+        assert list(sliding.windows) == [7, 8, 9]
+        for npmi in [sliding.finalize(), loaded.finalize()]:
+            npmi = npmi.sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+            assert npmi[['element_id1', 'element_id2']].equals(expected[['element_id1', 'element_id2']])
+            assert np.allclose(npmi['npmi'], expected['npmi'])
+
+    def test_rolling_npmi(self):
+        data = pd.DataFrame([['bob', 'sue', 10], ['bob', 'sue', 86410], ['bob', 'sandy', 2 * 86400 + 10]],
+                            columns=['element_id1', 'element_id2', 'timestamp1'])
+
+        rolled = list(count_data.rolling_npmi(data, window_size=86400, window_count=2))
+
+        assert [window for window, _ in rolled] == [0, 86400, 2 * 86400]
+        # the first day has left the span of the last two days
+        assert rolled[2][1].sort_values('element_id2')[['element_id1', 'element_id2']].values.tolist() == [['bob', 'sandy'], ['bob', 'sue']]
+        assert np.allclose(rolled[2][1]['npmi'], 0)
+
+class TestNpmiApproximate:
+    """
+    Tests the accuracy of the npmi estimated from Count-Min sketches against the exact npmi
+    """
+    def test_small_matches_npmi(self):
+        data_list = [['bob', 'sue'], ['bob', 'sue'], ['bob', 'sandy'], ['bill', 'sandy'], ['biff', 'sandy'], ['jeff', 'mike']]
+        data = pd.DataFrame(data_list, columns=['element_id1', 'element_id2'])
+
+        npmi = count_data.npmi(data).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+        approximate = count_data.npmi_approximate(data).sort_values(['element_id1', 'element_id2']).reset_index(drop=True)
+
+        assert approximate[['element_id1', 'element_id2']].equals(npmi[['element_id1', 'element_id2']])
+        assert np.allclose(approximate['npmi'], npmi['npmi'], equal_nan=True)
+
+    def test_error_bound(self):
+        rng = np.random.RandomState(7)
+        # a few frequent pairs among many rare ones
+        data = pd.DataFrame({'element_id1': np.concatenate([rng.randint(0, 5, 2000), rng.randint(0, 3000, 8000)]).astype(str),
+                             'element_id2': np.concatenate([rng.randint(0, 5, 2000), rng.randint(0, 3000, 8000)]).astype(str)})
+        counts = data.groupby(['element_id1', 'element_id2']).size().rename('exact').reset_index()
+
+        approximate = count_data.ApproximateNpmi(epsilon=0.005, delta=0.01, top_pairs=25)
+        for start in range(0, len(data), 1000):
+            approximate.update(data.iloc[start:start + 1000])
+        estimates = approximate.finalize()
+
+        compared = estimates.merge(counts, on=['element_id1', 'element_id2'])
+        exact = count_data.npmi(data).merge(estimates, on=['element_id1', 'element_id2'], suffixes=('', '_estimate'))
+        assert len(compared) == 25
+        assert (compared['count'] >= compared['exact']).all()
+        assert (compared['count'] - compared['exact'] <= approximate.error).all()
+        assert counts['exact'].nlargest(25).min() <= compared['exact'].min() + approximate.error
+        assert np.abs(exact['npmi'] - exact['npmi_estimate']).max() < 0.05
+
 class TestNpmiDataFilter:
     """
     Tests if data is properly filtered by the value of the nmpi for the id pair
@@ -334,4 +1025,59 @@ class TestNpmiDataFilter:
 
         test = count_data.npmi_data_filter(data, npmi)
 
-        assert test.equals(target)
\ No newline at end of file
+        assert test.equals(target)
+@pytest.fixture
+def datasets(tmpdir):
+    rng = np.random.RandomState(9)
+    paths = []
+    for name, records in [('data1.csv', 600), ('data2.csv', 400)]:
+        pd.DataFrame({'tag': rng.randint(0, 30, records), 'time': rng.randint(0, 86400, records),
+                      'lat': 44.5 + rng.rand(records) * 0.005, 'lon': -123.3 + rng.rand(records) * 0.005}
+                     ).to_csv(str(tmpdir.join(name)), index=False)
+        paths.append(str(tmpdir.join(name)))
+    return paths
+
+class TestProcessData:
+    """
+    Tests the npmi options of processing two csv files into likely pairs
+    """
+    headers = {'element_id1': 'tag', 'timestamp1': 'time', 'lat1': 'lat', 'lon1': 'lon',
+               'element_id2': 'tag', 'timestamp2': 'time', 'lat2': 'lat', 'lon2': 'lon'}
+    columns = ['element_id1', 'timestamp1', 'element_id2', 'timestamp2']
+
+    def test_streamed_matches_in_memory(self, datasets):
+        expected = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, engine='sorted', **self.headers)
+        streamed = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, chunksize=150, **self.headers)
+
+        assert len(expected) > 0
+        assert (streamed[self.columns].sort_values(self.columns).reset_index(drop=True)
+                .equals(expected[self.columns].sort_values(self.columns).reset_index(drop=True)))
+
+    def test_npmi_counts_rerun(self, datasets, tmpdir):
+        npmi_counts = str(tmpdir.join('counts.parquet'))
+
+        first = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, npmi_counts=npmi_counts,
+                                        **self.headers)
+        total = count_data.NpmiAccumulator().load(npmi_counts).total
+        rerun = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, npmi_counts=npmi_counts,
+                                        chunksize=150, **self.headers)
+
+        assert len(first) > 0
+        assert count_data.NpmiAccumulator().load(npmi_counts).total == total
+        assert (rerun[self.columns].sort_values(self.columns).reset_index(drop=True)
+                .equals(first[self.columns].sort_values(self.columns).reset_index(drop=True)))
+
+    def test_approximate_npmi(self, datasets, monkeypatch):
+        def exact_npmi(*args, **kwargs):
+            raise AssertionError('exact npmi used')
+        monkeypatch.setattr(count_data, 'npmi_sparse', exact_npmi)
+        monkeypatch.setattr(count_data, 'NpmiAccumulator', exact_npmi)
+
+        in_memory = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, approximate_npmi=True,
+                                            **self.headers)
+        streamed = count_data.process_data(*datasets, run_npmi=True, min_npmi=0.2, approximate_npmi=True,
+                                           chunksize=150, **self.headers)
+
+        assert len(in_memory) > 0
+        assert (streamed[self.columns].sort_values(self.columns).reset_index(drop=True)
+                .equals(in_memory[self.columns].sort_values(self.columns).reset_index(drop=True)))
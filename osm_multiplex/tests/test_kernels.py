@@ -0,0 +1,61 @@
+# third-party libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+# local imports
+from .. import count_data
+from .. import kernels
+
+numba = pytest.importorskip('numba')
+
+@pytest.fixture
+def numpy_only():
+    """
+    Runs `count_data` without the compiled kernels for the duration of a test
+    """
+    kernels.ENABLED = False
+    yield
+    kernels.ENABLED = kernels.NUMBA_AVAILABLE
+
+@pytest.fixture
+def records():
+    rng = np.random.RandomState(2)
+    data1 = pd.DataFrame({'element_id1': rng.randint(0, 20, 400).astype(str), 'timestamp1': rng.randint(0, 3600, 400),
+                          'lat1': 44.5 + rng.rand(400) * 0.02, 'lon1': -123.3 + rng.rand(400) * 0.02})
+    data2 = pd.DataFrame({'element_id2': rng.randint(0, 20, 300).astype(str), 'timestamp2': rng.randint(0, 3600, 300),
+                          'lat2': 44.5 + rng.rand(300) * 0.02, 'lon2': -123.3 + rng.rand(300) * 0.02})
+    return data1, data2
+
+class TestKernels:
+    """
+    Tests that the compiled kernels give the same results as the numpy implementations
+    """
+    def test_sorted_join(self, records, request):
+        data1, data2 = records
+        compiled = count_data.time_range_join_sorted(data1, data2, 60)
+        request.getfixturevalue('numpy_only')
+        numpy = count_data.time_range_join_sorted(data1, data2, 60)
+
+        assert compiled.equals(numpy)
+
+    def test_haversine(self, records, request):
+        data1, data2 = records
+        joined = count_data.time_range_join_sorted(data1, data2, 60)
+        compiled = count_data.haversine_dist_filter(joined, 500)
+        request.getfixturevalue('numpy_only')
+        numpy = count_data.haversine_dist_filter(joined, 500)
+
+        assert len(compiled) > 0
+        assert compiled.equals(numpy)
+
+    def test_npmi(self, records, request):
+        data1, data2 = records
+        joined = count_data.time_range_join_sorted(data1, data2, 60)
+        joined.loc[::7, 'element_id2'] = None
+        compiled = count_data.npmi(joined)
+        request.getfixturevalue('numpy_only')
+        numpy = count_data.npmi(joined)
+
+        assert compiled['element_id2'].notnull().all()
+        assert compiled.equals(numpy)
@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 
 # local imports
+from .. import artifacts
 from .. import lstm
 
 class TestWeekAnomalyDetect:
@@ -24,6 +25,32 @@ class TestWeekAnomalyDetect:
 
         assert len(test) == 2
 
+class TestSaveReconstruction:
+    def test_index_and_arrays(self, tmpdir):
+        store = artifacts.ArtifactStore(str(tmpdir))
+        reconstruction = {'location(11.11, 22.22)': {'threshold': 0.5, '2018, 1': [False, 0.25], '2018, 2': [True, 0.75]}}
+        collected = {'location(11.11, 22.22)': np.arange(8.0).reshape(2, 4)}
+        predicted = {'location(11.11, 22.22)': np.ones((2, 4))}
+
+        lstm.save_reconstruction(store, reconstruction, collected, predicted)
+
+        index = store.get('lstm_index')
+        assert index == {'location(11.11, 22.22)': {'threshold': 0.5, 'weeks': ['2018, 1', '2018, 2']}}
+        assert store.get('lstm_distance')['location(11.11, 22.22)'].tolist() == [0.25, 0.75]
+        week = store.get('lstm_collected_target', lazy=True)['location(11.11, 22.22)'][1]
+        assert week.tolist() == [4.0, 5.0, 6.0, 7.0]
+
+    def test_no_locations(self, tmpdir):
+        store = artifacts.ArtifactStore(str(tmpdir))
+        reconstruction = {'location(11.11, 22.22)': {'threshold': 0.5, '2018, 1': [False, 0.25]}}
+        lstm.save_reconstruction(store, reconstruction, {'location(11.11, 22.22)': np.zeros((1, 4))},
+                                 {'location(11.11, 22.22)': np.zeros((1, 4))})
+
+        lstm.save_reconstruction(store, {}, {}, {})
+
+        assert store.get('lstm_index') == {}
+        assert sorted(store.names()) == ['lstm_index']
+
 ## need rolling test
 
 class TestWeeklyDataframes:
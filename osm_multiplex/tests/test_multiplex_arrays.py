@@ -0,0 +1,52 @@
+# third-party libraries
+import networkx as nx
+import numpy as np
+import pytest
+
+# local imports
+from .. import multiplex_arrays
+
+@pytest.fixture
+def multiplex():
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from([('walk-1', {'y': 44.50, 'x': -123.20}), ('walk-2', {'y': 44.51, 'x': -123.21}),
+                          ('bike-1', {'y': 44.50, 'x': -123.20}), ('bike-3', {'y': 44.52, 'x': -123.22})])
+    graph.add_edges_from([('walk-1', 'walk-2', {'length': 12.5}), ('walk-2', 'walk-1', {'length': 12.5}),
+                          ('bike-1', 'bike-3', {'length': 30.0}), ('bike-1', 'bike-3', {'length': 32.0}),
+                          ('walk-1', 'bike-1'), ('bike-1', 'walk-1')])
+    return graph
+
+class TestCsrMultiplex:
+    """
+    Tests converting the multiplex graph to arrays and back
+    """
+    def test_from_networkx(self, multiplex):
+        csr = multiplex_arrays.CsrMultiplex.from_networkx(multiplex)
+
+        assert csr.modes == ['walk', 'bike']
+        assert csr.osm_ids.tolist() == [1, 2, 1, 3]
+        assert csr.node_modes.tolist() == [0, 0, 1, 1]
+        assert csr.indptr.tolist() == [0, 2, 3, 6, 6]
+        assert csr.targets.tolist() == [1, 2, 0, 3, 3, 0]
+        assert csr.weights.tolist() == [12.5, 0.0, 12.5, 30.0, 32.0, 0.0]
+        assert csr.edge_modes.tolist() == [0, 0, 0, 1, 1, 1]
+        assert csr.transfers.tolist() == [False, True, False, False, False, True]
+
+    def test_save_load_round_trip(self, multiplex, tmpdir):
+        path = str(tmpdir.join('multiplex'))
+        multiplex_arrays.CsrMultiplex.from_networkx(multiplex).save(path)
+
+        loaded = multiplex_arrays.CsrMultiplex.load(path)
+        assert isinstance(loaded.targets, np.memmap)
+        assert loaded.node_count == 4 and loaded.edge_count == 6
+
+        graph = loaded.to_networkx()
+        assert dict(graph.nodes(data=True)) == dict(multiplex.nodes(data=True))
+        assert sorted(graph.edges(data=True), key=str) == sorted(multiplex.edges(data=True), key=str)
+
+    def test_unnamed_nodes(self):
+        graph = nx.MultiDiGraph()
+        graph.add_node(123)
+
+        with pytest.raises(Exception):
+            multiplex_arrays.CsrMultiplex.from_networkx(graph)
@@ -1,3 +1,8 @@
+# standard libraries
+import math
+import os
+from xml.etree import ElementTree
+
 # third-party libraries
 import networkx as nx
 import pytest
@@ -5,6 +10,46 @@ import pytest
 # local imports
 from .. import osm_download
 
+FIXTURE_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_layer.osm')
+
+# highway types included by each network type, standing in for the osmnx filters
+NETWORK_HIGHWAYS = {'walk': {'residential', 'footway'}, 'bike': {'residential', 'footway'}, 'drive': {'residential'}}
+
+def fixture_layer(*area, network_type='walk', simplify=True, truncate_by_edge=False, retain_all=False, **kwargs):
+    """Stand-in for the osmnx download functions, building the layer from the fixture XML. A bounding box keeps
+    the edges with both nodes inside it, or with either node inside it if truncating by edge, and only the largest
+    weakly connected component is kept unless retaining all"""
+    root = ElementTree.parse(FIXTURE_XML).getroot()
+    layer = nx.MultiDiGraph(crs='epsg:4326')
+    for node in root.iter('node'):
+        layer.add_node(int(node.get('id')), osmid=int(node.get('id')), y=float(node.get('lat')),
+                       x=float(node.get('lon')))
+    inside = {node for node, attributes in layer.nodes(data=True)
+              if len(area) != 4 or (area[1] <= attributes['y'] <= area[0] and area[3] <= attributes['x'] <= area[2])}
+    for way in root.iter('way'):
+        highway = {tag.get('k'): tag.get('v') for tag in way.iter('tag')}.get('highway')
+        if highway not in NETWORK_HIGHWAYS[network_type]:
+            continue
+        refs = [int(nd.get('ref')) for nd in way.iter('nd')]
+        for start, end in list(zip(refs[:-1], refs[1:])) + list(zip(refs[1:], refs[:-1])):
+            if not ((start in inside or end in inside) if truncate_by_edge else (start in inside and end in inside)):
+                continue
+            length = 111195 * math.hypot(layer.nodes[start]['y'] - layer.nodes[end]['y'],
+                                         (layer.nodes[start]['x'] - layer.nodes[end]['x']) * 0.71)
+            layer.add_edge(start, end, osmid=int(way.get('id')), highway=highway, oneway=False, length=length)
+    layer.remove_nodes_from(list(nx.isolates(layer)))
+    if retain_all == False and layer.number_of_nodes() > 0:
+        layer = layer.subgraph(max(nx.weakly_connected_components(layer), key=len)).copy()
+
+    if simplify == True:
+        layer = osm_download.simplify_layer(layer)
+    return layer
+
+@pytest.fixture
+def local_osm(monkeypatch):
+    monkeypatch.setattr(osm_download.ox, 'graph_from_place', fixture_layer)
+    monkeypatch.setattr(osm_download.ox, 'graph_from_bbox', fixture_layer)
+
 class TestDownloadOsmLayer:
     """
     Tests downloading a single-mode network layer from OSM
@@ -67,6 +112,162 @@ class TestGenerateMultiplex:
 
         assert isinstance(test_multiplex, nx.classes.multidigraph.MultiDiGraph) == True
 
+class TestGenerateMultiplexLocal:
+    """
+    Tests building multiplex graphs from the fixture XML in place of OSM
+    """
+    def test_matches_serial_build(self, local_osm):
+        modes = ['walk', 'drive']
+        test_multiplex = osm_download.generate_multiplex('Corvallis, Oregon', modes, workers=2)
+
+        expected = nx.MultiDiGraph()
+        for mode in modes:
+            expected = nx.union(fixture_layer(network_type=mode), expected, rename=(mode + '-', None))
+        expected = osm_download.merge_multiplex_nodes(expected)
+
+        assert set(test_multiplex.nodes) == set(expected.nodes)
+        assert sorted(test_multiplex.edges()) == sorted(expected.edges())
+        assert ('walk-102', 'drive-102') in test_multiplex.edges()
+
+    def test_unsimplified_bbox(self, local_osm):
+        test_multiplex = osm_download.generate_multiplex([44.57, 44.56, -123.25, -123.27], ['walk', 'drive'],
+                                                         simplify=False)
+
+        assert 'walk-106' in test_multiplex.nodes
+        assert 'drive-106' not in test_multiplex.nodes
+        assert test_multiplex.nodes['drive-104']['y'] == 44.5650
+
+    def test_unsimplified_without_processes(self, local_osm, monkeypatch):
+        def no_processes(*args, **kwargs):
+            raise AssertionError('process pool created')
+        monkeypatch.setattr(osm_download.concurrent.futures, 'ProcessPoolExecutor', no_processes)
+
+        test_multiplex = osm_download.generate_multiplex('Corvallis, Oregon', ['walk', 'drive'], simplify=False)
+
+        assert 'walk-102' in test_multiplex.nodes
+
+    def test_combine_layers(self):
+        walk = nx.MultiDiGraph(crs='epsg:4326')
+        walk.add_edge(1, 2, length=10.0)
+        drive = nx.MultiDiGraph()
+        drive.add_edge(1, 2, length=10.0)
+        drive.add_edge(1, 2, length=12.0)
+
+        separated_graph = osm_download.combine_layers({'walk': walk, 'drive': drive})
+
+        assert separated_graph.graph['crs'] == 'epsg:4326'
+        assert sorted(separated_graph.edges(keys=True, data='length')) == [('drive-1', 'drive-2', 0, 10.0),
+                                                                          ('drive-1', 'drive-2', 1, 12.0),
+                                                                          ('walk-1', 'walk-2', 0, 10.0)]
+
+class TestOsmLayerCache:
+    """
+    Tests reusing downloaded layers from the on-disk cache
+    """
+    def test_cached_download(self, local_osm, monkeypatch, tmpdir):
+        downloads = []
+        monkeypatch.setattr(osm_download.ox, 'graph_from_place',
+                            lambda *area, **kwargs: downloads.append(area) or fixture_layer(*area, **kwargs))
+        cache = osm_download.OsmLayerCache(str(tmpdir))
+
+        first = osm_download.download_osm_layer('Corvallis, Oregon', 'walk', cache=cache)
+        second = osm_download.download_osm_layer('corvallis,  oregon', 'walk', cache=cache)
+        osm_download.download_osm_layer('Corvallis, Oregon', 'drive', cache=cache)
+
+        assert len(downloads) == 2
+        assert sorted(second.edges(data='length')) == sorted(first.edges(data='length'))
+
+    def test_offline_multiplex(self, local_osm, tmpdir):
+        area = [44.57, 44.56, -123.25, -123.27]
+        expected = osm_download.generate_multiplex(area, ['walk', 'drive'],
+                                                   cache=osm_download.OsmLayerCache(str(tmpdir)))
+
+        offline = osm_download.OsmLayerCache(str(tmpdir), offline=True)
+        rounded_area = [44.570001, 44.56, -123.25, -123.27]
+        test_multiplex = osm_download.generate_multiplex(rounded_area, ['walk', 'drive'], cache=offline)
+        assert sorted(test_multiplex.edges()) == sorted(expected.edges())
+
+        with pytest.raises(Exception):
+            osm_download.generate_multiplex(area, ['bike'], cache=offline)
+
+    def test_expiry_and_eviction(self, local_osm, monkeypatch, tmpdir):
+        cache = osm_download.OsmLayerCache(str(tmpdir.join('small')), cache_size=0)
+        osm_download.download_osm_layer('Corvallis, Oregon', 'walk', cache=cache)
+        assert os.listdir(str(tmpdir.join('small'))) == []
+
+        cache = osm_download.OsmLayerCache(str(tmpdir.join('expired')), ttl=-1)
+        osm_download.download_osm_layer('Corvallis, Oregon', 'walk', cache=cache)
+        entries = os.listdir(str(tmpdir.join('expired')))
+        assert sorted(os.path.splitext(entry)[1] for entry in entries) == ['.json', '.pickle']
+
+        # expired layers are never unpickled
+        def no_load(*args, **kwargs):
+            raise AssertionError('expired layer loaded')
+        monkeypatch.setattr(osm_download.pickle, 'load', no_load)
+        assert cache.get('Corvallis, Oregon', 'walk') is None
+
+class TestGenerateTiledMultiplex:
+    """
+    Tests building multiplex graphs from tiles of the fixture XML
+    """
+    def test_bbox_tiles(self):
+        tiles = osm_download.bbox_tiles([44.57, 44.55, -123.25, -123.27], tile_size=0.01)
+
+        assert tiles == [[44.56, 44.55, -123.26, -123.27], [44.56, 44.55, -123.25, -123.26],
+                         [44.57, 44.56, -123.26, -123.27], [44.57, 44.56, -123.25, -123.26]]
+        with pytest.raises(Exception):
+            osm_download.bbox_tiles('Corvallis, Oregon')
+
+    def test_matches_whole_area(self, local_osm):
+        area = [44.567, 44.562, -123.259, -123.263]
+        expected = osm_download.generate_multiplex(area, ['walk', 'drive'])
+
+        # tiles of 0.001 degrees split every street of the fixture
+        test_multiplex = osm_download.generate_tiled_multiplex(area, ['walk', 'drive'], tile_size=0.001)
+
+        assert set(test_multiplex.nodes) == set(expected.nodes)
+        assert sorted(test_multiplex.edges(data='length')) == sorted(expected.edges(data='length'))
+
+    def test_truncated_to_area(self, local_osm):
+        # the area cuts across the tiles and the streets of the fixture
+        area = [44.5645, 44.5625, -123.2605, -123.2625]
+        expected = osm_download.generate_multiplex(area, ['walk', 'drive'], simplify=False)
+
+        test_multiplex = osm_download.generate_tiled_multiplex(area, ['walk', 'drive'], tile_size=0.001,
+                                                               simplify=False)
+
+        assert all(area[1] <= attributes['y'] <= area[0] and area[3] <= attributes['x'] <= area[2]
+                   for _, attributes in test_multiplex.nodes(data=True))
+        assert set(test_multiplex.nodes) == set(expected.nodes)
+        assert sorted(test_multiplex.edges()) == sorted(expected.edges())
+
+    def test_spawned_simplify_pool(self, local_osm, monkeypatch):
+        contexts = []
+        pool = osm_download.concurrent.futures.ProcessPoolExecutor
+        monkeypatch.setattr(osm_download.concurrent.futures, 'ProcessPoolExecutor',
+                            lambda **kwargs: contexts.append(kwargs.get('mp_context')) or pool(**kwargs))
+
+        osm_download.generate_tiled_multiplex([44.567, 44.562, -123.259, -123.263], ['walk'], tile_size=0.002)
+
+        assert [context.get_start_method() for context in contexts] == ['spawn']
+
+    def test_refresh_area(self, local_osm, monkeypatch, tmpdir):
+        downloads = []
+        monkeypatch.setattr(osm_download.ox, 'graph_from_bbox',
+                            lambda *area, **kwargs: downloads.append(area) or fixture_layer(*area, **kwargs))
+        area = [44.567, 44.562, -123.259, -123.263]
+        cache = osm_download.OsmLayerCache(str(tmpdir))
+
+        first = osm_download.generate_tiled_multiplex(area, ['walk'], tile_size=0.002, cache=cache)
+        tile_count = len(osm_download.bbox_tiles(area, tile_size=0.002))
+        assert len(downloads) == tile_count
+
+        cached = osm_download.generate_tiled_multiplex(area, ['walk'], tile_size=0.002, cache=cache,
+                                                       refresh_area=[44.5645, 44.5635, -123.2605, -123.2615])
+        # the refreshed area crosses the boundary of two tiles
+        assert len(downloads) == tile_count + 2
+        assert sorted(cached.edges()) == sorted(first.edges())
+
 class TestMergeMultiplexNodes:
     """
     Tests if colocated nodes have edges connecting them
@@ -83,4 +284,12 @@ class TestMergeMultiplexNodes:
         assert ('A-1', 'B-1', 0) in connected_edges
         assert ('B-1', 'A-1', 0) in connected_edges
         assert ('A-2', 'B-2', 0) in connected_edges
-        assert ('B-2', 'A-2', 0) in connected_edges
\ No newline at end of file
+        assert ('B-2', 'A-2', 0) in connected_edges
+
+    def test_no_substring_matches(self):
+        separated_graph = nx.MultiDiGraph()
+        separated_graph.add_nodes_from(['walk-123', 'walk-91234', 'bike-123', 'drive_service-1234'])
+
+        connected_graph = osm_download.merge_multiplex_nodes(separated_graph)
+
+        assert sorted(connected_graph.edges()) == [('bike-123', 'walk-123'), ('walk-123', 'bike-123')]
@@ -0,0 +1,90 @@
+# standard libraries
+import os
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+# local imports
+from .. import count_data
+from .. import pipeline
+
+HEADERS = {'element_id': 'tag', 'timestamp': 'time', 'lat': 'lat', 'lon': 'lon'}
+
+@pytest.fixture
+def datasets(tmpdir):
+    rng = np.random.RandomState(8)
+    paths = []
+    for name, records in [('data1.csv', 600), ('data2.csv', 400)]:
+        times = pd.to_datetime(rng.randint(0, 86400, records), unit='s').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        pd.DataFrame({'tag': rng.randint(0, 30, records), 'time': times,
+                      'lat': 44.5 + rng.rand(records) * 0.005, 'lon': -123.3 + rng.rand(records) * 0.005}
+                     ).to_csv(str(tmpdir.join(name)), index=False)
+        paths.append(str(tmpdir.join(name)))
+    return paths
+
+class TestRunPipeline:
+    """
+    Tests running the pipeline stages and reusing their checkpoints
+    """
+    def test_matches_process_data(self, datasets, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+
+        outputs = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                        headers1=HEADERS, headers2=HEADERS, engine='spatiotemporal')
+        expected = count_data.process_data(datasets[0], datasets[1], element_id1='tag', timestamp1='time', lat1='lat',
+                                           lon1='lon', element_id2='tag', timestamp2='time', lat2='lat', lon2='lon',
+                                           engine='sorted')
+
+        columns = ['element_id1', 'timestamp1', 'element_id2', 'timestamp2']
+        assert len(expected) > 0
+        assert (outputs['likely_pairs'][columns].sort_values(columns).reset_index(drop=True)
+                .equals(expected[columns].sort_values(columns).reset_index(drop=True)))
+        assert len(os.listdir(checkpoint_dir)) == 4
+
+    def test_resume_from_changed_stage(self, datasets, tmpdir, capsys):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        first = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                      headers1=HEADERS, headers2=HEADERS)
+        capsys.readouterr()
+
+        unchanged = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                          headers1=HEADERS, headers2=HEADERS)
+        assert 'Running' not in capsys.readouterr().out
+        assert unchanged['likely_pairs'].equals(first['likely_pairs'])
+
+        # only the join and the stages after it depend on the detection distance
+        closer = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                       headers1=HEADERS, headers2=HEADERS, detection_distance=20)
+        output = capsys.readouterr().out
+        assert 'Running session_filter stage' not in output
+        assert 'Running join stage' in output
+        assert 0 < len(closer['likely_pairs']) < len(first['likely_pairs'])
+
+        pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                              headers1=HEADERS, headers2=HEADERS, detection_distance=20, rerun_from='join')
+        assert 'Running join stage' in capsys.readouterr().out
+
+    def test_changed_file_reruns(self, datasets, tmpdir):
+        keys = pipeline.stage_keys(dict(pipeline.DEFAULT_PARAMETERS, data1=datasets[0], data2=datasets[1]))
+
+        with open(datasets[1], 'a') as data2:
+            data2.write('5,2018-10-03T18:51:26.000Z,44.5,-123.3\n')
+        changed_keys = pipeline.stage_keys(dict(pipeline.DEFAULT_PARAMETERS, data1=datasets[0], data2=datasets[1]))
+
+        assert len(keys) == len(pipeline.STAGES)
+        assert all(key != changed_key for key, changed_key in zip(keys, changed_keys))
+
+    def test_memory_options_reuse_join(self, datasets, tmpdir, capsys):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        first = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                      headers1=HEADERS, headers2=HEADERS, engine='chunked', chunk_size=3600)
+        capsys.readouterr()
+
+        # the memory bounds of the join do not change its pairs, so its checkpoint is reused
+        bounded = pipeline.run_pipeline(datasets[0], datasets[1], checkpoint_dir=checkpoint_dir, stop_after='npmi',
+                                        headers1=HEADERS, headers2=HEADERS, engine='chunked', chunk_size=600,
+                                        max_memory=2 ** 20)
+        assert 'Running' not in capsys.readouterr().out
+        assert bounded['likely_pairs'].equals(first['likely_pairs'])
@@ -31,9 +31,15 @@ install_requires = [
     'numpy',
     'osmnx',
     'pandas',
-    'scikit-learn'
+    'pyarrow',
+    'scikit-learn',
+    'scipy'
 ]
 
+extras_require = {
+    'numba': ['numba'],
+}
+
 tests_require = [
     'pytest>=3.2.0',
     'pytest-cov',
@@ -92,5 +98,5 @@ setup(
 
     tests_require=tests_require,
     setup_requires=setup_requires,
-    #extras_require=extras_require,
+    extras_require=extras_require,
 )
\ No newline at end of file